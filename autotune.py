@@ -0,0 +1,273 @@
+#! python3
+
+"""
+Sweeps scheduled from a short calibration run.
+
+The time of a task varies by orders of magnitude between the direct and Ewald
+sums and with the number of neighbours, so no fixed worker count or chunk size
+suits every sweep. calibrate() runs the first tasks of a sweep in this process:
+
+1. one task to warm up (imports, compiled kernels, Bloch tables), then, if
+   its lattice sums are larger than the smallest tile, the next task at each
+   tile memory limit in LIMITS, one task per limit so that no limit is timed
+   on a result a cache (lattice_cache.py) already holds; the fastest limit
+   (tile shape of reduction.py) is kept if it beats the current one by 10%,
+   a margin which also covers the tasks differing a little
+2. further tasks at that limit give the time per task
+3. with several cores, a round of tasks on threads gives the thread speedup,
+   and a process pool is started once (per interpreter) to time its start up;
+   a pool started while calibrating runs the rest of the sweep if it is chosen
+
+and the backend, worker count and chunk size with the shortest predicted time
+are chosen:
+
+    serial   n t
+    thread   n t / speedup
+    process  start + (n t + chunks overhead) / workers
+
+where the overhead of a chunk is the time to pickle the task function plus
+DISPATCH. Chunks are as large as needed for the overhead to be under 5% of
+their time, but small enough for CHUNKS_PER_WORKER chunks per worker to share
+out uneven tasks. Calibration is kept under BUDGET of the serial time, and
+the values of the calibration tasks are returned so they are not computed
+again.
+
+The chosen tile limit holds while the sweep runs (Schedule.getBackend sets it
+before starting workers, so they inherit it) and record() puts the previous
+one back. Extinction.loopExtinction and dirtyRootFinder calibrate with
+backend="tune" and report the Schedule with their progress; Extinction keeps
+it as .schedule.
+"""
+
+import math
+import os
+import pickle
+import time
+
+import backends
+import reduction
+
+LIMITS = (4*2**20, 16*2**20, 64*2**20)  # tile memory limits tried (bytes)
+BUDGET = 0.05  # largest fraction of the serial time of a sweep spent calibrating
+SAMPLE = 4  # tasks timed at the chosen limit
+DISPATCH = 1e-3  # seconds to send a chunk to a process and get its results back
+CHUNKS_PER_WORKER = 4
+
+_startup = {}  # workers -> seconds to start a process pool
+
+
+def _noop(item):
+    return item
+
+
+def processStartup(workers, pools=None):
+    """
+    Seconds to start a process pool of workers and run a task on each, measured once per interpreter.
+
+    A pool started to measure is kept in pools["process"] if pools is given, otherwise closed.
+    """
+    if workers not in _startup:
+        start = time.perf_counter()
+        pool = backends.ProcessBackend(workers)
+        if pools is not None:
+            pools["process"] = pool
+        list(pool.imap(_noop, range(workers)))
+        _startup[workers] = time.perf_counter() - start
+        if pools is None:
+            pool.close()
+    return _startup[workers]
+
+
+class Schedule:
+    """
+    Settings chosen for a sweep and the measurements they were chosen from.
+
+    - backend, workers, chunksize: how to run the remaining tasks
+    - memory_limit: tile memory limit of reduction.py
+    - task_time: seconds per task in this process
+    - thread_speedup, process_startup: measured, or None if not measured
+    - estimates: predicted seconds of the sweep for each backend
+    - values, times: results and seconds of the calibration tasks, the first len(values) tasks of the sweep
+    - calibration_time: seconds spent calibrating
+    - measured_rate: tasks per second of the whole sweep, after record()
+    - pools: backends started while calibrating, by name, until getBackend() hands over the chosen one
+    """
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.backend = "serial"
+        self.workers = 1
+        self.chunksize = 1
+        self.memory_limit = reduction.MEMORY_LIMIT
+        self.previous_limit = None
+        self.task_time = 0.
+        self.thread_speedup = None
+        self.process_startup = None
+        self.estimates = {}
+        self.values = []
+        self.times = []
+        self.calibration_time = 0.
+        self.measured_rate = None
+        self.pools = {}
+
+    def getRate(self):
+        """
+        Predicted tasks per second of the chosen settings.
+        """
+        seconds = self.estimates.get(self.backend)
+        return self.tasks/seconds if seconds else float("inf")
+
+    def apply(self):
+        """
+        Set the tile memory limit, before any pool is started so workers inherit it.
+        """
+        if self.previous_limit is None:
+            self.previous_limit = reduction.MEMORY_LIMIT
+        reduction.setMemoryLimit(self.memory_limit)
+
+    def getBackend(self):
+        """
+        Backend for the rest of the sweep, the one calibration started if it has the chosen workers.
+        """
+        self.apply()
+        pool = self.pools.pop(self.backend, None)
+        self.closePools()
+        if pool is not None and pool.workers == self.workers:
+            return pool
+        if pool is not None:
+            pool.close()
+        return backends.BACKENDS[self.backend](self.workers)
+
+    def closePools(self, keep=None, terminate=False):
+        """
+        Stop the pools started while calibrating, except the one named keep.
+        """
+        for name in list(self.pools):
+            if name != keep:
+                pool = self.pools.pop(name)
+                if terminate:
+                    pool.terminate()
+                else:
+                    pool.close()
+
+    def record(self, seconds, tasks=None):
+        """
+        Record the wall time of the whole sweep, calibration included, and restore the tile memory limit.
+        """
+        self.measured_rate = (self.tasks if tasks is None else tasks)/seconds if seconds > 0 else None
+        if self.previous_limit is not None:
+            reduction.setMemoryLimit(self.previous_limit)
+            self.previous_limit = None
+
+    def describe(self):
+        text = "{} backend, {} workers, chunks of {}, tiles of {:.0f} MB: {:.3g} s per task, {:.3g} tasks/s predicted".format(
+            self.backend, self.workers, self.chunksize, self.memory_limit/2**20, self.task_time, self.getRate())
+        if self.measured_rate is not None:
+            text += ", {:.3g} tasks/s measured".format(self.measured_rate)
+        return text
+
+
+def _time(func, item):
+    start = time.perf_counter()
+    value = func(item)
+    return value, time.perf_counter() - start
+
+
+def calibrate(func, items, workers=None, points=None, limits=LIMITS, sample=SAMPLE, budget=BUDGET):
+    """
+    Schedule for running func over items, from timing the first tasks.
+
+    args:
+    - func: picklable function of one item
+    - items: list of the items of the sweep
+    - workers: most workers to use, all cores by default
+    - points: lattice points in the sums of a task, the limits are only tried if it is more than the smallest tile holds
+    - limits: tile memory limits tried, () to keep reduction.MEMORY_LIMIT
+    - sample: tasks timed at the chosen limit
+    - budget: largest fraction of the serial time spent calibrating
+    """
+    start = time.perf_counter()
+    items = list(items)
+    cores = workers or os.cpu_count() or 1
+    original = reduction.MEMORY_LIMIT
+    schedule = Schedule(len(items))
+    if not items:
+        return schedule
+
+    try:
+        value, first = _time(func, items[0])
+        schedule.values, schedule.times = [value], [first]
+        runs = int(budget*len(items))  # calibration runs allowed besides the first task
+
+        tiled = len(limits) > 0 and points is not None and points > reduction.tileSize(8, min(limits))
+        trials = {}  # limit -> time of its task
+        if tiled and runs >= len(limits) + 1 and len(items) > len(limits):
+            runs -= len(limits)
+            for limit in limits:
+                reduction.setMemoryLimit(limit)
+                value, elapsed = _time(func, items[len(schedule.values)])
+                schedule.values.append(value)
+                schedule.times.append(elapsed)
+                trials[limit] = elapsed
+            best = min(trials, key=trials.get)
+            if trials[best] < 0.9*trials.get(schedule.memory_limit, float("inf")):
+                schedule.memory_limit = best
+            reduction.setMemoryLimit(schedule.memory_limit)  # restored below, set again by Schedule.apply
+
+        timed = [trials[schedule.memory_limit]] if schedule.memory_limit in trials else []  # tasks at the chosen limit
+        while len(schedule.values) < min(sample + len(trials), len(items)) and runs > 0:
+            value, elapsed = _time(func, items[len(schedule.values)])
+            schedule.values.append(value)
+            schedule.times.append(elapsed)
+            timed.append(elapsed)
+            runs -= 1
+        timed = timed or schedule.times[1:] or schedule.times  # the first run includes the warm up
+        t = schedule.task_time = sorted(timed)[len(timed)//2]
+
+        left = len(items) - len(schedule.values)
+        schedule.estimates["serial"] = left*t
+        if cores > 1 and left > 0:
+            if runs >= cores and left > cores:
+                pool = schedule.pools["thread"] = backends.ThreadBackend(cores)
+                batch = items[len(schedule.values):len(schedule.values) + cores]
+                round_start = time.perf_counter()
+                results = list(pool.imap(lambda item: _time(func, item), batch))
+                wall = time.perf_counter() - round_start
+                schedule.thread_speedup = max(1., len(batch)*t/wall)  # times taken inside threads include waiting for the GIL
+                schedule.values += [value for value, _ in results]
+                schedule.times += [elapsed for _, elapsed in results]
+                left -= len(batch)
+                schedule.estimates["serial"] = left*t
+                schedule.estimates["thread"] = left*t/schedule.thread_speedup
+
+            if left*t > 1.:  # a pool could pay for itself
+                overhead = DISPATCH + _pickleTime(func)
+                best = None
+                for count in range(2, cores + 1):
+                    chunksize = max(1, min(math.ceil(20*overhead/t), left//(CHUNKS_PER_WORKER*count)))
+                    seconds = (left*t + math.ceil(left/chunksize)*overhead)/count
+                    if best is None or seconds < best[0]:
+                        best = (seconds, count, chunksize)
+                schedule.process_startup = processStartup(best[1], schedule.pools)
+                schedule.estimates["process"] = best[0] + schedule.process_startup
+                process_choice = best[1:]
+
+        schedule.backend = min(schedule.estimates, key=schedule.estimates.get)
+        if schedule.backend == "thread":
+            schedule.workers = cores
+            schedule.chunksize = max(1, left//(CHUNKS_PER_WORKER*cores))
+        elif schedule.backend == "process":
+            schedule.workers, schedule.chunksize = process_choice
+    except BaseException:  # a failed task or Ctrl-C, stop the pools calibration started
+        schedule.closePools(terminate=True)
+        raise
+    finally:
+        reduction.setMemoryLimit(original)
+    schedule.closePools(keep=schedule.backend)
+    schedule.calibration_time = time.perf_counter() - start
+    return schedule
+
+
+def _pickleTime(func):
+    start = time.perf_counter()
+    pickle.dumps(func)
+    return time.perf_counter() - start
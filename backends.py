@@ -0,0 +1,131 @@
+#! python3
+
+"""
+Execution backends for the (w, q) sweeps.
+
+Every backend has imap(func, iterable, chunksize), close() and terminate(),
+the part of the multiprocessing.Pool interface the sweeps use, and can be
+used as a context manager.
+
+- process: multiprocessing.Pool. Tasks and the objects they are bound to are
+  pickled to the workers, which pays off for long sweeps on many cores.
+- thread: a thread pool in this process. Nothing is pickled and lattice
+  tables, Bloch phases and caches are shared. NumPy and LAPACK release the
+  GIL in the heavy parts, so small sweeps (one q path or frequency cut) run
+  in milliseconds instead of paying for process start up.
+- serial: runs in the calling thread, for a handful of tasks and debugging.
+- distributed: workers on any number of hosts, see distributed.py. By name
+  it starts local workers only; pass a DistributedBackend for a cluster.
+
+getBackend(None, n_tasks) picks one from the number of tasks. The sweeps also
+take backend="tune", which picks the backend, worker count and chunk size from
+timing the first tasks (autotune.py).
+"""
+
+import os
+
+SERIAL_LIMIT = 4  # largest number of tasks run serially by default
+THREAD_LIMIT = 2000  # largest number of tasks run on threads by default
+
+
+class SerialBackend:
+    """
+    Runs tasks one after another in the calling thread.
+    """
+    local = True  # tasks run in this process
+
+    def __init__(self, workers=None):
+        self.workers = 1
+
+    def imap(self, func, iterable, chunksize=1):
+        return map(func, iterable)
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ThreadBackend(SerialBackend):
+    """
+    Runs tasks on a pool of threads sharing this process's memory.
+
+    args:
+    - workers: number of threads, all cores by default
+    """
+    def __init__(self, workers=None):
+        from multiprocessing.pool import ThreadPool  # not imported with the sweeps, workers start faster
+
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPool(self.workers)
+
+    def imap(self, func, iterable, chunksize=1):
+        return self.pool.imap(func, iterable, chunksize)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+
+
+class ProcessBackend(ThreadBackend):
+    """
+    Runs tasks on a multiprocessing.Pool.
+
+    args:
+    - workers: number of processes, all cores by default
+    """
+    local = False
+
+    def __init__(self, workers=None):
+        from multiprocessing import Pool
+
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = Pool(self.workers)
+
+
+def localDistributedBackend(workers=None):
+    """
+    DistributedBackend with workers (all cores by default) local worker processes.
+    """
+    from distributed import DistributedBackend
+
+    return DistributedBackend(workers or os.cpu_count() or 1)
+
+
+BACKENDS = {"serial": SerialBackend, "thread": ThreadBackend, "process": ProcessBackend, "distributed": localDistributedBackend}
+
+
+def chooseBackend(n_tasks=None):
+    """
+    Name of the default backend for a number of tasks (process if unknown).
+    """
+    if n_tasks is None:
+        return "process"
+    if n_tasks <= SERIAL_LIMIT:
+        return "serial"
+    if n_tasks <= THREAD_LIMIT:
+        return "thread"
+    return "process"
+
+
+def getBackend(backend=None, n_tasks=None, workers=None):
+    """
+    Backend from a name in BACKENDS, or chosen from n_tasks for None or "auto".
+
+    An object which already has imap (a backend or a Pool) is returned as it is.
+    """
+    if hasattr(backend, "imap"):
+        return backend
+    if backend is None or backend == "auto":
+        backend = chooseBackend(n_tasks)
+    return BACKENDS[backend](workers)
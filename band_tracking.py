@@ -0,0 +1,255 @@
+#! python3
+
+"""
+Bands followed continuously along a path by matching eigenvectors.
+
+Eigenvalues sorted by value swap labels wherever bands cross or come close.
+ModeTracker keeps the eigenvectors of the previous step instead and assigns
+the new modes to the old ones by maximum total overlap |<v_old, v_new>|
+(linear_sum_assignment), so column b of the results is the same band all the
+way along the path and the overlaps show how safely it was followed.
+
+Small matrices (the unit cell interaction matrices) are decomposed in full.
+Large ones (supercells, finite arrays) are solved with ARPACK in shift-invert
+mode: the shift is the centre of the Rayleigh quotients of the bands' last
+eigenvectors with the new matrix, the Arnoldi iteration starts from those
+eigenvectors, and a step costs one LU factorisation and a few iterations
+instead of a full decomposition. Degenerate bands may come out as any basis
+of their subspace, which shows as a low overlap.
+Shift-invert needs the matrix itself (dense or scipy.sparse): GMRES on the
+shifted matvec operators of finite_array.py does not converge near an
+eigenvalue.
+
+- trackBands: eigenvalues of H(q) - 1/alpha at fixed w along the Brillouin zone path.
+- followBand: complex frequency of one band along the path. At every q the
+  eigenvalue of that band (picked by overlap) is driven to zero, starting
+  from the frequency at the previous q, so branches do not hop as the roots
+  of det(H - 1/alpha) in dirtyRootFinder do.
+- followBands: followBand for several starting frequencies on a backend.
+- arrayModes: modes of a FiniteArray along a frequency range.
+"""
+
+import sys
+import time
+
+import numpy as np
+import scipy as sp
+from scipy import linalg, optimize, sparse
+import scipy.sparse.linalg
+from scipy.optimize import linear_sum_assignment
+
+import backends
+import precision
+from bloch import latticeBloch
+from finite_array import DenseEngine
+from plasmonic_lattice import Ewald
+from progress import Progress, Timed
+
+DENSE_LIMIT = 200  # largest matrix decomposed in full by default
+
+
+def normalise(vectors):
+    """
+    Columns scaled to unit norm.
+    """
+    return vectors/np.linalg.norm(vectors, axis=0)
+
+
+def overlapMatrix(previous, current):
+    """
+    |<previous_i, current_j>| for unit column vectors.
+    """
+    return np.abs(np.dot(np.conj(previous).T, current))
+
+
+def matchModes(previous, current):
+    """
+    Columns of current continuing the columns of previous, by maximum total overlap.
+
+    Returns (order, overlap): current[:, order[i]] follows previous[:, i], with overlap[i] = |<previous_i, current_order[i]>|.
+    """
+    overlap = overlapMatrix(previous, current)
+    rows, columns = linear_sum_assignment(overlap, maximize=True)
+    order = np.empty(previous.shape[1], dtype=int)
+    order[rows] = columns
+    return order, overlap[np.arange(len(order)), order]
+
+
+class ModeTracker:
+    """
+    Eigenpairs of a sequence of matrices, with the modes kept in a consistent order.
+
+    args:
+    - bands: number of modes followed, all of them by default (needed for iterative solves)
+    - sigma: the first step follows the bands closest to sigma
+    - dense_limit: matrices up to this size are decomposed in full, larger and sparse ones iteratively
+    - tol: tolerance of the iterative eigensolver
+    """
+    def __init__(self, bands=None, sigma=0, dense_limit=DENSE_LIMIT, tol=1e-10):
+        self.bands = bands
+        self.sigma = sigma
+        self.dense_limit = dense_limit
+        self.tol = tol
+        self.reset()
+
+    def reset(self):
+        self.values = None  # eigenvalues of the last step, in band order
+        self.vectors = None  # unit eigenvectors of the last step, columns in band order
+        self.overlap = None  # overlap of each band with the step before
+
+    def isDense(self, matrix):
+        return isinstance(matrix, np.ndarray) and len(matrix) <= self.dense_limit
+
+    def solve(self, matrix):
+        """
+        Eigenvalues and eigenvectors of matrix, ordered to follow the previous step.
+        """
+        if self.isDense(matrix):
+            values, vectors = sp.linalg.eig(matrix)
+        elif self.values is None:
+            values, vectors = self.eigs(matrix, self.sigma)
+        else:
+            shift = np.mean(np.sum(np.conj(self.vectors)*(matrix @ self.vectors), axis=0))  # Rayleigh quotients predict where the bands moved
+            values, vectors = self.eigs(matrix, shift, np.sum(self.vectors, axis=1))
+        vectors = normalise(vectors)
+
+        if self.vectors is None:
+            order = np.argsort(np.abs(values - self.sigma))[:self.bands]
+            order = order[np.argsort(values[order].real)]
+            overlap = np.ones(len(order))
+        else:
+            order, overlap = matchModes(self.vectors, vectors)
+        self.values, self.vectors, self.overlap = values[order], vectors[:, order], overlap
+        return self.values, self.vectors
+
+    def eigs(self, matrix, sigma, v0=None):
+        """
+        Eigenpairs next to sigma by shift-invert Arnoldi, starting from v0.
+
+        Twice the number of bands are found, so bands which move apart stay among them.
+        """
+        if self.bands is None:
+            raise ValueError("bands must be given to solve large matrices")
+        k = min(2*self.bands, matrix.shape[0] - 2)
+        return sp.sparse.linalg.eigs(matrix, k=k, sigma=sigma, v0=v0, tol=self.tol)
+
+
+def eigenproblem(cell, w, q, bloch=None, cache=None, j_max=5):
+    """
+    H(q) - 1/alpha at w, as in Extinction.calcExtinction.
+    """
+    return Ewald(2*np.pi/cell.getSpacing(), j_max, q, cell, np.array([0, 0]), bloch, cache).eigenproblem(w)
+
+
+def trackBands(cell, w, resolution, cache=None, j_max=5):
+    """
+    Eigenvalues of H(q) - 1/alpha at w along the Brillouin zone path, labelled by band.
+
+    Returns (values, overlap), both of shape (q points, 2*cell size): values[:, b] is band b,
+    overlap[i, b] its eigenvector overlap between q points i-1 and i.
+    """
+    bloch = latticeBloch(cell)
+    tracker = ModeTracker()
+    values, overlap = [], []
+    for q in cell.getBrillouinZone(resolution):
+        tracker.solve(eigenproblem(cell, w, q, bloch, cache, j_max))
+        values.append(tracker.values)
+        overlap.append(tracker.overlap)
+    return np.array(values), np.array(overlap)
+
+
+def followBand(w, cell, resolution, progress=None, cache=None, j_max=20):
+    """
+    Complex frequency of one band along the Brillouin zone path.
+
+    At the first q the band is the eigenvalue closest to zero at the root of
+    det(H - 1/alpha) near w, as in determinant_solver. At later q its
+    eigenvalue, picked by overlap with its eigenvector at the previous q, is
+    driven to zero starting from the previous frequency.
+
+    args:
+    - w: initial guess [Re(w), Im(w)]
+    - progress: optional Progress updated after each q
+
+    Returns (roots, overlap): roots [Re(w), Im(w)] for every q, and the overlap of the band between neighbouring q.
+    """
+    bloch = latticeBloch(cell)
+    roots, overlaps = [], []
+    reference = None
+    w = np.asarray(w, dtype=float)
+    with precision.using("double"):  # finite difference Jacobians need double precision
+        for q in cell.getBrillouinZone(resolution):
+            start = time.perf_counter()
+            ewald = Ewald(2*np.pi/cell.getSpacing(), j_max, q, cell, np.array([0, 0]), bloch, cache)
+            if reference is None:
+                w = sp.optimize.root(ewald.determinant, w, method="lm").x
+
+            def branch(x):
+                values, vectors = sp.linalg.eig(ewald.eigenproblem(x[0] + 1j*x[1]))
+                if reference is None:
+                    index = np.argmin(np.abs(values))
+                else:
+                    index = np.argmax(overlapMatrix(reference[:, None], normalise(vectors))[0])
+                return values[index], vectors[:, index]
+
+            def residual(x):
+                value = branch(x)[0]
+                return [value.real, value.imag]
+
+            w = sp.optimize.root(residual, w, method="lm").x
+            vector = normalise(branch(w)[1][:, None])
+            overlaps.append(1. if reference is None else overlapMatrix(reference[:, None], vector)[0, 0])
+            reference = vector[:, 0]
+            roots.append(w)
+            if progress is not None:
+                progress.update(time.perf_counter() - start, q)
+    return roots, overlaps
+
+
+def _followBand(args):
+    return followBand(*args)
+
+
+def followBands(wmin, wmax, guesses, cell, resolution, show_progress=True, log=None, backend=None):
+    """
+    followBand from guesses starting frequencies between wmin and wmax, one task per guess.
+
+    Returns (roots, overlap) of shapes (guesses, q points, 2) and (guesses, q points).
+
+    args:
+    - backend: "process", "thread", "serial", a backend from backends.py, or None to choose from the number of guesses
+    """
+    wrange = np.linspace(wmin, wmax, guesses)
+    values = [([w, 0], cell, resolution) for w in wrange]
+    progress = Progress(len(values), log=log, stream=sys.stderr if show_progress else None)
+    pool = backends.getBackend(backend, len(values))
+    roots, overlaps = [], []
+    for (value, overlap), elapsed in pool.imap(Timed(_followBand), values):
+        progress.update(elapsed, wrange[len(roots)])
+        roots.append(value)
+        overlaps.append(overlap)
+    if pool is not backend:
+        pool.close()
+    progress.finish()
+    return np.array(roots), np.array(overlaps)
+
+
+def arrayModes(array, wrange, bands=4, sigma=0, dense_limit=DENSE_LIMIT, tol=1e-8):
+    """
+    Eigenvalues of p/alpha - G p for a FiniteArray along wrange, labelled by band.
+
+    The matrix is assembled with the dense engine. Arrays above dense_limit
+    unknowns are solved by shift-invert Arnoldi, warm started from the previous
+    frequency.
+
+    Returns (values, overlap) of shape (len(wrange), bands).
+    """
+    tracker = ModeTracker(bands, sigma, dense_limit, tol)
+    values, overlap = [], []
+    for w in wrange:
+        matrix = -DenseEngine(array, w).matrix
+        matrix[np.diag_indices_from(matrix)] += np.repeat(1/array.getPolarisability(w), 2)
+        tracker.solve(matrix)
+        values.append(tracker.values)
+        overlap.append(tracker.overlap)
+    return np.array(values), np.array(overlap)
@@ -0,0 +1,179 @@
+#! python3
+
+"""
+Benchmarks for the hot paths: lattice sums, interaction matrices, extinction
+and root finding.
+
+Each workload is fixed so runs are reproducible. Wall time, evaluations per
+second and peak memory are recorded and compared against a stored baseline.
+
+usage:
+    python benchmarks.py                 # run and compare with the baseline
+    python benchmarks.py --save          # run and store a new baseline
+    python benchmarks.py --only ewald    # run workloads whose name contains "ewald"
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import plasmonic_lattice as pl
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# fixed parameters so that every run does the same work
+SPACING = 15.*10**-9
+RADIUS = 5.*10**-9
+PLASMA = 3.5
+LOSS = 0.04
+W = PLASMA/np.sqrt(2)
+Q = np.array([0.3*np.pi/SPACING, 0.1*np.pi/SPACING])
+
+
+class Workload:
+    """
+    Single benchmark: a function doing a fixed amount of work.
+
+    args:
+    - name: label used in reports and the baseline file
+    - func: callable performing the work
+    - evaluations: number of evaluations done by one call of func
+    """
+    def __init__(self, name, func, evaluations=1):
+        self.name = name
+        self.func = func
+        self.evaluations = evaluations
+
+    def run(self, repeat):
+        """
+        Time the workload, taking the best of repeat runs, then measure peak memory in a separate run.
+        """
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            self.func()
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        self.func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        wall = min(times)
+        return {"wall_time": wall, "evals_per_sec": self.evaluations/wall, "peak_memory": peak}
+
+
+def ewaldWorkload(neighbours):
+    cell = pl.Square(SPACING, RADIUS, PLASMA, LOSS, neighbours=neighbours, scaling=1.0)
+
+    def func():
+        pl.Ewald(2*np.pi/SPACING, 5, Q, cell, np.array([0, 0])).dyadicSumEwald(W)
+    return Workload("ewald_dyadic_sum_n{}".format(neighbours), func)
+
+
+def interactionWorkload(name, cell):
+    def func():
+        pl.Interaction(Q, cell).interactionMatrix(W)
+    return Workload("interaction_matrix_{}".format(name), func)
+
+
+def extinctionWorkload(resolution=3):
+    cell = pl.Square(SPACING, RADIUS, PLASMA, LOSS, neighbours=5, scaling=1.0)
+    extinction = pl.Extinction(cell, resolution, W - 0.5, W + 0.5)
+    wq_vals = [(w, q) for w in extinction.wrange for q in extinction.qrange]
+
+    def func():
+        for w, q in wq_vals:
+            extinction.calcExtinction(w, q)
+    return Workload("extinction_tile_{}".format(len(wq_vals)), func, len(wq_vals))
+
+
+def determinantWorkload(resolution=3):
+    cell = pl.Square(SPACING, RADIUS, PLASMA, LOSS, neighbours=5, scaling=1.0)
+
+    def func():
+        pl.determinant_solver([W, 0], cell, resolution)
+    return Workload("determinant_solver_{}".format(resolution), func, resolution)
+
+
+def getWorkloads():
+    workloads = [ewaldWorkload(n) for n in (5, 10, 20)]
+    workloads.append(interactionWorkload("square", pl.Square(SPACING, RADIUS, PLASMA, LOSS, neighbours=10, scaling=1.0)))
+    workloads.append(interactionWorkload("honeycomb", pl.Honeycomb(SPACING, RADIUS, PLASMA, LOSS, neighbours=5, scaling=1.0)))
+    workloads.append(extinctionWorkload())
+    workloads.append(determinantWorkload())
+    return workloads
+
+
+def loadBaseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results with the baseline. Returns a list of names which regressed.
+
+    A workload regresses if its wall time or peak memory grow by more than tolerance (fractional).
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key in ("wall_time", "peak_memory"):
+            if result[key] > baseline[name][key]*(1 + tolerance):
+                regressions.append(name)
+                break
+    return regressions
+
+
+def report(results, baseline):
+    print("{:<32} {:>12} {:>12} {:>12} {:>9}".format("workload", "time (s)", "evals/s", "peak (kB)", "vs base"))
+    for name, result in results.items():
+        change = ""
+        if name in baseline:
+            change = "{:+.1f}%".format(100*(result["wall_time"]/baseline[name]["wall_time"] - 1))
+        print("{:<32} {:>12.4f} {:>12.2f} {:>12.1f} {:>9}".format(name, result["wall_time"], result["evals_per_sec"], result["peak_memory"]/1024., change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the lattice sum hot paths.")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline file (json)")
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs per workload")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed fractional slow down before failing")
+    parser.add_argument("--only", default=None, help="only run workloads whose name contains this")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for workload in getWorkloads():
+        if args.only is not None and args.only not in workload.name:
+            continue
+        results[workload.name] = workload.run(args.repeat)
+
+    baseline = loadBaseline(args.baseline)
+    report(results, baseline)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("baseline saved to {}".format(args.baseline))
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("regressions: {}".format(", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
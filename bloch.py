@@ -0,0 +1,136 @@
+#! python3
+
+"""
+Factorised Bloch phases for lattice sums.
+
+For a Bravais point R = n*a1 + m*a2 the phase exp(i q.R) is u^n v^m with
+u = exp(i q.a1) and v = exp(i q.a2). The phases of a whole lattice are then
+built from two 1D geometric progressions instead of one complex exponential
+per lattice point, and when q steps along a straight path the progressions
+are updated by multiplying with the progression of the step.
+
+A BlochPhase may be shared by threads: setQ holds a lock, and callers pass
+their own q to phases() so another thread moving q in between does no harm.
+"""
+
+import threading
+
+import numpy as np
+
+import precision
+
+
+def geometricProgression(phase, number):
+    """
+    Return exp(i*phase)^n for n = -number..number.
+
+    Built by repeated multiplication, negative powers are the conjugates of the
+    positive ones as |exp(i*phase)| = 1 for real q.
+    """
+    powers = np.empty(2*number + 1, dtype=complex)
+    powers[number] = 1
+    if number > 0:
+        powers[number+1:] = np.cumprod(np.full(number, np.exp(1j*phase)))
+        powers[:number] = np.conj(powers[number+1:][::-1])
+    return powers
+
+
+class BlochPhase:
+    """
+    Bloch phases exp(i q.R) for R = n*a1 + m*a2 with |n|, |m| <= number.
+
+    args:
+    - a1, a2: lattice vectors
+    - number: largest index, usually the number of neighbours of the lattice
+    - reseed: number of incremental steps before the progressions are recomputed from scratch
+    """
+    def __init__(self, a1, a2, number, reseed=64):
+        self.a1 = np.array(a1, dtype=float)
+        self.a2 = np.array(a2, dtype=float)
+        self.number = number
+        self.reseed = reseed
+        self.basis = np.array([self.a1, self.a2]).T
+        self.q = None
+        self.step = None
+        self.steps_taken = 0
+        self.progressions = {}  # q -> (u powers, v powers)
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]  # not picklable, made again by __setstate__
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def setQ(self, q):
+        """
+        Move to a new q, stepping incrementally when q - previous q is the same as the last step.
+        """
+        q = np.array(q, dtype=float)
+        with self.lock:
+            self._setQ(q)
+
+    def _setQ(self, q):
+        key = tuple(q)
+        if key not in self.progressions:
+            step = None if self.q is None else q - self.q
+            if self.continues(step):
+                u, v = self.progressions[tuple(self.q)]
+                u_step, v_step = self.step[1]
+                self.progressions[key] = (u*u_step, v*v_step)
+                self.steps_taken += 1
+            else:
+                self.progressions[key] = (geometricProgression(np.dot(q, self.a1), self.number), geometricProgression(np.dot(q, self.a2), self.number))
+                self.steps_taken = 0
+                self.step = None
+                if step is not None and np.linalg.norm(step) > 0:
+                    self.step = (step, (geometricProgression(np.dot(step, self.a1), self.number), geometricProgression(np.dot(step, self.a2), self.number)))
+        self.q = q
+
+    def continues(self, step):
+        """
+        True if step matches the stored step and the progressions have not drifted for too long.
+        """
+        if step is None or self.step is None or self.steps_taken >= self.reseed:
+            return False
+        return np.linalg.norm(step - self.step[0]) <= 1e-9*np.linalg.norm(self.step[0])
+
+    def getTable(self):
+        """
+        Table of phases, entry [n+number, m+number] is exp(i q.(n*a1 + m*a2)).
+        """
+        u, v = self.progressions[tuple(self.q)]
+        return precision.store(np.outer(u, v), "bloch phases")
+
+    def getIndices(self, points):
+        """
+        Integer (n, m) for each point R = n*a1 + m*a2.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        return np.rint(np.linalg.solve(self.basis, points.T)).astype(int)
+
+    def phases(self, points, indices=None, q=None):
+        """
+        Phases exp(i q.R) for a list of Bravais points, or for their indices (n, m) if known.
+
+        q (already set with setQ) defaults to the current q.
+        """
+        n, m = self.getIndices(points) if indices is None else indices
+        u, v = self.progressions[tuple(self.q if q is None else np.array(q, dtype=float))]
+        return precision.store(u[n + self.number]*v[m + self.number], "bloch phases")
+
+    def clear(self):
+        self.q = None
+        self.step = None
+        self.progressions = {}
+
+
+def latticeBloch(cell):
+    """
+    BlochPhase covering the Bravais lattice of a lattice class (Square, Honeycomb...).
+    """
+    a1, a2 = cell.getLatticeVectors()
+    return BlochPhase(a1, a2, cell.neighbours)
@@ -0,0 +1,208 @@
+#! python3
+
+"""
+Accuracy against cost for the Ewald lattice sums.
+
+Runs ewald_test.Ewald over a grid of (E, j_max, neighbours, n_max) for a set of
+(q, w) points, measures the error against a high precision reference and the
+wall time, and writes the results and Pareto frontiers to csv files. Unlike
+testLatticeSum and testDyadicSum nothing is plotted.
+
+usage:
+    python convergence.py --output convergence_results --target 1e-6
+"""
+
+import argparse
+import csv
+import itertools
+import os
+import time
+
+import numpy as np
+
+from ewald_test import Lattice, Ewald
+
+
+def evaluate(ewald, w, quantity):
+    """
+    Evaluate a lattice sum, returned as an array of components.
+
+    args:
+    - ewald: Ewald instance
+    - w: frequency (eV)
+    - quantity: "dyadic" for the dyadic sum, "lattice" for the multipolar scalar sum up to n_max
+    """
+    if quantity == "dyadic":
+        if np.linalg.norm(ewald.pos) == 0:
+            return np.array(ewald.reducedDyadicSum(w))
+        return np.array(ewald.dyadicSumEwald(w))
+    elif quantity == "lattice":
+        return np.array([ewald.t0(w) + ewald.t1(w, ewald.n_max) + ewald.t2(w, ewald.n_max)])
+    raise ValueError("unknown quantity: {}".format(quantity))
+
+
+def relativeError(value, reference):
+    return np.linalg.norm(value - reference)/np.linalg.norm(reference)
+
+
+class ConvergenceHarness:
+    """
+    Sweep Ewald settings and record error and cost.
+
+    args:
+    - lattice: ewald_test.Lattice
+    - quantity: see evaluate()
+    - position: point in real space the sum is evaluated at
+    - reference: dict of settings (ewald, j_max, neighbours, n_max) for the reference sums
+    """
+    def __init__(self, lattice, quantity="dyadic", position=np.array([0, 0]), reference=None):
+        self.lattice = lattice
+        self.quantity = quantity
+        self.pos = position
+        self.reference = reference
+        self.references = {}
+
+    def run(self, settings, q, w):
+        """
+        Evaluate the sum for one set of settings. Returns (value, wall time).
+        """
+        ewald, j_max, neighbours, n_max = settings
+        start = time.perf_counter()
+        ewald_sum = Ewald(ewald, j_max, q, self.lattice, neighbours, self.pos, 0, n_max)
+        value = evaluate(ewald_sum, w, self.quantity)
+        return value, time.perf_counter() - start
+
+    def getReference(self, q, w):
+        """
+        Reference value at (q, w) and an estimate of its own error.
+
+        The Ewald sum should not depend on E, so the reference is computed at
+        two different E and their difference gives the accuracy of the reference.
+        """
+        key = (tuple(q), w)
+        if key not in self.references:
+            ref = self.reference
+            value, _ = self.run((ref["ewald"], ref["j_max"], ref["neighbours"], ref["n_max"]), q, w)
+            check, _ = self.run((1.25*ref["ewald"], ref["j_max"], ref["neighbours"], ref["n_max"]), q, w)
+            self.references[key] = (value, relativeError(check, value))
+        return self.references[key]
+
+    def sweep(self, grid, qpoints, frequencies):
+        """
+        Run every combination of settings at every (q, w).
+
+        args:
+        - grid: dict with lists for "ewald", "j_max", "neighbours" and "n_max"
+        - qpoints: list of points in reciprocal space
+        - frequencies: list of frequencies (eV)
+
+        Returns a list of dicts, one per run.
+        """
+        rows = []
+        for q, w in itertools.product(qpoints, frequencies):
+            reference, reference_error = self.getReference(q, w)
+            for settings in itertools.product(grid["ewald"], grid["j_max"], grid["neighbours"], grid["n_max"]):
+                value, wall_time = self.run(settings, q, w)
+                rows.append({
+                    "ewald": settings[0], "j_max": settings[1], "neighbours": settings[2], "n_max": settings[3],
+                    "q_x": q[0], "q_y": q[1], "w": w,
+                    "error": relativeError(value, reference), "reference_error": reference_error,
+                    "wall_time": wall_time,
+                })
+        return rows
+
+
+def aggregate(rows):
+    """
+    Combine runs with the same settings: worst error and total time over all (q, w).
+    """
+    combined = {}
+    for row in rows:
+        key = (row["ewald"], row["j_max"], row["neighbours"], row["n_max"])
+        if key not in combined:
+            combined[key] = {"ewald": key[0], "j_max": key[1], "neighbours": key[2], "n_max": key[3], "error": 0, "wall_time": 0}
+        combined[key]["error"] = max(combined[key]["error"], row["error"])
+        combined[key]["wall_time"] += row["wall_time"]
+    return list(combined.values())
+
+
+def paretoFrontier(rows):
+    """
+    Rows which no other row beats in both wall time and error, sorted by wall time.
+    """
+    frontier = []
+    best_error = np.inf
+    for row in sorted(rows, key=lambda r: (r["wall_time"], r["error"])):
+        if row["error"] < best_error:
+            frontier.append(row)
+            best_error = row["error"]
+    return frontier
+
+
+def cheapest(rows, target):
+    """
+    Cheapest settings whose error is below target, or None.
+    """
+    passing = [row for row in rows if row["error"] <= target]
+    if not passing:
+        return None
+    return min(passing, key=lambda r: r["wall_time"])
+
+
+def writeCsv(path, rows):
+    if not rows:
+        return
+    with open(path, "w") as output:
+        writer = csv.DictWriter(output, fieldnames=list(rows[0].keys()), lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Error against cost for Ewald lattice sums.")
+    parser.add_argument("--spacing", type=float, default=15*10**-9, help="square lattice spacing (m)")
+    parser.add_argument("--quantity", choices=["dyadic", "lattice"], default="dyadic")
+    parser.add_argument("--ewald", type=float, nargs="+", default=[0.5, 1, 2], help="E in units of 2*pi/spacing")
+    parser.add_argument("--j-max", type=int, nargs="+", default=[1, 3, 5])
+    parser.add_argument("--neighbours", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--n-max", type=int, nargs="+", default=[0])
+    parser.add_argument("--q", type=float, nargs="+", default=[0.1, 0.5], help="q along Gamma-X in units of pi/spacing")
+    parser.add_argument("--w", type=float, nargs="+", default=[2.5], help="frequencies (eV)")
+    parser.add_argument("--target", type=float, default=1e-6, help="relative accuracy target")
+    parser.add_argument("--output", default="convergence_results", help="directory for the csv files")
+    args = parser.parse_args(argv)
+
+    a = args.spacing
+    lattice = Lattice(np.array([0, a]), np.array([a, 0]))
+    grid = {
+        "ewald": [e*2*np.pi/a for e in args.ewald],
+        "j_max": args.j_max,
+        "neighbours": args.neighbours,
+        "n_max": args.n_max,
+    }
+    reference = {"ewald": 2*np.pi/a, "j_max": max(args.j_max) + 10, "neighbours": 2*max(args.neighbours), "n_max": max(args.n_max)}
+    qpoints = [np.array([q*np.pi/a, 0]) for q in args.q]
+
+    harness = ConvergenceHarness(lattice, args.quantity, reference=reference)
+    rows = harness.sweep(grid, qpoints, args.w)
+    combined = aggregate(rows)
+
+    os.makedirs(args.output, exist_ok=True)
+    writeCsv(os.path.join(args.output, "runs.csv"), rows)
+    writeCsv(os.path.join(args.output, "pareto.csv"), paretoFrontier(combined))
+    for q, w in itertools.product(qpoints, args.w):
+        point_rows = [row for row in rows if row["q_x"] == q[0] and row["q_y"] == q[1] and row["w"] == w]
+        writeCsv(os.path.join(args.output, "pareto_q{:.4g}_{:.4g}_w{:.4g}.csv".format(q[0], q[1], w)), paretoFrontier(point_rows))
+
+    reference_error = max(row["reference_error"] for row in rows)
+    print("reference accuracy: {:.2e}".format(reference_error))
+    best = cheapest(combined, args.target)
+    if best is None:
+        print("no settings reach an error of {:.1e}".format(args.target))
+    else:
+        print("cheapest settings for an error of {:.1e}: E = {:.4g}, j_max = {}, neighbours = {}, n_max = {} ({:.3f} s, error {:.2e})".format(
+            args.target, best["ewald"], best["j_max"], best["neighbours"], best["n_max"], best["wall_time"], best["error"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#! python3
+
+"""
+Dielectric models for the particles.
+
+A model gives the permittivity at real or complex frequencies w (eV), as a
+scalar or over a whole array of frequencies at once. Drude is the model
+Particle always used. Tabulated interpolates measured data with a cubic
+spline whose coefficients are computed once; at complex w each piece of the
+spline is continued analytically (the piece is chosen by Re(w)), so root
+finding in the complex plane works with tabulated metals too.
+
+Models remember their results for the last few frequency grids, so sweeps
+which evaluate the same w for every q only compute the permittivity once.
+Give a Particle (or lattice) a model with its model argument or setModel;
+particles without one share the Drude model of their wp and loss (getDrude).
+"""
+
+import collections
+import functools
+
+import numpy as np
+
+HZ_PER_EV = 1.6*10**-19/(6.63*10**-34)  # as in permittivity.py, which wrote perms_real.csv and perms_imag.csv
+
+
+def polarisability(w, permittivity, radius, ev):
+    """
+    Polarisability of a cylinder of radius in the long wavelength limit with radiative correction.
+
+    args:
+    - w: frequency (eV), scalar or array
+    - permittivity: permittivity at w
+    - radius: radius (m), scalar or broadcastable with w
+    - ev: eV to wavenumber conversion (plasmonic_lattice.ev)
+    """
+    k = w * ev
+    eps = (permittivity-1)/(permittivity+1)
+    return (2*np.pi*radius**2 * eps)/(1 - 0.25j*np.pi*(k*radius)**2 * eps)
+
+
+class Dielectric:
+    """
+    Base of the models: memoises permittivity(w) for the last cache_size frequency grids.
+
+    Subclasses implement evaluate(w) for an array of complex w.
+    """
+    def __init__(self, cache_size=32):
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()  # grid key -> permittivity
+
+    def getKey(self, w):
+        if np.ndim(w) == 0:
+            return complex(w)
+        w = np.asarray(w)
+        return (w.shape, w.dtype.str, w.tobytes())
+
+    def permittivity(self, w):
+        key = self.getKey(w)
+        try:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        except KeyError:  # not computed, or dropped by another thread sharing the model
+            pass
+        value = self.evaluate(np.asarray(w, dtype=complex))
+        if np.ndim(value) == 0:
+            value = value[()]
+        else:
+            value.setflags(write=False)  # shared by every caller with this grid
+        self.cache[key] = value
+        if len(self.cache) > self.cache_size:
+            try:
+                self.cache.popitem(last=False)
+            except KeyError:
+                pass
+        return value
+
+    def clear(self):
+        self.cache.clear()
+
+    def evaluate(self, w):
+        raise NotImplementedError
+
+
+class Drude(Dielectric):
+    """
+    Drude metal 1 - wp^2/(w^2 - i loss w).
+
+    args:
+    - wp: plasma frequency (eV)
+    - loss: damping (eV)
+    """
+    def __init__(self, wp, loss, cache_size=32):
+        Dielectric.__init__(self, cache_size)
+        self.plasma = wp
+        self.loss = loss
+
+    def evaluate(self, w):
+        return 1 - (self.plasma**2)/(w**2 - 1j*self.loss*w)
+
+
+@functools.lru_cache(maxsize=64)
+def _sharedDrude(wp, loss):
+    return Drude(wp, loss)
+
+
+def getDrude(wp, loss):
+    """
+    Drude model shared by every particle with the same scalar wp and loss, so they share its memo.
+
+    Arrays of wp or loss (one entry per particle or parameter set) get a model of their own.
+    """
+    if np.ndim(wp) == 0 and np.ndim(loss) == 0:
+        return _sharedDrude(wp, loss)
+    return Drude(wp, loss)
+
+
+class Tabulated(Dielectric):
+    """
+    Permittivity interpolated from tabulated data with a cubic spline.
+
+    args:
+    - w: real frequencies of the data (eV), increasing
+    - permittivity: complex permittivity at w
+    - extrapolate: continue the end pieces outside the data (root finders may step outside), otherwise frequencies outside raise ValueError
+    """
+    def __init__(self, w, permittivity, extrapolate=True, cache_size=32):
+        Dielectric.__init__(self, cache_size)
+        from scipy import interpolate  # slow to import, only needed for tabulated data
+        spline = interpolate.CubicSpline(np.asarray(w, dtype=float), np.asarray(permittivity, dtype=complex))
+        self.breaks = spline.x
+        self.coefficients = spline.c  # (4, pieces), highest power first
+        self.extrapolate = extrapolate
+
+    @classmethod
+    def fromCsv(cls, real_path, imag_path, frequency_scale=HZ_PER_EV, **kwargs):
+        """
+        Model from two csv files of (frequency, Re eps) and (frequency, Im eps), frequencies in Hz by default.
+        """
+        real = np.loadtxt(real_path, delimiter=",", ndmin=2)
+        imag = np.loadtxt(imag_path, delimiter=",", ndmin=2)
+        if not np.allclose(real[:, 0], imag[:, 0]):
+            raise ValueError("real and imaginary parts are given at different frequencies")
+        return cls(real[:, 0]/frequency_scale, real[:, 1] + 1j*imag[:, 1], **kwargs)
+
+    def evaluate(self, w):
+        if not self.extrapolate and (np.any(w.real < self.breaks[0]) or np.any(w.real > self.breaks[-1])):
+            raise ValueError("frequency outside the tabulated range {}..{} eV".format(self.breaks[0], self.breaks[-1]))
+        piece = np.clip(np.searchsorted(self.breaks, w.real, side='right') - 1, 0, len(self.breaks) - 2)
+        offset = w - self.breaks[piece]
+        value = np.zeros(w.shape, dtype=complex)
+        for c in self.coefficients:  # Horner
+            value = value*offset + c[piece]
+        return value
@@ -0,0 +1,356 @@
+#! python3
+
+"""
+Sweeps over several machines.
+
+A coordinator (the process running the sweep) serves a task board with
+multiprocessing.managers over TCP. Workers on any host connect to it, pull
+tiles of consecutive tasks, and push their results back, which stream into
+the coordinator's result store in order. When no tiles are left, an idle
+worker is handed a copy of the tile which has been running the longest, if
+it has taken more than straggler times the median tile time, so a slow or
+lost node does not hold up the end of a sweep. The first copy to finish is
+kept. Workers send a heartbeat every HEARTBEAT seconds, and a tile whose
+workers have all been silent for timeout seconds is lost and issued again,
+whether or not any tile has been timed yet and however many copies were
+issued. The coordinator raises instead of waiting when its local workers
+have stopped and no worker has been heard from for timeout.
+
+Tasks are pickled functions, so every node needs the same code on its path.
+DistributedBackend has the interface of the backends in backends.py and can
+be passed to Extinction.loopExtinction or dirtyRootFinder. On one machine it
+starts local worker processes itself; on a cluster start workers with
+
+    python distributed.py worker HOST:PORT --authkey KEY
+
+after the coordinator is listening (its address is in backend.address).
+"""
+
+import argparse
+import collections
+import itertools
+import os
+import pickle
+import queue
+import socket
+import sys
+import threading
+import time
+import traceback
+import multiprocessing
+from multiprocessing.managers import BaseManager
+
+HEARTBEAT = 5.  # seconds between heartbeats of a worker
+POLL = 1.  # seconds the coordinator waits for a result before checking the workers
+
+
+class TaskBoard:
+    """
+    Tiles waiting, running and done, shared with the workers through the manager.
+
+    args:
+    - straggler: a running tile is copied to an idle worker once it has taken straggler times the median tile time
+    - copies: largest number of copies of a tile running at once
+    - timeout: seconds of silence after which a worker is taken to be lost, and its tiles issued again
+    """
+    def __init__(self, straggler=2.0, copies=2, timeout=30.):
+        self.straggler = straggler
+        self.copies = copies
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pending = collections.deque()  # tile ids waiting for a worker
+        self.tiles = {}  # tile id -> (job id, items), until done
+        self.running = {}  # tile id -> (first start time, copies issued, workers running it)
+        self.durations = []
+        self.contact = {}  # worker -> time it was last heard from
+        self.jobs = {}  # job id -> pickled function
+        self.results = queue.Queue()  # (tile id, ok, results), read by the coordinator
+        self.workers = collections.Counter()  # worker -> tiles done
+        self.closed = False
+
+    def addJob(self, job, func):
+        self.jobs[job] = pickle.dumps(func)
+
+    def removeJob(self, job):
+        """
+        Forget a job and drop its tiles which are not done.
+        """
+        with self.lock:
+            self.jobs.pop(job, None)
+            for tile in [tile for tile, (tile_job, _) in self.tiles.items() if tile_job == job]:
+                del self.tiles[tile]
+                self.running.pop(tile, None)
+
+    def addTile(self, tile, job, items):
+        with self.lock:
+            self.tiles[tile] = (job, items)
+            self.pending.append(tile)
+
+    def getJob(self, job):
+        return self.jobs[job]
+
+    def isClosed(self):
+        return self.closed
+
+    def touch(self, worker=None):
+        """
+        Note that worker is alive.
+        """
+        self.contact[worker] = time.perf_counter()
+
+    def getLastContact(self):
+        """
+        Time any worker was last heard from, or None.
+        """
+        return max(self.contact.values(), default=None)
+
+    def take(self, worker=None):
+        """
+        Next tile (tile id, job id, items) for a worker, or None if there is nothing to do.
+        """
+        self.touch(worker)
+        with self.lock:
+            while self.pending:
+                tile = self.pending.popleft()
+                if tile in self.tiles:
+                    self.running[tile] = (time.perf_counter(), 1, [worker])
+                    return (tile,) + self.tiles[tile]
+            return self.steal(worker)
+
+    def isLost(self, holders, now):
+        return all(now - self.contact.get(holder, -float("inf")) > self.timeout for holder in holders)
+
+    def steal(self, worker=None):
+        """
+        Copy of a lost tile or of the longest running straggler, called with the lock held.
+        """
+        if not self.running:
+            return None
+        now = time.perf_counter()
+        late = None
+        if self.durations:
+            median = sorted(self.durations)[len(self.durations)//2]
+            late = now - self.straggler*median
+        lost = [(start, tile) for tile, (start, _, holders) in self.running.items() if self.isLost(holders, now)]
+        late = [] if late is None else [(start, tile) for tile, (start, issued, _) in self.running.items() if issued < self.copies and start <= late]
+        if not lost and not late:
+            return None
+        start, tile = min(lost or late)
+        _, issued, holders = self.running[tile]
+        self.running[tile] = (start, issued + 1, holders + [worker])
+        return (tile,) + self.tiles[tile]
+
+    def submit(self, tile, ok, results, worker=None):
+        """
+        Store the results of a tile. Returns False for copies finishing after the first.
+        """
+        self.touch(worker)
+        with self.lock:
+            if tile not in self.tiles:  # a copy finished first, or the job was dropped
+                return False
+            start = self.running.pop(tile, (time.perf_counter(),))[0]
+            self.durations.append(time.perf_counter() - start)
+            del self.tiles[tile]
+            self.workers[worker] += 1
+        self.results.put((tile, ok, results))
+        return True
+
+
+class _WorkerManager(BaseManager):
+    pass
+
+
+_WorkerManager.register("getBoard")
+
+
+def _heartbeat(address, authkey, name, stop, interval=HEARTBEAT):
+    """
+    Touch the board every interval seconds until stop is set, on a connection of its own.
+    """
+    try:
+        manager = _WorkerManager(tuple(address), authkey)
+        manager.connect()
+        board = manager.getBoard()
+        while not stop.wait(interval):
+            board.touch(name)
+    except (EOFError, ConnectionError):
+        pass  # coordinator gone
+
+
+def runWorker(address, authkey=None, poll=0.05, name=None):
+    """
+    Pull tiles from the coordinator at address and run them until it closes.
+
+    args:
+    - address: (host, port) of the coordinator
+    - authkey: key of the coordinator, by default this process's authkey (right for local workers)
+    - poll: seconds to wait when there is nothing to do
+    - name: name reported with the results, host:pid by default
+    """
+    authkey = multiprocessing.current_process().authkey if authkey is None else authkey
+    name = "{}:{}".format(socket.gethostname(), os.getpid()) if name is None else name
+    manager = _WorkerManager(tuple(address), authkey)
+    manager.connect()
+    board = manager.getBoard()
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(address, authkey, name, stop), daemon=True).start()
+    functions = {}
+    try:
+        while not board.isClosed():
+            task = board.take(name)
+            if task is None:
+                time.sleep(poll)
+                continue
+            tile, job, items = task
+            try:
+                if job not in functions:
+                    functions[job] = pickle.loads(board.getJob(job))
+                ok, results = True, [functions[job](item) for item in items]
+            except Exception:
+                ok, results = False, traceback.format_exc()
+            board.submit(tile, ok, results, name)
+    except (EOFError, ConnectionError):
+        pass  # coordinator gone
+    finally:
+        stop.set()
+
+
+class DistributedBackend:
+    """
+    Backend which runs tasks on workers connected over TCP.
+
+    args:
+    - workers: number of local worker processes to start
+    - address: (host, port) to listen on, an unused port on localhost by default. Use ("0.0.0.0", port) for remote workers.
+    - authkey: bytes shared with the workers, by default this process's authkey (local workers only)
+    - straggler, copies, timeout: work stealing settings of TaskBoard, timeout is also how long imap waits
+      without hearing from any worker once the local ones have stopped
+    """
+    local = False
+
+    def __init__(self, workers=0, address=("127.0.0.1", 0), authkey=None, straggler=2.0, copies=2, timeout=30.):
+        self.authkey = multiprocessing.current_process().authkey if authkey is None else authkey
+        self.timeout = timeout
+        self.board = TaskBoard(straggler, copies, timeout)
+
+        class Manager(BaseManager):
+            pass
+
+        Manager.register("getBoard", callable=lambda: self.board)
+        self.server = Manager(address, self.authkey).get_server()
+        self.address = self.server.address
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.tiles = itertools.count()
+        self.jobs = itertools.count()
+        self.processes = []
+        self.addWorkers(workers)
+        self.workers = workers
+
+    def getAddress(self):
+        """
+        Address workers on other hosts connect to.
+        """
+        host, port = self.address
+        return (socket.gethostname() if host in ("", "0.0.0.0") else host, port)
+
+    def addWorkers(self, number):
+        """
+        Start local worker processes.
+        """
+        for _ in range(number):
+            process = multiprocessing.Process(target=runWorker, args=(self.getAddress(), bytes(self.authkey)), daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def imap(self, func, iterable, chunksize=1):
+        """
+        Yield func(item) for every item in order, computed by the workers in tiles of chunksize items.
+        """
+        job = next(self.jobs)
+        self.board.addJob(job, func)
+        items = list(iterable)
+        tiles = []
+        for start in range(0, len(items), chunksize):
+            tiles.append(next(self.tiles))
+            self.board.addTile(tiles[-1], job, items[start:start+chunksize])
+
+        done = {}
+        started = time.perf_counter()
+        try:
+            for position, tile in enumerate(tiles):
+                while tile not in done:
+                    finished, ok, results = self.getResult(started, len(tiles) - position)
+                    if not ok:
+                        raise RuntimeError("task failed on a worker:\n" + results)
+                    done[finished] = results
+                for result in done.pop(tile):
+                    yield result
+        finally:
+            self.board.removeJob(job)
+
+    def getResult(self, started, left):
+        """
+        Next (tile id, ok, results) from the board. Raises if the local workers have stopped and no worker has
+        been heard from for timeout seconds.
+        """
+        while True:
+            try:
+                return self.board.results.get(timeout=POLL)
+            except queue.Empty:
+                pass
+            if any(process.is_alive() for process in self.processes):
+                continue
+            heard = max(self.board.getLastContact() or started, started)
+            if time.perf_counter() - heard > self.timeout:
+                raise RuntimeError("no worker has been heard from for {:.0f} s, {} tiles are not done".format(time.perf_counter() - heard, left))
+
+    def getWorkerCounts(self):
+        """
+        Number of tiles done by each worker.
+        """
+        return dict(self.board.workers)
+
+    def close(self):
+        self.board.closed = True
+        for process in self.processes:
+            process.join(5)
+        self.terminate()
+
+    def terminate(self):
+        self.board.closed = True
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        if getattr(self.server, "stop_event", None) is not None:
+            self.server.stop_event.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Worker for distributed sweeps.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    worker = subparsers.add_parser("worker", help="pull tasks from a coordinator")
+    worker.add_argument("address", help="HOST:PORT of the coordinator")
+    worker.add_argument("--authkey", required=True, help="key shared with the coordinator")
+    worker.add_argument("--processes", type=int, default=1, help="number of worker processes on this host")
+    args = parser.parse_args(argv)
+
+    host, port = args.address.rsplit(":", 1)
+    address = (host, int(port))
+    processes = [multiprocessing.Process(target=runWorker, args=(address, args.authkey.encode())) for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
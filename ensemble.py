@@ -0,0 +1,191 @@
+#! python3
+
+"""
+Ensembles of disordered finite arrays.
+
+Realisations perturb the particle positions (Gaussian, standard deviation
+position_sigma), radii (Gaussian, relative standard deviation radius_sigma)
+and remove particles (probability vacancy). Every realisation draws from its
+own child of a numpy SeedSequence, so a realisation is the same whichever
+worker computes it and in whatever order.
+
+Realisations run in parallel and their extinction spectra are folded into
+running means and variances (Welford's update, Chan's merge for combining
+runs), so memory does not grow with the number of realisations. With only
+size disorder the particles stay on the grid and each worker builds the
+Toeplitz kernel of the array once per frequency and shares it between all
+its realisations, keeping the kernels of as many frequencies as fit in
+ENGINE_MEMORY. Realisations with displaced particles or vacancies share
+nothing and build their engine at every frequency.
+
+Results are folded in in the order of the realisations, so a run stopped
+early by rtol has used exactly the first stats.count seeds, and a later run
+with stats carries on from the next one.
+"""
+
+import sys
+from multiprocessing import Pool
+
+import numpy as np
+
+from finite_array import FiniteArray
+from progress import Progress, Timed
+
+DENSE_LIMIT = 2000  # largest disordered array solved with the dense engine by default
+ENGINE_MEMORY = 256*2**20  # bytes of shared engines kept by each worker
+
+
+class RunningStats:
+    """
+    Running mean and variance of arrays (Welford), without storing the samples.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.  # sum of squared differences from the mean
+
+    def update(self, value):
+        value = np.asarray(value, dtype=float)
+        self.count += 1
+        delta = value - self.mean
+        self.mean = self.mean + delta/self.count
+        self.m2 = self.m2 + delta*(value - self.mean)
+
+    def merge(self, other):
+        """
+        Combine with the statistics of another set of samples (Chan et al).
+        """
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta*other.count/count
+        self.m2 = self.m2 + other.m2 + delta**2*self.count*other.count/count
+        self.count = count
+
+    def getVariance(self):
+        """
+        Sample variance (nan with fewer than two samples).
+        """
+        if self.count < 2:
+            return np.full(np.shape(self.mean), np.nan)
+        return self.m2/(self.count - 1)
+
+    def getStandardError(self):
+        return np.sqrt(self.getVariance()/self.count)
+
+
+class Ensemble:
+    """
+    Disorder ensemble of n1 x n2 unit cells of a lattice.
+
+    args:
+    - cell: lattice (Square, Honeycomb...)
+    - n1, n2: number of unit cells along each lattice vector
+    - position_sigma: standard deviation of the displacement of each coordinate (m)
+    - radius_sigma: relative standard deviation of the radii
+    - vacancy: probability a particle is missing
+    - seed: seed of the ensemble
+    - engine: matvec engine for FiniteArray, by default "fft" without positional disorder, and "dense" or "fmm" (above DENSE_LIMIT particles) with
+    - tol: GMRES tolerance
+    """
+    def __init__(self, cell, n1, n2, position_sigma=0., radius_sigma=0., vacancy=0., seed=0, engine=None, tol=1e-6):
+        self.cell = cell
+        self.n1 = n1
+        self.n2 = n2
+        self.position_sigma = position_sigma
+        self.radius_sigma = radius_sigma
+        self.vacancy = vacancy
+        self.seed = seed
+        self.engine = engine
+        self.tol = tol
+        self.shape = (len(cell.getUnitCell()), n1, n2)
+        self.engines = {}  # w -> engine shared by realisations which only differ in size, up to ENGINE_MEMORY
+        self.engine_bytes = 0
+
+    def getSeeds(self, number):
+        return np.random.SeedSequence(self.seed).spawn(number)
+
+    def isShared(self):
+        """
+        True if every realisation has the same positions, so one engine per frequency can be reused.
+        """
+        return self.position_sigma == 0 and self.vacancy == 0
+
+    def realisation(self, seed):
+        """
+        FiniteArray for one realisation drawn from a SeedSequence.
+        """
+        rng = np.random.default_rng(seed)
+        displacement = rng.normal(0, self.position_sigma, self.shape + (2,)) if self.position_sigma > 0 else None
+        radius = self.cell.radius*np.clip(1 + rng.normal(0, self.radius_sigma, self.shape), 0.01, None) if self.radius_sigma > 0 else None
+        present = rng.random(self.shape) >= self.vacancy if self.vacancy > 0 else None
+        return FiniteArray(self.cell, self.n1, self.n2, radius=radius, displacement=displacement, present=present)
+
+    def getEngine(self, array, w):
+        engine = self.engine
+        if engine is None:
+            if self.position_sigma == 0:
+                engine = "fft"
+            else:
+                engine = "fmm" if len(array) > DENSE_LIMIT else "dense"
+        if not self.isShared():
+            return array.getEngine(w, engine)
+        if w in self.engines:
+            return self.engines[w]
+        built = array.getEngine(w, engine)
+        size = getattr(getattr(built, "kernel", None), "nbytes", 0) + getattr(getattr(built, "matrix", None), "nbytes", 0)
+        if self.engine_bytes + size <= ENGINE_MEMORY:  # the first frequencies which fit are kept, as every realisation visits wrange in order
+            self.engines[w] = built
+            self.engine_bytes += size
+        return built
+
+    def extinction(self, seed, wrange):
+        """
+        Extinction spectrum of one realisation.
+        """
+        array = self.realisation(seed)
+        return np.array([array.calcExtinction(w, engine=self.getEngine(array, w), tol=self.tol) for w in wrange])
+
+    def run(self, number, wrange, processes=None, rtol=None, stats=None, show_progress=True, log=None):
+        """
+        Extinction mean and variance over number realisations.
+
+        args:
+        - number: number of realisations
+        - wrange: frequencies (eV)
+        - processes: worker processes, all cores by default
+        - rtol: stop early once the standard error is below rtol times |mean| at every frequency
+        - stats: RunningStats of an earlier run to continue, realisations carry on from its count
+
+        Returns the RunningStats, whose mean and variance are arrays over wrange.
+        """
+        stats = RunningStats() if stats is None else stats
+        wrange = np.asarray(wrange)
+        progress = Progress(number, log=log, stream=sys.stderr if show_progress else None)
+        pool = Pool(processes, initializer=_setEnsemble, initargs=(self,))
+        try:
+            start = stats.count
+            tasks = [(start + i, seed, wrange) for i, seed in enumerate(self.getSeeds(start + number)[start:])]
+            for (index, spectrum), elapsed in pool.imap(Timed(_extinction), tasks):  # in order, so an early stop keeps a prefix of the seeds
+                stats.update(spectrum)
+                progress.update(elapsed, index)
+                if rtol is not None and stats.count > 1 and np.all(stats.getStandardError() <= rtol*np.abs(stats.mean)):
+                    break
+        finally:
+            pool.terminate()
+        progress.finish()
+        return stats
+
+
+_ensemble = None  # ensemble of a worker process, so shared engines persist between tasks
+
+
+def _setEnsemble(ensemble):
+    global _ensemble
+    _ensemble = ensemble
+
+
+def _extinction(args):
+    index, seed, wrange = args
+    return index, _ensemble.extinction(seed, wrange)
@@ -7,11 +7,10 @@ Small script for testing Ewald's method on interactions via a 2D Green's functio
 import numpy as np
 import scipy as sp
 from scipy import special  # used for hankel functions
-from scipy import optimize
-from matplotlib import pyplot as plt
-from multiprocessing import Pool
 import itertools
 
+from plotting import getPyplot
+
 global ev
 ev = (1.602*10**-19 * 2 * np.pi)/(6.626*10**-34 * 2.997*10**8)
 
@@ -352,54 +351,91 @@ class Ewald:
         return _sum
         
         
-    def t1(self, w, n_max):
+    def t1Orders(self, w, n_max):
+        """
+        Reciprocal space terms of t1 for n = -n_max..n_max in one pass over the lattice.
+
+        Returns an array whose entry n_max+n is the sum over G of
+        (4i/A) exp((k^2 - beta^2)/(4E^2))/(k^2 - beta^2) * (i*beta/(k*exp(i*phi)))^n,
+        with the powers built by repeated multiplication.
+        """
         k = w*ev
-        _sum = 0
         a1, a2 = self.lattice.getBravaisVectors()
         area = float(np.cross(a1, a2))
-        
-        for G_pos in self.reciprocal:
-            beta = self.q + G_pos
-            beta_norm = np.linalg.norm(beta)
-            phi = np.angle(beta[0] + 1j*beta[1])
 
-            _sum += (4j/area) * 1/(k**2-beta_norm**2) * np.exp((k**2 - beta_norm**2)/(4*self.E**2))
-        
+        beta = self.q + np.array(self.reciprocal)
+        beta_norm = np.linalg.norm(beta, axis=1)
+        phi = np.angle(beta[:, 0] + 1j*beta[:, 1])
+        weight = (4j/area) * 1/(k**2-beta_norm**2) * np.exp((k**2 - beta_norm**2)/(4*self.E**2))
+
+        ratio = (1j*beta_norm)/(k*np.exp(1j*phi))
+        powers = np.ones((2*n_max+1, len(beta)), dtype=complex)
+        for n in range(1, n_max+1):  # power recurrences in both directions
+            powers[n_max+n] = powers[n_max+n-1]*ratio
+            powers[n_max-n] = powers[n_max-n+1]/ratio
+        return np.dot(powers, weight)
+
+    def t1(self, w, n_max):
+        orders = self.t1Orders(w, max(self.n_max-1, 0) if n_max != 0 else 0)
+        middle = len(orders)//2
+        _sum = orders[middle]
         if n_max != 0:
             for n in range(1, self.n_max):
-                for G_pos in self.reciprocal:
-                    beta = self.q + G_pos
-                    beta_norm = np.linalg.norm(beta)
-                    phi = np.angle(beta[0] + 1j*beta[1])
-                    
-                    _sum += (4j/area) * 1/(k**2-beta_norm**2) * np.exp((k**2 - beta_norm**2)/(4*self.E**2)) * (((1j*beta_norm)/(k*np.exp(1j*phi)))**n + ((1j*beta_norm)/(k*np.exp(1j*phi)))**-n)
-                #print("t1: " + str(n))
-
+                _sum += orders[middle+n] + orders[middle-n]
         return _sum
 
+    def t2IntegralOrders(self, dist, w, n_max):
+        """
+        Integrals I_n of the recurrence relation for n = 0..n_max, shape (n_max+1, len(dist)).
 
-    def t2(self, w, n_max):
+        Same recurrence as t2_I_n, run across n for every lattice point at once.
+        """
         k = w*ev
+        integrals = np.zeros((max(n_max, 1)+1, len(dist)), dtype=complex)
+        integrals[0] = self.t2_I_0(dist, w)
+        integrals[1] = self.t2_I_1(dist, w)
+        decay = np.exp(k**2/(4*self.E**2) - dist**2*self.E**2)
+        for n in range(2, n_max+1):
+            integrals[n] = +((self.E**(2*(n-1)))/(2*(n-1)*dist**2))*decay + (integrals[n-1]/dist**2) - (k**2/(4*dist**2))*integrals[n-2]
+        return integrals[:n_max+1]
+
+    def t2Orders(self, w, n_max):
+        """
+        Real space terms for n = -n_max..n_max in one pass over the lattice (origin excluded).
 
-        _sum = 0
-        for R_pos in self.lattice.genBravais(self.neighbours, False):  # sum excluding origin
-            R_norm = np.linalg.norm(R_pos)
-            alpha = np.angle(R_pos[0] + 1j*R_pos[1])
-
-            _sum += (-1j/np.pi)*np.exp(1j*np.dot(self.q, R_pos))*self.t2_I_0(R_norm, w)
+        Entry n_max+n is -2^(|n|+1) (i/pi) sum_R exp(i q.R) exp(-i n alpha) (R/k)^|n| I_|n|(R),
+        the same terms as t2_lim without its conjugation of negative orders.
+        """
+        k = w*ev
+        bravais = np.array(self.lattice.genBravais(self.neighbours, False))  # sum excluding origin
+        R_norm = np.linalg.norm(bravais, axis=1)
+        alpha = np.angle(bravais[:, 0] + 1j*bravais[:, 1])
+        phases = np.exp(1j*np.dot(bravais, self.q))
+        integrals = self.t2IntegralOrders(R_norm, w, n_max)
+
+        orders = np.zeros(2*n_max+1, dtype=complex)
+        radial = np.ones(len(R_norm), dtype=complex)
+        rotation = np.exp(-1j*alpha)
+        positive = negative = phases
+        orders[n_max] = (-2j/np.pi)*np.sum(phases*integrals[0])
+        for n in range(1, n_max+1):  # power recurrences for (R/k)^n and exp(-+i n alpha)
+            radial = radial*R_norm/k
+            positive = positive*rotation
+            negative = negative/rotation
+            orders[n_max+n] = -(2**(n+1))*(1j/np.pi)*np.sum(positive*radial*integrals[n])
+            orders[n_max-n] = -(2**(n+1))*(1j/np.pi)*np.sum(negative*radial*integrals[n])
+        return orders
 
+    def t2(self, w, n_max):
+        orders = self.t2Orders(w, max(self.n_max-1, 0) if n_max != 0 else 0)
+        middle = len(orders)//2
+        _sum = 0.5*orders[middle]
         if n_max != 0:
             for n in range(1, self.n_max):
-                for R_pos in self.lattice.genBravais(self.neighbours, False):  # sum excluding origin
-                    R_norm = np.linalg.norm(R_pos)
-                    alpha = np.angle(R_pos[0] + 1j*R_pos[1])
-
-                    _sum -= 2**(n+1) * (1j/np.pi) * (R_norm/k)**n * (2*np.cos(np.dot(self.q, R_pos)-n*alpha)) * self.t2_I_n(R_norm, w, n)
-                #print("t2: " + str(n))
+                # 2cos(q.R - n*alpha) pairs R with -R, whose angle is alpha + pi
+                _sum += orders[middle+n] + (-1)**n*orders[middle-n]
         return _sum
 
-    
-
     @memoize    
     def t2_I_n(self, dist, w, n):  # recurrence relation
         k = w*ev
@@ -445,6 +481,7 @@ def testLatticeSum(vector_1, vector_2, neighbour_range, q, w, pos):
     """
     Plots graphs of monopolar lattice sums. Returns graph of non-converging original method and converging sums with Ewald's method.
     """
+    plt = getPyplot()
     results = []
     ewald_results = []
     loop_range = range(1, neighbour_range+1)
@@ -491,6 +528,7 @@ def testDyadicSum(vector_1, vector_2, neighbour_range, q, w, pos=[0, 0]):
     """
     Plots graphs of dipolar lattice sums. Returns graph of non-converging original method and converging sums with Ewald's method.
     """
+    plt = getPyplot()
     results = []
     ewald_results = []
     loop_range = range(1, neighbour_range+1)
@@ -0,0 +1,310 @@
+#! python3
+
+"""
+Finite arrays of particles with the coupled dipole method.
+
+The dipoles p of an array of n1 x n2 unit cells satisfy
+
+    p_i/alpha_i - sum_(j != i) G(r_i - r_j) p_j = E_inc(r_i)
+
+with G from Interaction.green. The system is solved with GMRES, so only
+matrix-vector products with G are needed. On a regular array G only depends
+on the difference of cell indices, which makes it block Toeplitz, and the
+product is a 2D convolution done by FFT in O(N log N) time and O(N) memory.
+Vacancies keep this structure, the missing dipoles are zero. Arrays with
+displaced particles use the fast multipole engine in fmm.py. A dense engine
+is kept for small arrays and for checking.
+
+The coupling is long ranged (G falls off as |r|^-1/2) and the system is
+badly conditioned near the particle and lattice resonances. It is
+preconditioned with the block circulant approximation of p/alpha - G
+(T. Chan's optimal circulant of the Toeplitz kernel, with the mean 1/alpha
+of each site), which FFTs invert with one 2s x 2s solve per Fourier mode
+for s sites per cell. It differs from the array at its edges, so the
+iterations still grow with the size of the array, but several times more
+slowly; size disorder and small displacements (the kernel of the
+undisplaced grid is used) keep most of the gain, vacancies lose it, so
+arrays with vacancies are not preconditioned by default.
+
+Vectors are laid out as p[particle, component] with particles ordered by
+(site in the unit cell, i, j), the same order as FiniteArray.getPositions.
+"""
+
+import numpy as np
+import scipy as sp
+from scipy.sparse import linalg
+
+import precision
+from plasmonic_lattice import Particle, Interaction, ev
+from fmm import FMMEngine
+
+RESTART = 200  # GMRES restart length, the Krylov basis holds RESTART vectors of 2N
+
+
+class DenseEngine:
+    """
+    Products with the full 2N x 2N matrix of G. Memory is O(N^2).
+    """
+    def __init__(self, array, w):
+        positions = array.getPositions()
+        distance = positions[:, None, :] - positions[None, :, :]
+        G = Interaction(None, array.cell).green(w, np.moveaxis(distance, -1, 0))  # (2, 2, N, N)
+        diagonal = np.arange(len(positions))
+        G[:, :, diagonal, diagonal] = 0  # no self interaction
+        self.matrix = np.transpose(G, (2, 0, 3, 1)).reshape(2*len(positions), 2*len(positions))
+
+    def matvec(self, p):
+        return np.dot(self.matrix, p)
+
+
+def toeplitzKernel(array, w):
+    """
+    G(pos_s - pos_t + di*a1 + dj*a2) of the undisplaced grid, shape (2, 2, s, t, 2*n1, 2*n2).
+
+    The differences -n1 < di < n1, -n2 < dj < n2 are in FFT order, zero padded at di = n1 and dj = n2.
+    """
+    n1, n2 = array.n1, array.n2
+    di = np.fft.fftfreq(2*n1, 1./(2*n1))
+    dj = np.fft.fftfreq(2*n2, 1./(2*n2))
+    di[n1] = dj[n2] = 0  # unused index, masked below
+    cells = di[:, None, None]*array.a1 + dj[None, :, None]*array.a2  # (2*n1, 2*n2, 2)
+    basis = array.getBasis()
+    offsets = basis[:, None, :] - basis[None, :, :]  # (sites, sites, 2)
+    distance = offsets[:, :, None, None, :] + cells[None, None, :, :, :]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kernel = Interaction(None, array.cell).green(w, np.moveaxis(distance, -1, 0))
+    kernel[..., n1, :] = 0
+    kernel[..., :, n2] = 0
+    for s in range(len(basis)):
+        kernel[:, :, s, s, 0, 0] = 0  # no self interaction
+    return kernel
+
+
+class ToeplitzEngine:
+    """
+    Products with G by FFT, using the block Toeplitz structure of the array.
+
+    The kernel G(pos_s - pos_t + di*a1 + dj*a2) for every pair of sites (s, t)
+    and -n1 < di < n1, -n2 < dj < n2 is stored zero padded to (2*n1, 2*n2) so
+    the circular convolution equals the linear one.
+    """
+    def __init__(self, array, w):
+        if array.displacement is not None:
+            raise ValueError("displaced particles break the Toeplitz structure, use the dense or fmm engine")
+        self.sites = array.getCellSize()
+        self.index = np.flatnonzero(array.present)  # particles present in the full grid
+        self.n1, self.n2 = array.n1, array.n2
+        self.kernel = precision.store(np.fft.fft2(toeplitzKernel(array, w)), "toeplitz kernel")
+        self.shape = (2*self.n1, 2*self.n2)
+
+    def matvec(self, p):
+        full = np.zeros((self.sites*self.n1*self.n2, 2), dtype=complex)
+        full[self.index] = np.asarray(p).reshape(-1, 2)
+        full = full.reshape(self.sites, self.n1, self.n2, 2)
+        p_hat = np.fft.fft2(np.moveaxis(full, -1, 1), s=self.shape)  # (t, b, 2*n1, 2*n2)
+        field = np.fft.ifft2(np.einsum('abstuv,tbuv->sauv', self.kernel, p_hat.astype(self.kernel.dtype, copy=False)))[..., :self.n1, :self.n2]
+        return np.moveaxis(field, 1, -1).reshape(-1, 2)[self.index].ravel()
+
+
+class CirculantPreconditioner:
+    """
+    Approximate inverse of p/alpha - G from the block circulant approximation of the array.
+
+    T. Chan's circulant of a Toeplitz sequence t_d is c_d = ((n - d) t_d + d t_(d-n))/n, taken along both
+    lattice directions. With the mean 1/alpha of each site, every Fourier mode of the n1 x n2 grid has a
+    2s x 2s block, inverted once here.
+
+    args:
+    - engine: a ToeplitzEngine at w whose kernel is reused, otherwise the kernel is computed
+    """
+    def __init__(self, array, w, engine=None):
+        self.sites = array.getCellSize()
+        self.index = np.flatnonzero(array.present)
+        self.n1, self.n2 = array.n1, array.n2
+        if isinstance(engine, ToeplitzEngine):
+            kernel = np.fft.ifft2(engine.kernel)
+        else:
+            kernel = toeplitzKernel(array, w)
+        for axis, n in ((-2, self.n1), (-1, self.n2)):
+            d = np.arange(n)
+            weight = (d/n).reshape((-1, 1) if axis == -2 else (-1,))
+            kernel = (1 - weight)*np.take(kernel, d, axis) + weight*np.take(kernel, d + n, axis)
+        circulant = np.fft.fft2(kernel)  # (2, 2, s, t, n1, n2)
+
+        inverse_alpha = np.zeros(self.sites*self.n1*self.n2, dtype=complex)
+        inverse_alpha[self.index] = 1/array.getPolarisability(w)
+        counts = np.maximum(np.count_nonzero(array.present.reshape(self.sites, -1), axis=1), 1)
+        mean = inverse_alpha.reshape(self.sites, -1).sum(axis=1)/counts
+
+        size = 2*self.sites
+        blocks = -np.transpose(circulant, (4, 5, 2, 0, 3, 1)).reshape(self.n1, self.n2, size, size)  # rows (s, a), columns (t, b)
+        blocks += np.diag(np.repeat(mean, 2))
+        self.blocks = np.linalg.inv(blocks)
+
+    def matvec(self, x):
+        full = np.zeros((self.sites*self.n1*self.n2, 2), dtype=complex)
+        full[self.index] = np.asarray(x).reshape(-1, 2)
+        x_hat = np.fft.fft2(np.moveaxis(full.reshape(self.sites, self.n1, self.n2, 2), -1, 1), axes=(2, 3))  # (t, b, n1, n2)
+        x_hat = np.moveaxis(x_hat.reshape(2*self.sites, self.n1, self.n2), 0, -1)
+        y_hat = np.einsum('uvij,uvj->uvi', self.blocks, x_hat)
+        y = np.fft.ifft2(np.moveaxis(y_hat, -1, 0).reshape(self.sites, 2, self.n1, self.n2), axes=(2, 3))
+        return np.moveaxis(y, 1, -1).reshape(-1, 2)[self.index].ravel()
+
+
+ENGINES = {"dense": DenseEngine, "fft": ToeplitzEngine, "fmm": FMMEngine}
+
+
+class FiniteArray:
+    """
+    Finite array of n1 x n2 unit cells of a lattice (Square, Triangle, Honeycomb...).
+
+    args:
+    - cell: lattice giving the lattice vectors, unit cell and particles
+    - n1, n2: number of unit cells along each lattice vector
+    - radius, wp, loss: optional per particle values, broadcast to (sites, n1, n2), for size or material disorder
+    - displacement: optional offsets from the lattice positions, broadcast to (sites, n1, n2, 2)
+    - present: optional boolean mask of shape (sites, n1, n2), False for vacancies
+    """
+    def __init__(self, cell, n1, n2, radius=None, wp=None, loss=None, displacement=None, present=None):
+        self.cell = cell
+        self.n1 = n1
+        self.n2 = n2
+        self.a1, self.a2 = [np.array(a, dtype=float) for a in cell.getLatticeVectors()]
+        unit_cell = cell.getUnitCell()
+        shape = (len(unit_cell), n1, n2)
+        self.present = np.ones(shape, dtype=bool).ravel() if present is None else np.broadcast_to(present, shape).ravel()
+        self.displacement = None if displacement is None else np.broadcast_to(displacement, shape + (2,)).reshape(-1, 2)[self.present]
+        self.radius = np.broadcast_to(np.array([p.radius for p in unit_cell]).reshape(-1, 1, 1) if radius is None else radius, shape).ravel()[self.present]
+        self.wp = np.broadcast_to(np.array([p.plasma for p in unit_cell]).reshape(-1, 1, 1) if wp is None else wp, shape).ravel()[self.present]
+        self.loss = np.broadcast_to(np.array([p.loss for p in unit_cell]).reshape(-1, 1, 1) if loss is None else loss, shape).ravel()[self.present]
+        self.particles = Particle(self.radius, self.wp, self.loss, model=getattr(cell, "model", None))
+        self.iterations = 0
+
+    def getCellSize(self):
+        return len(self.cell.getUnitCell())
+
+    def getBasis(self):
+        """
+        Positions of the particles in the unit cell, shape (sites, 2).
+        """
+        return np.array([particle.pos for particle in self.cell.getUnitCell()], dtype=float)
+
+    def getPositions(self):
+        """
+        Positions of every particle, shape (N, 2), ordered by (site, i, j).
+        """
+        i = np.arange(self.n1)[:, None, None]
+        j = np.arange(self.n2)[None, :, None]
+        cells = i*self.a1 + j*self.a2
+        positions = (self.getBasis()[:, None, None, :] + cells[None]).reshape(-1, 2)[self.present]
+        if self.displacement is not None:
+            positions = positions + self.displacement
+        return positions
+
+    def __len__(self):
+        return int(np.count_nonzero(self.present))
+
+    def getPolarisability(self, w):
+        return self.particles.getPolarisability(w)
+
+    def incidentField(self, w, q=None, polarisation=(1, 0)):
+        """
+        Plane wave E_inc(r) = polarisation*exp(i q.r) at every particle, shape (N, 2).
+
+        args:
+        - q: in-plane wavevector (default normal incidence)
+        """
+        q = np.zeros(2) if q is None else np.asarray(q)
+        phase = np.exp(1j*np.dot(self.getPositions(), q))
+        return phase[:, None]*np.asarray(polarisation, dtype=complex)[None, :]
+
+    def getEngine(self, w, engine="fft"):
+        """
+        Matvec engine for G at w, from a name in ENGINES or a class taking (array, w).
+
+        Options can be bound with functools.partial, e.g. partial(FMMEngine, tol=1e-8).
+        """
+        if isinstance(engine, str):
+            engine = ENGINES[engine]
+        return engine(self, w)
+
+    def getOperator(self, w, engine="fft"):
+        """
+        LinearOperator for p/alpha - G p.
+        """
+        if not hasattr(engine, "matvec"):
+            engine = self.getEngine(w, engine)
+        inverse_alpha = np.repeat(1/self.getPolarisability(w), 2)
+        size = 2*len(self)
+        return sp.sparse.linalg.LinearOperator((size, size), matvec=lambda p: inverse_alpha*p - engine.matvec(p), dtype=complex)
+
+    def getPreconditioner(self, w, engine=None):
+        """
+        LinearOperator of the CirculantPreconditioner at w.
+        """
+        preconditioner = CirculantPreconditioner(self, w, engine)
+        size = 2*len(self)
+        return sp.sparse.linalg.LinearOperator((size, size), matvec=preconditioner.matvec, dtype=complex)
+
+    def solve(self, w, incident=None, engine="fft", tol=1e-8, restart=RESTART, maxiter=None, precondition=None):
+        """
+        Dipole moments p, shape (N, 2), for an incident field (default normal incidence, x polarised).
+
+        With precondition (by default unless there are vacancies) the system is
+        preconditioned with the block circulant approximation of the array
+        (CirculantPreconditioner) and the starting guess is its solution,
+        otherwise GMRES starts from the non interacting solution alpha*E_inc.
+        With single precision kernels (precision.py) tol is raised to what
+        their products can resolve.
+
+        GMRES keeps restart vectors of 2N complex values (restart*N*32 bytes),
+        and stalls if restarted too early. Near the particle resonance (w = 2.4
+        eV for wp = 3.5, loss = 0.04 Square arrays, tol = 1e-8) it takes 82
+        iterations for 30 x 30 cells, 160 for 60 x 60 and 355 for 120 x 120
+        (12 s on one core), against 349, 510 and 847 without preconditioning.
+        Away from it (w = 2.0 eV) 300 x 300 cells take 525 iterations and 1.5
+        minutes, which did not finish in 20 minutes without preconditioning,
+        but at w = 2.4 eV they did not finish in 30 minutes either. Arrays of
+        about 10^5 particles are practical away from the particle resonance,
+        near it up to about 2 x 10^4, or with a looser tol.
+        """
+        if precision.isReduced():
+            tol = max(tol, 100*precision.getEpsilon())
+            precision.record("dipoles", tol)
+        if incident is None:
+            incident = self.incidentField(w)
+        b = np.asarray(incident, dtype=complex).ravel()
+        if not hasattr(engine, "matvec"):
+            engine = self.getEngine(w, engine)
+        if precondition is None:
+            precondition = bool(np.all(self.present))
+        if precondition:
+            preconditioner = self.getPreconditioner(w, engine)
+            x0 = preconditioner.matvec(b)
+        else:
+            preconditioner = None
+            x0 = np.repeat(self.getPolarisability(w), 2)*b
+
+        self.iterations = 0
+
+        def count(_):
+            self.iterations += 1
+
+        p, info = sp.sparse.linalg.gmres(self.getOperator(w, engine), b, x0=x0, rtol=tol, restart=restart,
+                                         maxiter=maxiter, M=preconditioner, callback=count, callback_type='pr_norm')
+        if info > 0:
+            raise RuntimeError("GMRES did not converge in {} iterations".format(info))
+        return p.reshape(-1, 2)
+
+    def calcExtinction(self, w, q=None, polarisation=(1, 0), engine="fft", tol=1e-8, restart=RESTART):
+        """
+        Extinction 4*pi*k*sum(Im(conj(E_inc).p)) divided by the number of particles.
+        """
+        k = w*ev
+        incident = self.incidentField(w, q, polarisation)
+        p = self.solve(w, incident, engine, tol, restart)
+        return 4*np.pi*k*np.sum(np.conj(incident)*p).imag/len(self)
+
+    def loopExtinction(self, wrange, q=None, polarisation=(1, 0), engine="fft", tol=1e-8, restart=RESTART):
+        return [self.calcExtinction(w, q, polarisation, engine, tol, restart) for w in wrange]
@@ -0,0 +1,223 @@
+#! python3
+
+"""
+Fast multipole method for the 2D dyadic Green's function.
+
+The field of dipoles p_j is E_a(x) = (i/4) sum_j (k^2 delta_ab + d_a d_b) H0(k|x - y_j|) p_jb,
+so two scalar Helmholtz FMMs, one for the x and one for the y components of p
+as charges, give potentials phi_x and phi_y and the dyadic field follows from
+their Hessians. The Hessian of a local expansion sum_m L_m J_m(k rho) exp(i m theta)
+is again a local expansion, found by shifting coefficients with
+
+    D+ = dx + i dy: L_m -> -k L_(m-1)
+    D- = dx - i dy: L_m -> k L_(m+1)
+
+The boxes form a uniform quadtree stored as dense arrays per level. The
+translations (Graf's addition theorem, y = new centre - old centre) are
+
+    M2M: M'_m = sum_n M_n J_(n-m)(k|y|) exp(i (n-m) arg y)
+    M2L: L_m = sum_n M_n H_(n-m)(k|y|) exp(i (n-m) arg y)
+    L2L: L'_m = sum_n L_n J_(n-m)(k|y|) exp(i (n-m) arg y)
+
+M2L matrices are built once for the 40 possible box offsets of an
+interaction list and applied to every box of a level at once. For boxes much
+smaller than the wavelength J_n and H_n span hundreds of orders of magnitude,
+so the expansions at a level are stored scaled by (k*size)^(-|n|) (multipoles)
+and (k*size)^|n| (local expansions). Neighbouring boxes interact directly
+through a sparse matrix of Interaction.green.
+"""
+
+import numpy as np
+import scipy as sp
+from scipy import special, sparse
+
+from plasmonic_lattice import Interaction, ev
+
+# offsets from a box to the boxes of its interaction list, over all positions in the parent
+OFFSETS = [(dx, dy) for dx in range(-3, 4) for dy in range(-3, 4) if max(abs(dx), abs(dy)) > 1]
+
+
+def besselHessian(coefficients, k):
+    """
+    Coefficients of the second derivatives of a local expansion.
+
+    args:
+    - coefficients: L_m for m = -p..p along the last axis
+    - k: wavenumber
+
+    Returns the coefficients of (d_x d_x, d_x d_y, d_y d_y) applied to the
+    expansion, truncated to the same orders.
+    """
+    plus_plus = np.zeros_like(coefficients)  # D+ D+: L_m -> k^2 L_(m-2)
+    plus_plus[..., 2:] = k**2 * coefficients[..., :-2]
+    minus_minus = np.zeros_like(coefficients)  # D- D-: L_m -> k^2 L_(m+2)
+    minus_minus[..., :-2] = k**2 * coefficients[..., 2:]
+    plus_minus = -k**2 * coefficients  # Laplacian
+
+    xx = (plus_plus + 2*plus_minus + minus_minus)/4
+    yy = -(plus_plus - 2*plus_minus + minus_minus)/4
+    xy = (plus_plus - minus_minus)/4j
+    return xx, xy, yy
+
+
+def expansionOrder(k, diameter, tol):
+    """
+    Truncation order for boxes of a given diameter.
+
+    Well separated boxes converge like 0.4^p in practice, and p must also exceed k*diameter.
+    """
+    return int(np.ceil(np.abs(k)*diameter + np.log(tol)/np.log(0.4))) + 1
+
+
+def translationMatrix(function, k, y, p_out, p_in):
+    """
+    Matrix T[m, n] = function(n-m, k|y|) exp(i (n-m) arg y) for m = -p_out..p_out, n = -p_in..p_in.
+    """
+    order = np.arange(-p_in, p_in+1)[None, :] - np.arange(-p_out, p_out+1)[:, None]
+    return function(order, k*np.hypot(*y)) * np.exp(1j*order*np.arctan2(y[1], y[0]))
+
+
+class FMMEngine:
+    """
+    Products with G for arbitrary particle positions in near linear time.
+
+    args:
+    - array: FiniteArray (or anything with getPositions and cell)
+    - w: frequency (eV)
+    - tol: target relative accuracy, sets the expansion orders
+    - leaf_size: average number of particles in the smallest boxes
+    """
+    def __init__(self, array, w, tol=1e-6, leaf_size=16):
+        self.k = k = w*ev
+        self.positions = positions = np.asarray(array.getPositions(), dtype=float)
+        N = len(positions)
+        self.levels = max(2, int(np.ceil(np.log(max(N, 1)/leaf_size)/np.log(4))))
+
+        self.origin = positions.min(axis=0)
+        self.side = max((positions.max(axis=0) - self.origin).max(), 1e-300)*(1 + 1e-9)
+        self.orders = {l: expansionOrder(k, np.sqrt(2)*self.side/2**l, tol) for l in range(2, self.levels+1)}
+        self.orders[self.levels] += 2  # the Hessian shifts orders by two
+
+        # leaf boxes, expansions about their centres
+        n = 2**self.levels
+        size = self.side/n
+        box = np.clip(np.floor((positions - self.origin)/size).astype(int), 0, n-1)
+        self.box = box[:, 0]*n + box[:, 1]
+        relative = positions - (self.origin + (box + 0.5)*size)
+        rho = k*np.hypot(relative[:, 0], relative[:, 1])
+        theta = np.arctan2(relative[:, 1], relative[:, 0])
+        order = np.arange(-self.orders[self.levels], self.orders[self.levels]+1)
+        bessel = sp.special.jv(order[None, :], rho[:, None])
+        self.scales = {l: min(1., np.abs(k)*self.getSize(l))**np.abs(np.arange(-p, p+1)) for l, p in self.orders.items()}
+        self.outgoing = bessel*np.exp(-1j*order[None, :]*theta[:, None])/self.scales[self.levels]  # P2M
+        self.incoming = bessel*np.exp(1j*order[None, :]*theta[:, None])  # local expansion evaluation
+        self.assign = sp.sparse.csr_matrix((np.ones(N), (self.box, np.arange(N))), shape=(n*n, N))
+
+        self.buildTranslations()
+        self.near = self.nearField(array, w)
+
+    def getSize(self, level):
+        return self.side/2**level
+
+    def buildTranslations(self):
+        k = self.k
+        self.m2m = {}  # level of parent -> {child position: matrix}
+        self.l2l = {}
+        self.m2l = {}  # level -> {offset: matrix}, all acting on scaled expansions
+        for l in range(2, self.levels+1):
+            p = self.orders[l]
+            scale = self.scales[l]
+            if l > 2:
+                p_parent = self.orders[l-1]
+                parent_scale = self.scales[l-1]
+                child = self.getSize(l)
+                self.m2m[l-1] = {(cx, cy): translationMatrix(sp.special.jv, k, ((0.5 - cx)*child, (0.5 - cy)*child), p_parent, p)*scale[None, :]/parent_scale[:, None]
+                                 for cx in (0, 1) for cy in (0, 1)}
+                self.l2l[l] = {(cx, cy): translationMatrix(sp.special.jv, k, ((cx - 0.5)*child, (cy - 0.5)*child), p, p_parent)*scale[:, None]/parent_scale[None, :]
+                               for cx in (0, 1) for cy in (0, 1)}
+
+            size = self.getSize(l)
+            self.m2l[l] = {(dx, dy): translationMatrix(sp.special.hankel1, k, (-dx*size, -dy*size), p, p)*scale[:, None]*scale[None, :]
+                           for dx, dy in OFFSETS}  # y = target centre - source centre
+
+    def nearField(self, array, w):
+        """
+        Sparse 2N x 2N matrix of G between particles in the same or adjacent leaf boxes.
+        """
+        n = 2**self.levels
+        N = len(self.positions)
+        counts = np.bincount(self.box, minlength=n*n)
+        starts = np.cumsum(counts) - counts
+        by_box = np.argsort(self.box, kind='stable')
+        bx, by = self.box // n, self.box % n
+
+        rows, cols = [], []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                valid = (bx + dx >= 0) & (bx + dx < n) & (by + dy >= 0) & (by + dy < n)
+                targets = np.flatnonzero(valid)
+                neighbour = (bx[valid] + dx)*n + by[valid] + dy
+                number = counts[neighbour]
+                first = np.repeat(starts[neighbour] - (np.cumsum(number) - number), number)
+                rows.append(np.repeat(targets, number))
+                cols.append(by_box[first + np.arange(number.sum())])
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        keep = rows != cols
+        rows, cols = rows[keep], cols[keep]
+
+        G = Interaction(None, array.cell).green(w, (self.positions[rows] - self.positions[cols]).T)  # (2, 2, pairs)
+        a, b = np.meshgrid([0, 1], [0, 1], indexing='ij')
+        matrix_rows = (2*rows[None, None, :] + a[:, :, None]).ravel()
+        matrix_cols = (2*cols[None, None, :] + b[:, :, None]).ravel()
+        return sp.sparse.csr_matrix((G.ravel(), (matrix_rows, matrix_cols)), shape=(2*N, 2*N))
+
+    def upward(self, charges):
+        """
+        Multipole expansions at every level, arrays of shape (n, n, 2, 2p+1).
+        """
+        n = 2**self.levels
+        weighted = self.outgoing[:, None, :]*charges[:, :, None]  # (N, 2, 2p+1)
+        leaf = self.assign.dot(weighted.reshape(len(charges), -1))
+        multipoles = {self.levels: np.asarray(leaf).reshape(n, n, 2, -1)}
+        for l in range(self.levels-1, 1, -1):
+            child = multipoles[l+1]
+            multipoles[l] = sum(np.dot(child[cx::2, cy::2], matrix.T) for (cx, cy), matrix in self.m2m[l].items())
+        return multipoles
+
+    def interactionList(self, multipoles, level):
+        """
+        Local expansions at a level from the multipoles of its interaction lists.
+        """
+        n = 2**level
+        padded = np.zeros((n+6, n+6) + multipoles[level].shape[2:], dtype=complex)
+        padded[3:n+3, 3:n+3] = multipoles[level]
+
+        local = np.zeros_like(multipoles[level])
+        for px in (0, 1):
+            for py in (0, 1):
+                for dx, dy in OFFSETS:
+                    if abs((px + dx) // 2) > 1 or abs((py + dy) // 2) > 1:
+                        continue  # source is not a child of a neighbour of the parent
+                    local[px::2, py::2] += np.dot(padded[3+px+dx:3+n+dx:2, 3+py+dy:3+n+dy:2], self.m2l[level][(dx, dy)].T)
+        return local
+
+    def matvec(self, p):
+        k = self.k
+        charges = np.asarray(p).reshape(-1, 2)
+        multipoles = self.upward(charges)
+
+        local = self.interactionList(multipoles, 2)
+        for l in range(3, self.levels+1):
+            parent = local
+            local = self.interactionList(multipoles, l)
+            for (cx, cy), matrix in self.l2l[l].items():
+                local[cx::2, cy::2] += np.dot(parent, matrix.T)
+
+        n = 2**self.levels
+        local = local.reshape(n*n, 2, -1)[self.box]/self.scales[self.levels]  # (N, 2, 2p+1)
+        xx, xy, yy = besselHessian(local, k)
+        x_coefficients = k**2*local[:, 0] + xx[:, 0] + xy[:, 1]
+        y_coefficients = k**2*local[:, 1] + xy[:, 0] + yy[:, 1]
+        far = 0.25j*np.stack((np.sum(x_coefficients*self.incoming, axis=1), np.sum(y_coefficients*self.incoming, axis=1)), axis=1)
+        return far.ravel() + self.near.dot(np.asarray(p).ravel())
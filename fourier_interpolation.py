@@ -0,0 +1,233 @@
+#! python3
+
+"""
+Fourier (Wannier style) interpolation of the interaction matrix across the
+Brillouin zone.
+
+A lattice sum over Bravais points R with phases exp(i q.R) is periodic in q
+and equal to a real space Fourier series. The series is fitted from values on
+a coarse grid of q with an FFT and then evaluated cheaply at any q.
+
+Near Rayleigh anomalies (|q + G| = k) the full H is not smooth and the series
+converges slowly. FourierInterpolator computes H directly there.
+EwaldFourierInterpolator splits off the poles of the reciprocal space terms
+instead, fits the smooth rest with the real space part, and sums the few
+terms near the poles directly, so the anomalies are treated exactly.
+
+Extinction, determinant_solver and Ewald take sums="interpolate" for an
+EwaldFourierInterpolator (see plasmonic_lattice.getSums). A fit costs grid^2
+evaluations of the smooth sums at one frequency and is kept per frequency, so
+it pays off when many q share a frequency (extinction maps, dense bands),
+not in root finding, where every frequency is new.
+"""
+
+import numpy as np
+
+import reduction
+from plasmonic_lattice import Ewald, ev
+
+
+def reciprocalVectors(a1, a2):
+    """
+    Reciprocal lattice vectors with a_i.b_j = 2*pi*delta_ij.
+    """
+    R = np.array([[0, -1], [1, 0]])
+    b1 = 2*np.pi * np.dot(R, a2)/np.dot(a1, np.dot(R, a2))
+    b2 = 2*np.pi * np.dot(R, a1)/np.dot(a2, np.dot(R, a1))
+    return b1, b2
+
+
+class FourierInterpolator:
+    """
+    Interpolates H(w, q) from a coarse q grid.
+
+    args:
+    - cell: lattice (Square, Honeycomb...)
+    - grid: number of q points along each reciprocal vector, made odd so the series is symmetric
+    - anomaly_tol: distance to a Rayleigh anomaly, relative to |b1|, inside which H is computed directly
+    - ewald, j_max: parameters of the direct Ewald sums
+    """
+    def __init__(self, cell, grid=15, anomaly_tol=0.02, ewald=None, j_max=5):
+        if grid % 2 == 0:
+            grid += 1
+        self.cell = cell
+        self.grid = grid
+        self.anomaly_tol = anomaly_tol
+        self.E = 2*np.pi/cell.getSpacing() if ewald is None else ewald
+        self.j_max = j_max
+        self.a1, self.a2 = [np.array(a, dtype=float) for a in cell.getLatticeVectors()]
+        self.b1, self.b2 = reciprocalVectors(self.a1, self.a2)
+        self.orders = np.fft.fftfreq(grid, 1./grid).astype(int)  # n for each fft index
+        self.coefficients = {}  # w -> C[n, m, ...]
+        self.errors = {}  # w -> estimated relative error
+
+    def directMatrix(self, w, q):
+        """
+        Interaction matrix from the full Ewald sum.
+        """
+        return Ewald(self.E, self.j_max, q, self.cell, np.array([0, 0])).interactionMatrix(w)
+
+    def sample(self, w, q):
+        """
+        The periodic function of q which is fitted.
+        """
+        return self.directMatrix(w, q)
+
+    def getGrid(self):
+        """
+        Coarse q grid, shape (grid, grid, 2), point [i, j] is (i*b1 + j*b2)/grid.
+        """
+        fractions = np.arange(self.grid)/self.grid
+        return fractions[:, None, None]*self.b1 + fractions[None, :, None]*self.b2
+
+    def fit(self, w, checks=4):
+        """
+        Fit the Fourier series at frequency w and estimate its error.
+
+        The error is the largest relative difference from the direct sum at
+        checks points between grid points which are away from anomalies.
+        """
+        grid = self.getGrid()
+        samples = np.array([[self.sample(w, grid[i, j]) for j in range(self.grid)] for i in range(self.grid)])
+        self.coefficients[w] = np.fft.fft2(samples, axes=(0, 1))/self.grid**2
+
+        error = 0.
+        offsets = (np.arange(checks) + 0.5)/checks
+        for f1, f2 in zip(offsets, offsets[::-1]):
+            q = f1*self.b1 + f2*self.b2
+            if self.isNearAnomaly(w, q):
+                continue
+            exact = self.directMatrix(w, q)
+            error = max(error, np.abs(self.interactionMatrix(w, q) - exact).max()/np.abs(exact).max())
+        self.errors[w] = error
+        return error
+
+    def getError(self, w):
+        if w not in self.errors:
+            self.fit(w)
+        return self.errors[w]
+
+    def isNearAnomaly(self, w, q, orders=3):
+        """
+        True if |q + G| is within anomaly_tol*|b1| of k for some reciprocal lattice vector G.
+        """
+        k = (w*ev).real
+        n = np.arange(-orders, orders+1)
+        G = n[:, None, None]*self.b1 + n[None, :, None]*self.b2
+        distance = np.abs(np.linalg.norm(np.asarray(q) + G, axis=-1) - k)
+        return distance.min() < self.anomaly_tol*np.linalg.norm(self.b1)
+
+    def series(self, w, q):
+        """
+        Evaluate the fitted Fourier series at q.
+        """
+        if w not in self.coefficients:
+            self.fit(w)
+        f1 = np.dot(q, self.a1)/(2*np.pi)
+        f2 = np.dot(q, self.a2)/(2*np.pi)
+        u = np.exp(2j*np.pi*f1*self.orders)
+        v = np.exp(2j*np.pi*f2*self.orders)
+        return np.einsum('n,nm...,m->...', u, self.coefficients[w], v)
+
+    def interactionMatrix(self, w, q):
+        """
+        H(w, q) from the series, or from the full Ewald sum near an anomaly.
+        """
+        if self.isNearAnomaly(w, q):
+            return self.directMatrix(w, q)
+        return self.series(w, q)
+
+    def evaluateMany(self, w, qpoints):
+        """
+        H(w, q) at many q, shape (len(qpoints), ...), for dense bands and zone maps.
+        """
+        return np.array([self.interactionMatrix(w, q) for q in qpoints])
+
+
+class EwaldFourierInterpolator(FourierInterpolator):
+    """
+    Interpolates the smooth part of the Ewald dyadic sum at the origin.
+
+    The reciprocal space terms f(q + G) of t1_lim have poles at the Rayleigh
+    anomalies |q + G| = k. With u = (|q + G|^2 - k^2)/s and s = (window |b1|)^2
+    they are split by chi = exp(-u^2) into f (1 - chi), which has no pole, and
+    f chi. The sum of f (1 - chi) over G is smooth and periodic in q and is
+    fitted together with the real space sums (t2_lim). f chi is below 1e-17
+    of f unless |q + G| is within about 2.5 window |b1| of k, so it is summed
+    directly over those few G (about 45 for window=1.5), and t0 does not
+    depend on q.
+
+    With the defaults the error is about 1e-11 relative to H for Square
+    lattices. H at a q then takes about 0.2 ms, against 1.3 ms for the direct
+    sums with 10 neighbours and 5 ms with 40, but a fit costs grid^2 = 49
+    sums of the smooth part, about 40 to 65 direct evaluations, so it pays
+    off for frequencies shared by more q points than that. The sums over a
+    truncated lattice are only periodic in q once they have converged, so
+    with few neighbours (5 for E = 2 pi/spacing) H differs from the direct
+    sums by their truncation error, about 1e-4, which fit() reports.
+
+    args:
+    - window: width of chi in units of |b1|, wider needs more direct terms and fewer grid points
+    """
+    NEAR = 40.  # direct terms are those with Re(u^2) < NEAR, chi < exp(-NEAR) beyond
+
+    def __init__(self, cell, grid=7, ewald=None, j_max=5, window=1.5):
+        FourierInterpolator.__init__(self, cell, grid, 0., ewald, j_max)
+        self.area = float(np.cross(self.a1, self.a2))  # signed, as in Ewald.t1_lim
+        self.scale = (window*np.linalg.norm(self.b1))**2
+
+    def spectralTerms(self, w, beta):
+        """
+        Terms of t1_lim for n = 0, 2 at beta = q + G without the pole 1/(k^2 - |beta|^2), shape (points, 2), and u.
+        """
+        k = w*ev
+        norm2 = np.sum(beta**2, axis=1)
+        n = np.array([0, 2])
+        phi = np.arctan2(beta[:, 1], beta[:, 0])
+        weight = (4*1j**(n+1))/self.area * np.exp((k**2 - norm2)/(4*self.E**2))[:, None] * (np.sqrt(norm2)[:, None]/k)**n * np.exp(-1j*n*phi[:, None])
+        return weight, (norm2 - k**2)/self.scale
+
+    def smoothSpectral(self, w, q):
+        """
+        Sum over the reciprocal lattice of the terms of t1_lim times 1 - chi, for n = 0, 2.
+        """
+        def terms(G_pos, indices):
+            weight, u = self.spectralTerms(w, np.asarray(q) + G_pos)
+            x = u*u
+            ratio = -np.expm1(-x)/np.where(x == 0, 1, x)  # (1 - exp(-x))/x
+            return -weight*(u*np.where(x == 0, 1, ratio)/self.scale)[:, None]  # (1 - chi)/(k^2 - |beta|^2) = -u ratio/s
+
+        return reduction.latticeReduce(self.cell, 'reciprocal', True, terms, width=2)
+
+    def nearSpectral(self, w, q):
+        """
+        Sum of the terms of t1_lim times chi, for n = 0, 2, over the G near the anomalies.
+        """
+        k = w*ev
+        q = np.asarray(q, dtype=float)
+        radius = np.sqrt(abs(k.real)**2 + np.sqrt(self.NEAR)*self.scale)
+        ranges = []
+        for a in (self.a1, self.a2):  # n = ((q + G).a - q.a)/(2 pi) with |q + G| < radius
+            shift = np.dot(q, a)/(2*np.pi)
+            reach = radius*np.linalg.norm(a)/(2*np.pi)
+            number = min(self.cell.neighbours, int(np.ceil(reach + abs(shift))))
+            ranges.append(np.arange(-number, number+1))
+        n, m = [index.ravel() for index in np.meshgrid(*ranges, indexing='ij')]
+        if hasattr(self.cell, "getLatticeMask"):
+            mask = self.cell.getLatticeMask(n, m, True)
+            n, m = n[mask], m[mask]
+        weight, u = self.spectralTerms(w, q + n[:, None]*self.b1 + m[:, None]*self.b2)
+        near = (u*u).real < self.NEAR
+        return np.sum(-weight[near]*(np.exp(-u[near]**2)/(self.scale*u[near]))[:, None], axis=0)
+
+    def sample(self, w, q):
+        ewald = Ewald(self.E, self.j_max, q, self.cell, np.array([0, 0]))
+        return np.array([ewald.t2_lim(w, 0), ewald.t2_lim(w, 2)]) + self.smoothSpectral(w, q)
+
+    def isNearAnomaly(self, w, q, orders=3):
+        return False
+
+    def interactionMatrix(self, w, q):
+        h_0, h_pos2 = self.series(w, q) + self.nearSpectral(w, q)
+        ewald = Ewald(self.E, self.j_max, q, self.cell, np.array([0, 0]))
+        return ewald.dyadicFromLatticeSums(w, ewald.t0(w) + h_0, h_pos2)
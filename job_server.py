@@ -0,0 +1,312 @@
+#! python3
+
+"""
+Local job server which shares sweep results between users.
+
+Clients send sweep specifications as JSON lines over TCP. A specification
+names a lattice and the sweep:
+
+    {"kind": "extinction", "lattice": {"type": "Square", "spacing": 15e-9, "radius": 5e-9,
+     "wp": 3.5, "loss": 0.04, "neighbours": 15, "scaling": 1.0},
+     "wmin": 2.0, "wmax": 3.0, "resolution": 33}
+
+    {"kind": "roots", "lattice": {...}, "wmin": 2.0, "wmax": 3.0, "guesses": 4, "resolution": 33}
+
+and is split into work units: (lattice, w, q) points of Extinction.calcExtinction,
+or (lattice, starting w, resolution) runs of determinant_solver along the
+Brillouin zone path. Units already computed are served from the result
+store, units another request is computing are awaited rather than started
+again, and only new units go to the worker processes. Extinction is the
+same at q and -q, so those share a unit. A specification may set
+"precision" ("double" or "single", precision.py), by default the server's,
+and units of different precision are never shared. The store can be kept in
+a JSON lines file so results outlive the server; the new results of a
+request are appended to it in one write, off the event loop.
+
+Replies are {"id": ..., "results": [...], "computed": n, "reused": n, "joined": n}
+with results in the order of Extinction.loopExtinction or dirtyRootFinder,
+or {"id": ..., "error": "..."}, also for lines which are not JSON objects.
+{"op": "stats"} returns the server totals.
+
+    python job_server.py serve --port 8765 --workers 8 --store results.jsonl
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import json
+import os
+import socket
+import sys
+
+import numpy as np
+
+import plasmonic_lattice as pl
+import precision
+
+PORT = 8765
+LATTICES = {"Square": pl.Square, "Triangle": pl.Triangle, "Honeycomb": pl.Honeycomb, "SimpleHoneycomb": pl.SimpleHoneycomb}
+LATTICE_ARGS = ("spacing", "radius", "wp", "loss", "neighbours", "scaling")
+
+
+def _number(value):
+    return "{:.12g}".format(float(value))
+
+
+def latticeKey(lattice):
+    """
+    Canonical text of a lattice specification.
+    """
+    return json.dumps([lattice["type"]] + [_number(lattice[name]) for name in LATTICE_ARGS])
+
+
+@functools.lru_cache(maxsize=16)
+def makeLattice(key):
+    """
+    Lattice object from a latticeKey, built once per worker process.
+    """
+    values = json.loads(key)
+    arguments = [float(value) for value in values[1:]]
+    arguments[4] = int(arguments[4])  # neighbours
+    return LATTICES[values[0]](*arguments)
+
+
+def expandSpec(spec):
+    """
+    Work units of a specification, in the order of its results.
+
+    Returns a list of (key, unit). Units are tuples ("extinction", lattice key, w, q, precision)
+    or ("roots", lattice key, w, resolution, precision), keys are their canonical text.
+    """
+    lattice = latticeKey(spec["lattice"])
+    cell = makeLattice(lattice)
+    resolution = int(spec["resolution"])
+    storage = spec.get("precision", precision.getPrecision())
+    if storage not in precision.PRECISIONS:
+        raise ValueError("unknown precision {}, use one of {}".format(storage, sorted(precision.PRECISIONS)))
+    units = []
+    if spec["kind"] == "extinction":
+        wrange = np.linspace(spec["wmin"], spec["wmax"], resolution, endpoint=True)
+        qrange = cell.getBrillouinZone(resolution)
+        for w in wrange:
+            for q in qrange:
+                q = tuple(float(value) for value in q)
+                negative = tuple(-value for value in q)
+                canonical = max(q, negative, key=lambda point: [_number(value) for value in point])  # q and -q share a unit
+                key = json.dumps(["extinction", lattice, _number(w), [_number(value) for value in canonical], storage])
+                units.append((key, ("extinction", lattice, float(w), canonical, storage)))
+    elif spec["kind"] == "roots":
+        for w in np.linspace(spec["wmin"], spec["wmax"], int(spec["guesses"])):
+            key = json.dumps(["roots", lattice, _number(w), resolution, storage])
+            units.append((key, ("roots", lattice, float(w), resolution, storage)))
+    else:
+        raise ValueError("unknown kind of sweep: {}".format(spec["kind"]))
+    return units
+
+
+def computeUnit(unit):
+    """
+    Value of a work unit, run in a worker process.
+    """
+    kind, lattice, w, parameter, storage = unit
+    cell = makeLattice(lattice)
+    with precision.using(storage):
+        if kind == "extinction":
+            extinction = pl.Extinction(cell, 1, w, w)
+            return float(extinction.calcExtinction(w, np.array(parameter)))
+        roots = pl.determinant_solver([w, 0], cell, parameter)
+    return [[float(value) for value in root] for root in roots]
+
+
+class JobServer:
+    """
+    Deduplicating sweep server.
+
+    args:
+    - executor: concurrent.futures executor running the units, a process pool with workers processes by default
+    - workers: number of worker processes of the default executor
+    - store: optional JSON lines file the results are loaded from and appended to
+    """
+    def __init__(self, executor=None, workers=None, store=None):
+        self.executor = concurrent.futures.ProcessPoolExecutor(workers) if executor is None else executor
+        self.writer = concurrent.futures.ThreadPoolExecutor(1)  # appends to the store, one request at a time
+        self.store = store
+        self.results = {}  # unit key -> value
+        self.inflight = {}  # unit key -> future of the unit being computed
+        self.stats = collections.Counter()
+        if store is not None and os.path.exists(store):
+            self.loadStore()
+
+    def loadStore(self):
+        """
+        Load the results of the store. Malformed records are skipped, and a truncated last one (a crash
+        while appending) is cut off so the next append starts on a line of its own.
+        """
+        with open(self.store, "rb") as f:
+            lines = f.read().split(b"\n")
+        end = 0  # bytes of complete records
+        for number, line in enumerate(lines, 1):
+            last = number == len(lines)  # text after the last newline
+            try:
+                record = json.loads(line)
+                self.results[record["key"]] = record["value"]
+            except (ValueError, KeyError, TypeError) as error:
+                if line.strip():
+                    print("{}:{}: {} record skipped ({})".format(self.store, number, "truncated" if last else "malformed", error), file=sys.stderr)
+                if last:
+                    break
+            end += len(line) + (not last)
+        if end < os.path.getsize(self.store):
+            with open(self.store, "r+b") as f:
+                f.truncate(end)
+        elif lines[-1].strip():  # a whole last record without its newline
+            with open(self.store, "ab") as f:
+                f.write(b"\n")
+
+    async def compute(self, key, unit, counts, records):
+        """
+        Value of a unit, from the store, from a computation in flight, or computed now (and added to records).
+        """
+        if key in self.results:
+            counts["reused"] += 1
+            return self.results[key]
+        if key in self.inflight:
+            counts["joined"] += 1
+            return await asyncio.shield(self.inflight[key])
+
+        counts["computed"] += 1
+        future = asyncio.get_running_loop().run_in_executor(self.executor, computeUnit, unit)
+        self.inflight[key] = future
+        try:
+            value = await asyncio.shield(future)
+        finally:
+            del self.inflight[key]
+        self.results[key] = value
+        records.append(json.dumps({"key": key, "value": value}) + "\n")
+        return value
+
+    def appendStore(self, records):
+        with open(self.store, "a") as f:
+            f.writelines(records)
+
+    async def runSpec(self, spec):
+        """
+        Results of a specification and how many units were computed, reused and joined.
+        """
+        counts = collections.Counter()
+        units = expandSpec(spec)
+        records = []
+        try:
+            results = await asyncio.gather(*[self.compute(key, unit, counts, records) for key, unit in units])
+        finally:
+            if self.store is not None and records:
+                await asyncio.get_running_loop().run_in_executor(self.writer, self.appendStore, records)
+        self.stats.update(counts)
+        self.stats["requests"] += 1
+        reply = {"results": results}
+        reply.update({name: counts[name] for name in ("computed", "reused", "joined")})
+        return reply
+
+    async def reply(self, message):
+        if not isinstance(message, dict):
+            return {"id": None, "error": "request is not a JSON object"}
+        if message.get("op") == "stats":
+            reply = dict(self.stats, stored=len(self.results), inflight=len(self.inflight))
+        else:
+            try:
+                reply = await self.runSpec(message["spec"])
+            except Exception as error:
+                reply = {"error": "{}: {}".format(type(error).__name__, error)}
+        reply["id"] = message.get("id")
+        return reply
+
+    async def handle(self, reader, writer):
+        """
+        Answer the JSON line requests of one connection, several at a time.
+        """
+        lock = asyncio.Lock()
+
+        async def answer(line):
+            try:
+                message = json.loads(line)
+            except ValueError as error:  # answered, the other requests of the connection carry on
+                reply = {"id": None, "error": "{}: {}".format(type(error).__name__, error)}
+            else:
+                reply = await self.reply(message)
+            async with lock:
+                writer.write((json.dumps(reply) + "\n").encode())
+                await writer.drain()
+
+        tasks = []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                tasks.append(asyncio.ensure_future(answer(line)))
+            await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=PORT, started=None):
+        server = await asyncio.start_server(self.handle, host, port)
+        if started is not None:
+            started(server)
+        async with server:
+            await server.serve_forever()
+
+    def run(self, host="127.0.0.1", port=PORT):
+        try:
+            asyncio.run(self.serve(host, port))
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            self.writer.shutdown()
+
+
+def request(message, address=("127.0.0.1", PORT), timeout=None):
+    """
+    Send one request to a server and wait for its reply.
+    """
+    with socket.create_connection(address, timeout) as connection:
+        connection.sendall((json.dumps(message) + "\n").encode())
+        connection.shutdown(socket.SHUT_WR)
+        with connection.makefile() as f:
+            return json.loads(f.readline())
+
+
+def submit(spec, address=("127.0.0.1", PORT), timeout=None):
+    """
+    Results of a sweep specification from a server. Raises RuntimeError if the server reports an error.
+    """
+    reply = request({"spec": spec}, address, timeout)
+    if "error" in reply:
+        raise RuntimeError(reply["error"])
+    return reply
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep job server with shared results.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve = subparsers.add_parser("serve", help="run the server")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=PORT)
+    serve.add_argument("--workers", type=int, default=None, help="worker processes, all cores by default")
+    serve.add_argument("--store", default=None, help="JSON lines file of results kept between runs")
+    send = subparsers.add_parser("submit", help="send a specification (JSON file) and print the reply")
+    send.add_argument("spec")
+    send.add_argument("--host", default="127.0.0.1")
+    send.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        JobServer(workers=args.workers, store=args.store).run(args.host, args.port)
+    else:
+        with open(args.spec) as f:
+            print(json.dumps(submit(json.load(f), (args.host, args.port))))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
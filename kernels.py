@@ -0,0 +1,288 @@
+#! python3
+
+"""
+Optional compiled kernels for the dyadic Green's function and the real space
+Ewald series.
+
+With numba installed the kernels below run as compiled loops which form the
+xx, xy and yy components (and the scalar real space sum) together, point by
+point, without the temporaries of the NumPy expressions. Without numba, or
+after useJit(False), the same functions run as vectorised NumPy, which is
+also the reference the compiled path is checked against by verify().
+
+numba has no Hankel functions of complex argument, so H0 and H1 come from
+scipy on both paths and H2 from the recurrence H2 = 2 H1/z - H0. The
+exponential integrals E_n(x) of the Ewald series are a port of the Cephes
+expn used by scipy.special.expn.
+
+numba is imported, and the kernels compiled, on the first compiled call
+(_getNumba), so importing this module (and plasmonic_lattice, in every
+worker) does not pay for it. The Ewald kernel returns the terms of every
+point, which are added pairwise (reduction.pairwiseSum) like the other
+lattice sums.
+"""
+
+import math
+import threading
+from importlib.util import find_spec
+
+import numpy as np
+import scipy as sp
+from scipy import special
+
+import precision
+import reduction
+
+NUMBA = find_spec("numba") is not None  # numba is installed, imported by _getNumba
+JIT = NUMBA  # use the compiled kernels
+
+_numba = None
+_lock = threading.Lock()
+
+MACHEP = 1.11022302462515654042e-16
+MAXLOG = 7.09782712893383996843e2
+EULER = 0.57721566490153286061
+BIG = 4.503599627370496e15
+
+
+def useJit(flag=True):
+    """
+    Switch the compiled kernels on or off. They stay off if numba is not installed.
+    """
+    global JIT
+    JIT = bool(flag) and _getNumba() is not None
+    return JIT
+
+
+def _getNumba():
+    """
+    numba, imported and the kernels compiled on first use, or None (and JIT off) if it is not installed.
+    """
+    global _numba, NUMBA, JIT, _expn, _greenLoop, _ewaldLoop
+    if _numba is None and NUMBA:
+        with _lock:
+            if _numba is None:
+                try:
+                    import numba
+                except ImportError:
+                    NUMBA = JIT = False
+                    return None
+                jit = numba.njit(cache=True, error_model='numpy')
+                _expn = jit(_expn)
+                _greenLoop = jit(_greenLoop)
+                _ewaldLoop = jit(_ewaldLoop)
+                _numba = numba
+    return _numba
+
+
+def _expn(n, x):
+    """
+    Exponential integral E_n(x) for integer n >= 0 and real x >= 0 (Cephes expn).
+    """
+    if n < 0 or x < 0:
+        return math.nan
+    if x > MAXLOG:
+        return 0.
+    if x == 0:
+        return math.inf if n < 2 else 1./(n - 1)
+    if n == 0:
+        return math.exp(-x)/x
+
+    if x > 1:  # continued fraction
+        k = 1
+        pkm2 = 1.
+        qkm2 = x
+        pkm1 = 1.
+        qkm1 = x + n
+        ans = pkm1/qkm1
+        t = 1.
+        while t > MACHEP:
+            k += 1
+            if k & 1:
+                yk = 1.
+                xk = n + (k - 1)/2
+            else:
+                yk = x
+                xk = k/2
+            pk = pkm1*yk + pkm2*xk
+            qk = qkm1*yk + qkm2*xk
+            if qk != 0:
+                r = pk/qk
+                t = abs((ans - r)/r)
+                ans = r
+            else:
+                t = 1.
+            pkm2 = pkm1
+            pkm1 = pk
+            qkm2 = qkm1
+            qkm1 = qk
+            if abs(pk) > BIG:
+                pkm2 /= BIG
+                pkm1 /= BIG
+                qkm2 /= BIG
+                qkm1 /= BIG
+        return ans*math.exp(-x)
+
+    # power series
+    psi = -EULER - math.log(x)
+    for i in range(1, n):
+        psi += 1./i
+    z = -x
+    xk = 0.
+    yk = 1.
+    pk = 1. - n
+    ans = 0. if n == 1 else 1./pk
+    t = 1.
+    while t > MACHEP:
+        xk += 1
+        yk *= z/xk
+        pk += 1
+        if pk != 0:
+            ans += yk/pk
+        t = abs(yk/ans) if ans != 0 else 1.
+    return z**(n - 1)*psi/math.gamma(n) - ans
+
+
+def _greenLoop(k, x, y, h0, h1, out):
+    """
+    Fill out[0], out[1], out[2] with G_xx, G_xy, G_yy (nan at zero separation).
+    """
+    for i in range(x.shape[0]):
+        r2 = x[i]*x[i] + y[i]*y[i]
+        if r2 == 0:  # singular, as on the NumPy path
+            out[0, i] = out[1, i] = out[2, i] = complex(math.nan, math.nan)
+            continue
+        R = math.sqrt(r2)
+        arg = k*R
+        h2 = 2*h1[i]/arg - h0[i]
+        scale = 0.25j*k*k
+        cross = (x[i]*x[i] - y[i]*y[i])/(k*R*r2)*h1[i]
+        out[0, i] = scale*(y[i]*y[i]/r2*h0[i] + cross)
+        out[1, i] = scale*x[i]*y[i]/r2*h2
+        out[2, i] = scale*(x[i]*x[i]/r2*h0[i] - cross)
+
+
+def _ewaldLoop(k, E, j_max, x, y, phases, out):
+    """
+    Fill out[:, i] with the real space Ewald terms [xx, xy, yy, scalar] of point i.
+
+    xx, xy, yy are the terms of Ewald.dyadicEwaldG2 before the 1/(4 pi), and
+    scalar the terms of Ewald.ewaldG2.
+    """
+    coefficients = np.empty(j_max+1, dtype=np.complex128)
+    term = 1. + 0j
+    for j in range(j_max+1):
+        coefficients[j] = term
+        term = term*(k/(2*E))**2/(j + 1)
+    E2 = E*E
+    E4 = E2*E2
+    for i in range(x.shape[0]):
+        r2 = x[i]*x[i] + y[i]*y[i]
+        s = r2*E2
+        previous = _expn(0, s)  # E_(j-1)
+        current = _expn(1, s)  # E_j
+        shifted = 0j  # sum of c_j E_(j-1), j >= 1
+        direct = 0j  # sum of c_j E_j, j >= 1
+        scalar = coefficients[0]*current  # sum of c_j E_(j+1), j >= 0
+        for j in range(1, j_max+1):
+            following = _expn(j+1, s)
+            shifted += coefficients[j]*previous
+            direct += coefficients[j]*current
+            scalar += coefficients[j]*following
+            previous = current
+            current = following
+        decay = math.exp(-s)
+        local = decay/r2*(s + 1)*4/r2
+        phase = phases[i]
+        out[0, i] = phase*(4*x[i]*x[i]*E4*shifted - 2*E2*direct + x[i]*x[i]*local - 2*decay/r2)
+        out[1, i] = phase*(4*x[i]*y[i]*E4*shifted + x[i]*y[i]*r2*local)
+        out[2, i] = phase*(4*y[i]*y[i]*E4*shifted - 2*E2*direct + y[i]*y[i]*local - 2*decay/r2)
+        out[3, i] = -phase*scalar/(4*math.pi)
+
+
+def greenComponents(k, x, y):
+    """
+    G_xx, G_xy, G_yy of Interaction.green for separations (x, y) of any (matching) shape.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    R = np.hypot(x, y)
+    arg = k*R
+    h0 = sp.special.hankel1(0, arg)
+    h1 = sp.special.hankel1(1, arg)
+    if JIT and _getNumba() is not None:
+        out = np.empty((3, x.size), dtype=complex)
+        _greenLoop(complex(k), x.ravel(), y.ravel(), np.ravel(h0).astype(complex), np.ravel(h1).astype(complex), out)
+        return [precision.store(component.reshape(x.shape), "green") for component in out]
+
+    h2 = 2*h1/arg - h0
+    xx = 0.25j * k**2 * ((y**2/R**2) * h0 + (x**2 - y**2)/(k*R**3) * h1)
+    yy = 0.25j * k**2 * ((x**2/R**2) * h0 - (x**2 - y**2)/(k*R**3) * h1)
+    xy = 0.25j * k**2 * x*y/R**2 * h2
+    return [precision.store(component, "green") for component in (xx, xy, yy)]
+
+
+def ewaldRealSpace(k, E, j_max, x, y, phases):
+    """
+    Real space Ewald sums over points at separations (x, y) with Bloch phases.
+
+    Returns [xx, xy, yy, scalar]: the sums of Ewald.dyadicEwaldG2 (without the
+    1/(4 pi)) for each component, and of Ewald.ewaldG2, from one evaluation of
+    the exponential integrals per point, added pairwise.
+    """
+    x = np.ravel(np.asarray(x, dtype=float))
+    y = np.ravel(np.asarray(y, dtype=float))
+    phases = np.ravel(np.asarray(phases, dtype=complex))
+    if JIT and _getNumba() is not None:
+        out = np.empty((4, x.size), dtype=complex)
+        _ewaldLoop(complex(k), float(E), int(j_max), x, y, phases, out)
+        return reduction.pairwiseSum(out.T)
+
+    r2 = x**2 + y**2
+    s = r2*E**2
+    table = sp.special.expn(np.arange(j_max+2)[:, None], s[None, :])  # E_p(s), p = 0..j_max+1
+    coefficients = np.array([(k/(2*E))**(2*j)/math.factorial(j) for j in range(j_max+1)], dtype=complex)
+    shifted = np.dot(coefficients[1:], table[:j_max])  # sum_(j >= 1) c_j E_(j-1)
+    direct = np.dot(coefficients[1:], table[1:j_max+1])  # sum_(j >= 1) c_j E_j
+    scalar = np.dot(coefficients, table[1:])  # sum_(j >= 0) c_j E_(j+1)
+    decay = np.exp(-s)
+    local = decay/r2*(s + 1)*4/r2
+    xx = 4*x**2*E**4*shifted - 2*E**2*direct + x**2*local - 2*decay/r2
+    xy = 4*x*y*E**4*shifted + x*y*r2*local
+    yy = 4*y**2*E**4*shifted - 2*E**2*direct + y**2*local - 2*decay/r2
+    return reduction.pairwiseSum((phases*np.array([xx, xy, yy, -scalar/(4*np.pi)])).T)
+
+
+def verify(size=2000, rtol=1e-10, seed=0):
+    """
+    Check the compiled kernels against the NumPy path on random input.
+
+    Returns the largest relative differences {kernel: error}, and raises
+    AssertionError if any is above rtol. Does nothing without numba.
+    """
+    if _getNumba() is None:
+        return {}
+    rng = np.random.default_rng(seed)
+    k = (2.5 + 0.05j)*(1.602e-19*2*np.pi)/(6.626e-34*2.997e8)
+    x, y = rng.uniform(-2e-7, 2e-7, (2, size))
+    E = 2*np.pi/15e-9
+    phases = np.exp(2j*np.pi*rng.random(size))
+
+    x_grid = np.linspace(0.01, 40, size)
+    errors = {}
+    previous = JIT
+    try:
+        results = {}
+        for flag in (False, True):
+            useJit(flag)
+            results[flag] = (np.array(greenComponents(k, x, y)), ewaldRealSpace(k, E, 5, x, y, phases))
+        errors["greenComponents"] = np.abs(results[True][0] - results[False][0]).max()/np.abs(results[False][0]).max()
+        errors["ewaldRealSpace"] = np.abs(results[True][1] - results[False][1]).max()/np.abs(results[False][1]).max()
+        reference = sp.special.expn(np.arange(8)[:, None], x_grid[None, :])
+        compiled = np.array([[_expn(n, value) for value in x_grid] for n in range(8)])
+        errors["expn"] = np.abs(compiled/reference - 1).max()
+    finally:
+        useJit(previous)
+    for name, error in errors.items():
+        assert error <= rtol, "{} differs from the NumPy path by {}".format(name, error)
+    return errors
@@ -0,0 +1,217 @@
+#! python3
+
+"""
+Lattice sums cached in dimensionless form.
+
+With L = |a1| the lattice sums only depend on the geometry through k*L, q*L,
+E*L, pos/L and the shape a1/L, a2/L, and the dyadic sum scales as 1/L^2. The
+cache stores H*L^2 under those dimensionless keys, so a study over lattice
+spacing or scaling reuses sums whenever (k*L, q*L) coincide, and optionally
+interpolates in k*L between nearby cached values.
+
+Sums are cached per storage precision (precision.py), so sums stored in
+single precision are not served to double precision runs.
+
+Workers of the process and distributed backends fill copies of the cache.
+imap() saves the cache to a file once, and while it runs the cache pickles
+without its sums: each worker process loads the file the first time it meets
+the cache and keeps its copy between chunks. Tasks return the sums they
+added with their result, which imap() merges into the cache of this process,
+as profiling.imap does for the statistics. Workers on other hosts, which
+cannot read the file, start from an empty cache.
+"""
+
+import bisect
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
+import precision
+from plasmonic_lattice import ev
+
+
+class DimensionlessCache:
+    """
+    Store of dimensionless lattice sums H*L^2.
+
+    args:
+    - decimals: dimensionless keys are rounded to this many decimal places
+    - interpolate: interpolate linearly in k*L between cached values (real frequencies only)
+    - max_gap: largest gap in k*L which may be interpolated across
+    """
+    def __init__(self, decimals=10, interpolate=False, max_gap=1e-3):
+        self.decimals = decimals
+        self.interpolate = interpolate
+        self.max_gap = max_gap
+        self.sums = {}  # (geometry, q*L) -> {k*L: H*L^2}
+        self.hits = 0
+        self.misses = 0
+        self.added = None  # (key, k*L key, H*L^2) stored since startRecording(), None when not recording
+        self.shared = None  # file the sums were saved to by imap(), pickles carry its name instead of the sums
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.shared is not None:
+            state["sums"] = None  # the file has them, and the sweep may be adding to the dict meanwhile
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.sums is None:
+            self.sums = _loadShared(self.shared)
+
+    def _round(self, values):
+        return tuple(np.round(np.ravel(values), self.decimals))
+
+    def getKey(self, ewald, w):
+        """
+        Returns (key, k*L, L) for an Ewald sum at frequency w.
+        """
+        a1, a2 = ewald.lattice.getLatticeVectors()
+        L = np.linalg.norm(a1)
+        geometry = (type(ewald.lattice).__name__, precision.getPrecision(), ewald.lattice.neighbours, ewald.j_max,
+                    self._round(np.concatenate((a1, a2))/L), self._round(ewald.E*L), self._round(np.asarray(ewald.pos)/L))
+        kL = complex(w*ev*L)
+        return (geometry, self._round(np.asarray(ewald.q)*L)), kL, L
+
+    def _kKey(self, kL):
+        return (round(kL.real, self.decimals), round(kL.imag, self.decimals))
+
+    def lookup(self, ewald, w):
+        """
+        Cached H for an Ewald sum at w, rescaled to its lattice, or None.
+        """
+        key, kL, L = self.getKey(ewald, w)
+        table = self.sums.get(key)
+        if table is None:
+            return None
+        value = table.get(self._kKey(kL))
+        if value is None and self.interpolate and kL.imag == 0:
+            value = self._interpolate(table, kL.real)
+        if value is None:
+            return None
+        return value/L**2
+
+    def _interpolate(self, table, kL):
+        real = sorted(k for k, imag in table if imag == 0)
+        i = bisect.bisect_left(real, kL)
+        if i == 0 or i == len(real):
+            return None
+        k0, k1 = real[i-1], real[i]
+        if k1 - k0 > self.max_gap*max(abs(k1), 1e-300):
+            return None
+        t = (kL - k0)/(k1 - k0)
+        return (1 - t)*table[(k0, 0.)] + t*table[(k1, 0.)]
+
+    def store(self, ewald, w, H):
+        key, kL, L = self.getKey(ewald, w)
+        entry = (key, self._kKey(kL), np.array(H)*L**2)
+        self.merge([entry])
+        if self.added is not None:
+            self.added.append(entry)
+
+    def merge(self, entries, hits=0, misses=0):
+        """
+        Add (key, k*L key, H*L^2) entries, as returned by takeRecorded() in a worker.
+        """
+        for key, kL, value in entries:
+            self.sums.setdefault(key, {})[kL] = value
+        self.hits += hits
+        self.misses += misses
+
+    def startRecording(self):
+        self.added = []
+        self._counts = (self.hits, self.misses)
+
+    def takeRecorded(self):
+        """
+        Returns (entries, hits, misses) since startRecording(), and stops recording.
+        """
+        added, self.added = self.added, None
+        return added, self.hits - self._counts[0], self.misses - self._counts[1]
+
+    def interactionMatrix(self, ewald, w):
+        """
+        Return the dyadic sum of ewald at w, from the cache if possible.
+        """
+        H = self.lookup(ewald, w)
+        if H is not None:
+            self.hits += 1
+            return H
+        self.misses += 1
+        H = ewald.dyadicSumEwald(w)
+        self.store(ewald, w, H)
+        return H
+
+    def __len__(self):
+        return sum(len(table) for table in self.sums.values())
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self.sums, f)
+
+    def load(self, path):
+        """
+        Merge sums saved by another run (or worker) into this cache.
+        """
+        with open(path, "rb") as f:
+            for key, table in pickle.load(f).items():
+                self.sums.setdefault(key, {}).update(table)
+
+
+_shared = {}  # file -> sums, the copy of this worker process
+
+
+def _loadShared(path):
+    """
+    Sums saved by imap() to path, loaded once per process.
+    """
+    if path not in _shared:
+        _shared.clear()  # an earlier sweep's copy
+        sums = {}
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                sums = pickle.load(f)
+        _shared[path] = sums
+    return _shared[path]
+
+
+class _RecordingTask:
+    """
+    Picklable wrapper which returns (result, (entries, hits, misses)) of the task's copy of cache.
+
+    func and cache are pickled together, so func uses this copy of the cache.
+    """
+    def __init__(self, func, cache):
+        self.func = func
+        self.cache = cache
+
+    def __call__(self, *args):
+        self.cache.startRecording()
+        result = self.func(*args)
+        return result, self.cache.takeRecorded()
+
+
+def imap(mapper, func, iterable, cache=None, local=False):
+    """
+    Yield func over iterable using mapper (e.g. pool.imap), merging the sums tasks add in workers into cache.
+
+    Set local for mappers which run in this process (threads), which fill cache directly.
+    """
+    if cache is None or local:
+        for result in mapper(func, iterable):
+            yield result
+        return
+    handle, path = tempfile.mkstemp(prefix="lattice_cache_", suffix=".pkl")
+    os.close(handle)
+    cache.save(path)
+    cache.shared = path
+    try:
+        for result, recorded in mapper(_RecordingTask(func, cache), iterable):
+            cache.merge(*recorded)
+            yield result
+    finally:
+        cache.shared = None
+        os.remove(path)
@@ -0,0 +1,188 @@
+#! python3
+
+"""
+Lattice sums S_n(k, q) and the periodic Green's tensor from them.
+
+Near the origin the quasi periodic sum G_q(r) = sum_R H0(k|r - R|) exp(i q.R)
+is H0(k|r|) plus a regular part sum_n S_n J_n(k|r|) exp(i n arg r), valid for
+|r| below the shortest lattice vector. The S_n only depend on (k, q), so one
+set of sums gives the Green's function at every in-cell displacement by
+Graf's addition theorem, and the dyadic tensor follows from the Hessian of
+the expansion (fmm.besselHessian). A cell with s sites then needs one set of
+lattice sums instead of s^2 Ewald sums.
+
+The S_n are found with Ewald's method, all orders in one pass over the
+lattices. With beta = q + G (angle phi) and R (angle alpha), for n >= 0
+
+    spectral: -(4i/A) sum_G exp((k^2 - beta^2)/(4E^2))/(beta^2 - k^2) (i beta/k)^n exp(-i n phi)
+    spatial: -(i/pi) sum_(R != 0) exp(i q.R) (2 E^2 |R|/k)^n exp(-i n alpha) sum_j (k/2E)^(2j)/j! E_(j+1-n)(|R|^2 E^2)
+
+plus -1 - (i/pi) Ei(k^2/(4E^2)) for n = 0. Negative orders use exp(i|n| phi),
+exp(i|n| alpha) and a factor (-1)^|n|. The exponential integrals of negative
+order come from E_p(x) = (exp(-x) - p E_(p+1)(x))/x.
+
+Extinction, determinant_solver and Ewald use it with sums="lattice" (see
+plasmonic_lattice.getSums), which gives the full interaction matrix of
+multi-site cells such as Honeycomb.
+"""
+
+import numpy as np
+import scipy as sp
+from scipy import special
+
+from plasmonic_lattice import Interaction, ev
+from fmm import besselHessian
+
+KEPT = 64  # sets of sums kept, the most recent (w, q)
+
+
+class LatticeSums:
+    """
+    Lattice sums S_n for n = -order..order of a lattice at one (w, q).
+
+    args:
+    - cell: lattice (Square, Honeycomb...), its neighbours sets the extent of both sums
+    - order: largest |n|, by default enough for the site displacements of the cell to converge to about 1e-12
+    - ewald: Ewald splitting parameter, default sqrt(pi)/|a1| which keeps high orders accurate
+    - j_max: number of terms in the spatial series
+    """
+    def __init__(self, cell, order=None, ewald=None, j_max=20):
+        self.cell = cell
+        a1, a2 = [np.array(a, dtype=float) for a in cell.getLatticeVectors()]
+        self.E = np.sqrt(np.pi)/np.linalg.norm(a1) if ewald is None else ewald
+        self.j_max = j_max
+        self.area = abs(float(np.cross(a1, a2)))
+        R = np.array([[0, -1], [1, 0]])
+        b1 = 2*np.pi * np.dot(R, a2)/np.dot(a1, np.dot(R, a2))
+        b2 = 2*np.pi * np.dot(R, a1)/np.dot(a2, np.dot(R, a1))
+        number = np.arange(-cell.neighbours, cell.neighbours+1)
+        n, m = [index.ravel() for index in np.meshgrid(number, number, indexing='ij')]
+        self.reciprocal = n[:, None]*b1 + m[:, None]*b2
+        origin = (n == 0) & (m == 0)
+        self.bravais = n[~origin, None]*a1 + m[~origin, None]*a2
+        self.shortest = np.linalg.norm(self.bravais, axis=1).min()
+        self.order = self.getOrder() if order is None else order
+        self.sums = {}  # (w, q) -> S_n for n = -order..order, the last KEPT
+
+    def getOrder(self, tol=1e-12):
+        """
+        Order at which the expansion converges for every displacement in the cell.
+
+        Terms fall off like (|r|/shortest lattice vector)^n, and two extra orders are needed by the Hessian.
+        """
+        positions = np.array([particle.pos for particle in self.cell.getUnitCell()], dtype=float)
+        ratio = np.linalg.norm(positions[:, None] - positions[None, :], axis=-1).max()/self.shortest
+        if ratio == 0:
+            return 4
+        if ratio >= 1:
+            raise ValueError("site displacements reach the nearest lattice point, the expansion does not converge")
+        return max(4, int(np.ceil(np.log(tol)/np.log(ratio))) + 2)
+
+    def orders(self):
+        return np.arange(-self.order, self.order+1)
+
+    def _signedPowers(self, base, angle):
+        """
+        Array [points, n] of base^|n| exp(-i n angle) (-1)^|n| (n < 0), built by repeated multiplication.
+        """
+        powers = np.cumprod(np.concatenate((np.ones((len(base), 1), dtype=complex), np.repeat(base[:, None], self.order, axis=1)), axis=1), axis=1)
+        positive = powers*np.exp(-1j*np.arange(self.order+1)[None, :]*angle[:, None])
+        negative = (powers*(-1)**np.arange(self.order+1)[None, :]*np.exp(1j*np.arange(self.order+1)[None, :]*angle[:, None]))[:, :0:-1]
+        return np.concatenate((negative, positive), axis=1)
+
+    def spectral(self, w, q):
+        k = w*ev
+        beta = np.asarray(q, dtype=float) + self.reciprocal
+        beta_norm = np.linalg.norm(beta, axis=1)
+        weight = np.exp((k**2 - beta_norm**2)/(4*self.E**2))/(beta_norm**2 - k**2)
+        return -(4j/self.area)*np.dot(weight, self._signedPowers(1j*beta_norm/k, np.arctan2(beta[:, 1], beta[:, 0])))
+
+    def exponentialIntegrals(self, x):
+        """
+        Array [points, p] of E_p(x) for p = 1-order..j_max+1.
+        """
+        table = np.empty((len(x), self.order + self.j_max + 1))
+        p = np.arange(1, self.j_max+2)
+        table[:, self.order:] = sp.special.expn(p[None, :], x[:, None])
+        for i in range(self.order-1, -1, -1):  # p = i + 1 - order, from 0 down
+            p = i + 1 - self.order
+            table[:, i] = (np.exp(-x) - p*table[:, i+1])/x
+        return table
+
+    def spatial(self, w, q):
+        k = w*ev
+        R = np.linalg.norm(self.bravais, axis=1)
+        table = self.exponentialIntegrals(R**2*self.E**2)
+        series = np.zeros((len(R), self.order+1), dtype=complex)
+        n = np.arange(self.order+1)
+        for j in range(self.j_max+1):
+            series += (k/(2*self.E))**(2*j)/sp.special.factorial(j) * table[:, j + self.order - n]  # E_(j+1-n)
+        series = np.concatenate((series[:, :0:-1], series), axis=1)  # the series depends on |n|
+        phases = np.exp(1j*np.dot(self.bravais, q))
+        powers = self._signedPowers(2*self.E**2*R/k, np.arctan2(self.bravais[:, 1], self.bravais[:, 0]))
+        return -(1j/np.pi)*np.dot(phases, powers*series)
+
+    def getSums(self, w, q):
+        """
+        S_n for n = -order..order, computed once per (w, q).
+        """
+        key = (w, tuple(q))
+        sums = self.sums.get(key)
+        if sums is None:
+            k = w*ev
+            sums = self.spectral(w, q) + self.spatial(w, q)
+            sums[self.order] += -1 - (1j/np.pi)*sp.special.expi(k**2/(4*self.E**2))
+            if len(self.sums) >= KEPT:  # a sweep visits every (w, q) once, keep memory bounded
+                self.sums.pop(next(iter(self.sums)), None)
+            self.sums[key] = sums
+        return sums
+
+    def clear(self):
+        self.sums = {}
+
+    def regular(self, w, q, r):
+        """
+        Regular part sum_n S_n J_n(k|r|) exp(i n arg r) of the scalar sum G_q(r).
+        """
+        k = w*ev
+        r = np.asarray(r, dtype=float)
+        n = self.orders()
+        return np.sum(self.getSums(w, q)*sp.special.jv(n, k*np.hypot(*r))*np.exp(1j*n*np.arctan2(r[1], r[0])))
+
+    def monopolar(self, w, q, r):
+        """
+        (i/4) G_q(r), the sum of (i/4) H0(k|r - R|) exp(i q.R) over every R (R = 0 excluded if r = 0).
+        """
+        k = w*ev
+        singular = sp.special.hankel1(0, k*np.hypot(*r)) if np.any(r) else 0
+        return 0.25j*(singular + self.regular(w, q, r))
+
+    def dyadic(self, w, q, r):
+        """
+        Periodic dyadic Green's tensor sum_R G(r - R) exp(i q.R) with G as in Interaction.green.
+
+        The R = 0 term is left out when r = 0. Accurate while |r| is well below the shortest lattice vector.
+        """
+        k = w*ev
+        r = np.asarray(r, dtype=float)
+        n = self.orders()
+        basis = sp.special.jv(n, k*np.hypot(*r))*np.exp(1j*n*np.arctan2(r[1], r[0]))
+        sums = self.getSums(w, q)
+        xx, xy, yy = [np.sum(coefficients*basis) for coefficients in besselHessian(sums, k)]
+        scalar = np.sum(sums*basis)
+        G = 0.25j*np.array([[k**2*scalar + xx, xy], [xy, k**2*scalar + yy]])
+        if np.any(r):
+            G = G + Interaction(None, self.cell).green(w, r)
+        return G
+
+    def interactionMatrix(self, w, q):
+        """
+        Interaction matrix of the cell, as Interaction.interactionMatrix, from one set of lattice sums.
+        """
+        positions = [particle.pos for particle in self.cell.getUnitCell()]
+        size = len(positions)
+        H = np.zeros((2*size, 2*size), dtype=complex)
+        for i in range(size):
+            for j in range(size):
+                H[2*i:2*i+2, 2*j:2*j+2] = self.dyadic(w, q, positions[i] - positions[j])
+        return H
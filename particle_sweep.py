@@ -0,0 +1,110 @@
+#! python3
+
+"""
+Particle parameter sweeps which reuse the lattice sums.
+
+The interaction matrix H(w, q) only depends on the lattice geometry, the
+particle radius, plasma frequency and loss enter through 1/alpha on the
+diagonal. As this is a multiple of the identity, the eigenvalues of H are
+computed once per (w, q) and shifted in bulk for every parameter set.
+"""
+
+import numpy as np
+import scipy as sp
+from scipy import linalg
+
+import precision
+import profiling
+from plasmonic_lattice import Particle, Ewald, ev
+
+
+class ParticleSweep:
+    """
+    Extinction and determinants for many particle parameter sets on one lattice.
+
+    args:
+    - cell: lattice providing the geometry (Square, Honeycomb...)
+    - radius: particle radii
+    - wp: plasma frequencies (eV)
+    - loss: losses (eV)
+
+    radius, wp and loss are broadcast against each other, each entry of the
+    result is one parameter set.
+    """
+    def __init__(self, cell, radius, wp, loss, ewald=None, j_max=5, cache=None):
+        self.cell = cell
+        self.radius, self.wp, self.loss = np.broadcast_arrays(np.asarray(radius, dtype=float), np.asarray(wp, dtype=float), np.asarray(loss, dtype=float))
+        self.particles = Particle(self.radius.ravel(), self.wp.ravel(), self.loss.ravel())
+        if ewald is None:
+            ewald = 2*np.pi/cell.getSpacing()
+        self.E = ewald
+        self.j_max = j_max
+        self.cache = cache  # optional lattice_cache.DimensionlessCache
+        self.eigenvalue_cache = {}
+
+    def getShape(self):
+        """
+        Shape of the parameter sets.
+        """
+        return self.radius.shape
+
+    def interactionMatrix(self, w, q):
+        """
+        Interaction matrix H(w, q) without the 1/alpha term, as used by Extinction.
+        """
+        return Ewald(self.E, self.j_max, q, self.cell, np.array([0, 0]), cache=self.cache).interactionMatrix(w)
+
+    def eigenvalues(self, w, q):
+        """
+        Eigenvalues of H(w, q), computed once and cached.
+
+        H(w, -q) = H(w, q)^T has the same eigenvalues, so -q is taken from the cache too.
+        """
+        key = (w, tuple(q))
+        reversed_key = (w, tuple(-np.asarray(q)))
+        if key not in self.eigenvalue_cache and reversed_key in self.eigenvalue_cache:
+            key = reversed_key
+        if profiling.enabled:
+            profiling.recordCache("ParticleSweep.eigenvalues", key in self.eigenvalue_cache)
+        if key not in self.eigenvalue_cache:
+            self.eigenvalue_cache[key] = sp.linalg.eigvals(self.interactionMatrix(w, q))
+        return self.eigenvalue_cache[key]
+
+    def shiftedEigenvalues(self, w, q):
+        """
+        Eigenvalues of H - 1/alpha for every parameter set, shape (sets, cell_size*2).
+        """
+        inverse_alpha = 1/self.particles.getPolarisability(w)
+        return self.eigenvalues(w, q)[np.newaxis, :] - inverse_alpha[:, np.newaxis]
+
+    def calcExtinction(self, w, q):
+        """
+        Find the extinction at a particular (w, q) for every parameter set.
+        """
+        k = w*ev
+        result = 4*np.pi*k*np.sum(1/precision.widen(self.shiftedEigenvalues(w, q)), axis=1).imag
+        return result.reshape(self.getShape())
+
+    def determinant(self, w, q):
+        """
+        det(H - 1/alpha) at a particular (w, q) for every parameter set.
+        """
+        return np.prod(self.shiftedEigenvalues(w, q), axis=1).reshape(self.getShape())
+
+    def loopExtinction(self, wrange, qrange):
+        """
+        Extinction over a grid of (w, q) for every parameter set.
+
+        Returns an array of shape (parameter sets..., len(wrange), len(qrange)).
+        """
+        results = np.empty(self.getShape() + (len(wrange), len(qrange)), dtype=precision.getReal())
+        for i, w in enumerate(wrange):
+            for j, q in enumerate(qrange):
+                results[..., i, j] = self.calcExtinction(w, q)
+        return results
+
+    def clear(self):
+        """
+        Drop the cached eigenvalues.
+        """
+        self.eigenvalue_cache = {}
@@ -1,45 +1,130 @@
 #! /usr/bin/python3
 
 '''
-Quick script to generate .csv files of real and imaginary permittivities for COMSOL.
+Export tables of permittivity for COMSOL and other solvers.
+
+The model (dielectric.py) is evaluated over the frequency grid in chunks and
+every chunk is written as soon as it is computed, so the size of the table
+is not limited by memory. Real and imaginary parts come from the same
+evaluation: as two csv files of (frequency, value), COMSOL's layout, as one
+csv file of (frequency, real, imag), or as a binary .npy array of
+(frequency, real, imag) rows written through a memory map.
+
+Run as a script it writes perms_real.csv and perms_imag.csv for a Drude metal.
 '''
 
+import argparse
+import sys
+
 import numpy as np
-from matplotlib import pyplot as plt
-import csv
 
-# define frequencies in eV
-min_freq = 1
-max_freq = 5 
+from dielectric import Drude, HZ_PER_EV
+
+CHUNK = 2**16  # frequencies per chunk
+
+ELEC_VOLT = HZ_PER_EV  # eV conversion to Hz
+
+
+def gridSize(min_freq, max_freq, step):
+    """
+    Number of points of np.arange(min_freq, max_freq, step).
+    """
+    return max(0, int(np.ceil((max_freq - min_freq)/step)))
+
+
+def frequencyChunks(min_freq, max_freq, step, chunk=CHUNK):
+    """
+    Yield the frequencies of np.arange(min_freq, max_freq, step) in arrays of at most chunk points.
+    """
+    number = gridSize(min_freq, max_freq, step)
+    for start in range(0, number, chunk):
+        yield min_freq + step*np.arange(start, min(start + chunk, number))
+
+
+def _rows(columns, fmt):
+    """
+    Text of csv rows, formatted in one operation.
+    """
+    table = np.column_stack(columns)
+    row = ",".join([fmt]*table.shape[1]) + "\n"
+    return (row*len(table)) % tuple(table.ravel())
+
+
+def exportCsv(model, chunks, real_path, imag_path=None, frequency_scale=ELEC_VOLT, fmt="%.12g"):
+    """
+    Write the permittivity of model at every frequency in chunks (eV) to csv.
+
+    args:
+    - model: dielectric model, its evaluate() is used so the chunks are not memoised
+    - chunks: iterable of frequency arrays, e.g. frequencyChunks(...)
+    - real_path, imag_path: files of (frequency, Re eps) and (frequency, Im eps), or with imag_path None one file of (frequency, Re eps, Im eps)
+    - frequency_scale: factor converting eV to the frequency unit written (Hz by default)
+    - fmt: printf format of each number
+
+    Returns the number of rows written.
+    """
+    count = 0
+    real_file = open(real_path, "w")
+    imag_file = None if imag_path is None else open(imag_path, "w")
+    try:
+        for w in chunks:
+            permittivity = model.evaluate(np.asarray(w, dtype=complex))
+            frequency = np.asarray(w, dtype=float)*frequency_scale
+            if imag_file is None:
+                real_file.write(_rows((frequency, permittivity.real, permittivity.imag), fmt))
+            else:
+                real_file.write(_rows((frequency, permittivity.real), fmt))
+                imag_file.write(_rows((frequency, permittivity.imag), fmt))
+            count += len(frequency)
+    finally:
+        real_file.close()
+        if imag_file is not None:
+            imag_file.close()
+    return count
 
-plasma_freq = 3.5
-gamma = 0.01
 
-step = 0.05
+def exportNpy(model, min_freq, max_freq, step, path, frequency_scale=ELEC_VOLT, chunk=CHUNK):
+    """
+    Write an .npy array of rows (frequency, Re eps, Im eps) for np.arange(min_freq, max_freq, step).
 
-ELEC_VOLT = 1.6*10**-19/(6.63*10**-34)  # eV conversion to Hz
+    The file is filled chunk by chunk through a memory map. Returns the number of rows.
+    """
+    from numpy.lib.format import open_memmap
 
-fig, ax = plt.subplots(2)
+    number = gridSize(min_freq, max_freq, step)
+    table = open_memmap(path, mode="w+", dtype=float, shape=(number, 3))
+    start = 0
+    for w in frequencyChunks(min_freq, max_freq, step, chunk):
+        permittivity = model.evaluate(w.astype(complex))
+        rows = table[start:start + len(w)]
+        rows[:, 0] = w*frequency_scale
+        rows[:, 1] = permittivity.real
+        rows[:, 2] = permittivity.imag
+        start += len(w)
+    table.flush()
+    del table
+    return number
 
-perm_re = []
-perm_im = []
-for w in np.arange(min_freq, max_freq, step):
-	perm_re.append([w*ELEC_VOLT, (1- plasma_freq**2/(w**2 - 1j*gamma*w)).real])
-	perm_im.append([w*ELEC_VOLT, (1- plasma_freq**2/(w**2 - 1j*gamma*w)).imag])
-# ax[0].scatter(np.arange(min_freq, max_freq, step), [i.real for i in permittivity],c='b')
-# ax[1].scatter(np.arange(min_freq, max_freq, step), [i.imag for i in permittivity],c='r')
 
-# ax[0].set_title("re")
-# ax[1].set_title("im")
-# plt.show()
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export Drude permittivity tables.")
+    parser.add_argument("--min", type=float, default=1, help="lowest frequency (eV)")
+    parser.add_argument("--max", type=float, default=5, help="highest frequency (eV), not included")
+    parser.add_argument("--step", type=float, default=0.05, help="frequency step (eV)")
+    parser.add_argument("--plasma", type=float, default=3.5, help="plasma frequency (eV)")
+    parser.add_argument("--gamma", type=float, default=0.01, help="loss (eV)")
+    parser.add_argument("--real", default="perms_real.csv", help="output of the real part, or of the whole table")
+    parser.add_argument("--imag", default="perms_imag.csv", help="output of the imaginary part, empty to write one file")
+    parser.add_argument("--npy", action="store_true", help="write one binary .npy table to --real instead of csv")
+    args = parser.parse_args(argv)
 
-with open("perms_real.csv", "w") as output:
-    writer = csv.writer(output, lineterminator='\n')
-    for val in perm_re:
-        writer.writerow([val[0],val[1]])    
+    model = Drude(args.plasma, args.gamma)
+    if args.npy:
+        exportNpy(model, args.min, args.max, args.step, args.real)
+    else:
+        exportCsv(model, frequencyChunks(args.min, args.max, args.step), args.real, args.imag or None)
+    return 0
 
 
-with open("perms_imag.csv", "w") as output:
-    writer = csv.writer(output, lineterminator='\n')
-    for val in perm_im:
-        writer.writerow([val[0],val[1]])
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,42 +3,73 @@
 import numpy as np
 import scipy as sp
 from scipy import special  # used for hankel functions
-from scipy import optimize
-from matplotlib import pyplot as plt
-from multiprocessing import Pool
+import functools
 import itertools
+import os
+import sys
+import time
+
+import autotune
+import backends
+import dielectric
+import kernels
+import plotting
+import precision
+import profiling
+import reduction
+from bloch import latticeBloch
+from symmetry import isInversionSymmetric, timeReversalMap
+from progress import Progress, Timed
+
+global ev
+ev = (1.602*10**-19 * 2 * np.pi)/(6.626*10**-34 * 2.997*10**8)  # k-> w conversion
+global c
+c = 2.997*10**8  # speed of light
 
 
 class Particle:
     """
     Particle class.
 
-    Each particle has a position, radius, plasma frequency and loss.
+    Each particle has a position, radius, plasma frequency and loss, and
+    optionally a dielectric model (dielectric.py) which replaces the Drude
+    permittivity given by the plasma frequency and loss. Without one, the
+    Drude model of the plasma frequency and loss is shared with the other
+    particles which have the same ones.
     """
-    def __init__(self, radius, wp, loss, x_pos=0, y_pos=0):
+    def __init__(self, radius, wp, loss, x_pos=0, y_pos=0, model=None):
         self.pos = np.array([x_pos, y_pos])
         self.radius = radius
         self.plasma = wp
         self.loss = loss
+        self.model = model
+        self.drude = None  # dielectric.getDrude(wp, loss), looked up on first use
+
+    def setModel(self, model):
+        """
+        Use a dielectric model (Drude, Tabulated...) for the permittivity, or None for the Drude default.
+        """
+        self.model = model
 
     def getPermittivity(self, w):
         """
         Return permittivity for a particle.
 
         args:
-        - w: frequency (eV)
+        - w: frequency (eV), scalar or array
         """
-        return 1 - (self.plasma**2)/(w**2 - 1j*self.loss*w)
+        if self.model is not None:
+            return self.model.permittivity(w)
+        if getattr(self, "drude", None) is None:
+            self.drude = dielectric.getDrude(self.plasma, self.loss)
+        return self.drude.permittivity(w)
 
     def getPolarisability(self, w):
         """
         Return the polarisability for a particle.
 
         """
-        k = w * ev
-        permittivity = self.getPermittivity(w)
-        eps = (permittivity-1)/(permittivity+1)
-        return (2*np.pi*self.radius**2 * eps)/(1 - 0.25j*np.pi*(k*self.radius)**2 * eps)
+        return dielectric.polarisability(w, self.getPermittivity(w), self.radius, ev)
 
 
 class Square(Particle): # TODO: update names of getBravais...
@@ -105,6 +136,12 @@ class Square(Particle): # TODO: update names of getBravais...
                 lattice_points.append(i*t1 + j*t2)
         return np.array(lattice_points)
 
+    def getLatticeMask(self, n, m, origin):
+        """
+        Which indices (n, m) with |n|, |m| <= neighbours are in getLattice, for tiled sums.
+        """
+        return ((n != 0) | (m != 0)) | (origin is True)
+
     def getBrillouinZone(self, size):
         """
         Generate set of reciprocal lattice points from
@@ -114,15 +151,15 @@ class Square(Particle): # TODO: update names of getBravais...
         - size: number of points to create
         """
 
-        Gamma_X_x = np.linspace(0, np.pi/self.spacing, size/3,
+        Gamma_X_x = np.linspace(0, np.pi/self.spacing, int(size/3),
                                 endpoint=False)
         Gamma_X_y = np.zeros(int(size/3))
 
         X_M_x = np.ones(int(size/3))*np.pi/self.spacing
-        X_M_y = np.linspace(0, np.pi/self.spacing, size/3, endpoint=False)
+        X_M_y = np.linspace(0, np.pi/self.spacing, int(size/3), endpoint=False)
 
-        M_Gamma_x = np.linspace(np.pi/self.spacing, 0, size/3, endpoint=True)
-        M_Gamma_y = np.linspace(np.pi/self.spacing, 0, size/3, endpoint=True)
+        M_Gamma_x = np.linspace(np.pi/self.spacing, 0, int(size/3), endpoint=True)
+        M_Gamma_y = np.linspace(np.pi/self.spacing, 0, int(size/3), endpoint=True)
 
         q_x = np.concatenate((Gamma_X_x, X_M_x, M_Gamma_x))
         q_y = np.concatenate((Gamma_X_y, X_M_y, M_Gamma_y))
@@ -214,11 +251,16 @@ class SimpleHoneycomb(Particle):  # TODO: update names of getBravais...
             particle_list.append(Particle(self.radius, self.wp, self.loss, x, y))
         return particle_list
 
+    def getLatticeVectors(self):
+        t1 = np.array([self.scaling*1.5*self.spacing, self.scaling*self.spacing*np.sqrt(3)/2])
+        t2 = np.array([self.scaling*1.5*self.spacing, -self.scaling*self.spacing*np.sqrt(3)/2])
+
+        return t1, t2
+
     def getLattice(self, _type='bravais', origin='false'):
         neighbour_list = []
         number = self.neighbours
-        t1 = np.array([self.scaling*1.5*self.spacing, self.scaling*self.spacing*np.sqrt(3)/2])
-        t2 = np.array([self.scaling*1.5*self.spacing, -self.scaling*self.spacing*np.sqrt(3)/2])
+        t1, t2 = self.getLatticeVectors()
 
         for n,m in itertools.product(np.arange(-number, number+1), repeat=2):
             neighbour_list.append(n*t1 + m*t2)
@@ -310,6 +352,12 @@ class Honeycomb(Particle):
 
         return np.array(points)
 
+    def getLatticeMask(self, n, m, origin):
+        """
+        Which indices (n, m) with |n|, |m| <= neighbours are in getLattice, for tiled sums.
+        """
+        return np.abs(n + m) <= self.neighbours
+
     def getBrillouinZone(self, size):
         """
         Create set of (x,y) coordinates for path in reciprocal space.
@@ -317,11 +365,11 @@ class Honeycomb(Particle):
         From K to Gamma to M.
         """
         b = 3* self.spacing * self.scaling
-        K_Gamma_x = np.linspace((4*np.pi)/(3*b), 0, size/2, endpoint=False)
+        K_Gamma_x = np.linspace((4*np.pi)/(3*b), 0, int(size/2), endpoint=False)
         K_Gamma_y = np.zeros(int(size/2))
 
         Gamma_M_x = np.zeros(int(size/2))
-        Gamma_M_y = np.linspace(0, (2*np.pi)/(np.sqrt(3)*b), size/2, endpoint=True)
+        Gamma_M_y = np.linspace(0, (2*np.pi)/(np.sqrt(3)*b), int(size/2), endpoint=True)
 
         q_x = np.concatenate((K_Gamma_x, Gamma_M_x))
         q_y = np.concatenate((K_Gamma_y, Gamma_M_y))
@@ -331,27 +379,73 @@ class Honeycomb(Particle):
     def getCellSize(self):
         return 6
 
+    def getSpacing(self):
+        return self.spacing
+
+
+def getSums(sums, cell):
+    """
+    Source of the interaction matrices H(w, q) of cell for Ewald, or None for the Ewald sums themselves.
+
+    args:
+    - sums: None or "ewald" for the Ewald sums, "interpolate" for a
+      fourier_interpolation.EwaldFourierInterpolator, "lattice" for lattice_sums.LatticeSums (one set of
+      sums for all the sites of a cell, the full 2s x 2s matrix of an s site cell), or an object with
+      interactionMatrix(w, q)
+    """
+    if sums is None or sums == "ewald":
+        return None
+    if hasattr(sums, "interactionMatrix"):
+        return sums
+    if sums == "interpolate":
+        from fourier_interpolation import EwaldFourierInterpolator
+
+        return EwaldFourierInterpolator(cell)
+    if sums == "lattice":
+        from lattice_sums import LatticeSums
+
+        return LatticeSums(cell)
+    raise ValueError("unknown sums {}, use 'ewald', 'interpolate', 'lattice' or an object with interactionMatrix(w, q)".format(sums))
+
 
 class Extinction:
-    def __init__(self, cell, resolution, wmin, wmax):
+    def __init__(self, cell, resolution, wmin, wmax, cache=None, sums=None):
+        """
+        args:
+        - cache: optional lattice_cache.DimensionlessCache shared between lattices of different spacing
+        - sums: how H(w, q) is found, see getSums. With "interpolate" each frequency is fitted once
+          per worker (and chunk of tasks on the process backend) and shared by its q points.
+        """
         self.cell = cell
+        self.cache = cache
+        self.sums = getSums(sums, cell)
         self.wmin = wmin
         self.wmax = wmax
         self.resolution = resolution
         self.wrange = np.linspace(wmin, wmax, self.resolution, endpoint=True)
         self.qrange = cell.getBrillouinZone(self.resolution)
+        self.bloch = latticeBloch(cell)  # shared so phases update incrementally along qrange
+        self.schedule = None  # autotune.Schedule of the last sweep run with backend="tune"
 
     def calcExtinction(self, w, q):
         """
         Find the extinction at a particular (w, q).
         """
-        print(w)
         k = w*ev
-        H_matrix = Ewald(2*np.pi/self.cell.getSpacing(), 5, q, self.cell, np.array([0, 0])).interactionMatrix(w)
+        H_matrix = Ewald(2*np.pi/self.cell.getSpacing(), 5, q, self.cell, np.array([0, 0]), self.bloch, self.cache, self.sums).interactionMatrix(w)
         for i in range(len(H_matrix[0])):
             H_matrix[i][i] = H_matrix[i][i] - 1/self.cell.getPolarisability(w)
 
-        return 4*np.pi*k*(sum(1/sp.linalg.eigvals(H_matrix)).imag)
+        eigenvalues = self.eigenvalues(H_matrix)
+        if precision.isReduced():  # 1/alpha nearly cancels H at a resonance
+            precision.record("eigenvalues", precision.getEpsilon()*np.linalg.norm(H_matrix)/np.min(np.abs(eigenvalues)), len(eigenvalues))
+        return 4*np.pi*k*(sum(1/precision.widen(eigenvalues)).imag)
+
+    def eigenvalues(self, H_matrix):
+        """
+        Eigenvalues of the eigenproblem, kept separate so the solve can be profiled.
+        """
+        return sp.linalg.eigvals(H_matrix)
 
     def _calcExtinction(self, args):
         """
@@ -359,17 +453,58 @@ class Extinction:
         """
         return self.calcExtinction(*args)
 
-    def loopExtinction(self):
+    def loopExtinction(self, show_progress=True, log=None, backend=None):
         """
-        Method for quickly looping over (w, q) using multiprocessing.
+        Method for quickly looping over (w, q) in parallel.
 
         Calculates the extinction at each (w, q) using calcExtinction() then returns a linear list of extinction values.
+
+        args:
+        - show_progress: report completed points, throughput and ETA on stderr
+        - log: path of a JSON lines file recording the time taken by every point
+        - backend: "process", "thread", "serial", a backend from backends.py, None to choose from the number of points,
+          or "tune" to choose the backend, workers, chunk size and tile size from timing the first points (autotune.py)
         """
         results = []
-        wq_vals = [(w, q) for w in self.wrange for q in self.qrange]
-        pool = Pool()
-
-        results.append(pool.map(self._calcExtinction, wq_vals))
+        independent, source, _ = timeReversalMap(self.qrange)  # extinction is the same at q and -q
+        wq_vals = [(w, self.qrange[i]) for w in self.wrange for i in independent]
+        progress = Progress(len(wq_vals), log=log, stream=sys.stderr if show_progress else None)
+        values = []
+        if backend == "tune":
+            self.schedule = autotune.calibrate(self._calcExtinction, wq_vals, points=(2*self.cell.neighbours + 1)**2)
+            for value, elapsed in zip(self.schedule.values, self.schedule.times):
+                progress.update(elapsed, wq_vals[len(values)])
+                values.append(value)
+            pool = self.schedule.getBackend()
+            chunksize = self.schedule.chunksize
+        else:
+            pool = backends.getBackend(backend, len(wq_vals))
+            chunksize = max(1, len(wq_vals)//(4*(os.cpu_count() or 1)))
+
+        local = getattr(pool, "local", False)
+        mapper = functools.partial(pool.imap, chunksize=chunksize)
+        if self.cache is not None:  # workers fill copies of the cache, merge their sums back
+            import lattice_cache
+
+            mapper = functools.partial(lattice_cache.imap, mapper, cache=self.cache, local=local)
+        try:
+            for value, elapsed in profiling.imap(mapper, Timed(self._calcExtinction), wq_vals[len(values):], local):
+                progress.update(elapsed, wq_vals[len(values)])
+                values.append(value)
+        except BaseException:  # a failed task or Ctrl-C, stop the workers started here
+            if pool is not backend:
+                pool.terminate()
+            raise
+        if pool is not backend:
+            pool.close()
+        results.append(precision.store([values[i*len(independent) + j] for i in range(len(self.wrange)) for j in source], "extinction"))
+        if backend == "tune":
+            self.schedule.record(time.perf_counter() - progress.start)
+            if show_progress:
+                sys.stderr.write("\n" + self.schedule.describe())
+        progress.finish()
+        if profiling.enabled:
+            profiling.report()
         return results
 
     def plotExtinction(self):
@@ -378,20 +513,24 @@ class Extinction:
 
         Takes linear list of extinction values from loopExtinction(), reshapes into (size * size) array and plots using imshow().
         """
-        light_line = [(np.linalg.norm(qval)/ev) for q, qval in enumerate(self.qrange)]
-        plt.plot(light_line, 'r--', zorder=1, alpha=0.5)
-
         raw_results = self.loopExtinction()
-        reshaped_results = np.array(raw_results).reshape((self.resolution, self.resolution))
-        plt.imshow(reshaped_results, origin='lower', extent=[0, self.resolution-1, self.wmin, self.wmax], aspect='auto', cmap='viridis', zorder=0)
-
-        plt.show()
+        plotting.plotExtinction(raw_results, self.qrange, self.resolution, self.wmin, self.wmax, ev)
 
 
 class Interaction:
-    def __init__(self, q, cell):
+    def __init__(self, q, cell, bloch=None):
         self.q = q
         self.cell = cell
+        self.bloch = bloch
+
+    def getBravaisPhases(self, points, indices=None):
+        """
+        Bloch phases exp(i q.R) for Bravais points, from the factorised table.
+        """
+        if self.bloch is None:
+            self.bloch = latticeBloch(self.cell)
+        self.bloch.setQ(self.q)
+        return self.bloch.phases(points, indices, self.q)
 
     def green(self, w, distance):
         """
@@ -401,48 +540,64 @@ class Interaction:
         by a vector distance at a frequency k. For a 2D Green's function, the
         interactions are modelled with Hankel functions.
 
-        Returns a matrix of the form [[G_xx, G_xy],[G_xy, G_yy]]
+        Returns a matrix of the form [[G_xx, G_xy],[G_xy, G_yy]]. distance may
+        also be an array of shape (2, ...), giving a result of shape (2, 2, ...).
+        The components are formed together by kernels.greenComponents.
         """
         k = w*ev
-        x = distance[0]
-        y = distance[1]
-        R = np.linalg.norm(distance)
-        arg = k*R
+        xx_type, xy_type, yy_type = kernels.greenComponents(k, distance[0], distance[1])
 
-        xx_type = 0.25j * k**2 * ((y**2/R**2) * sp.special.hankel1(0,arg) + (x**2 - y**2)/(k*R**3) * sp.special.hankel1(1, arg))
+        return np.array([[xx_type, xy_type], [xy_type, yy_type]])
 
-        yy_type = 0.25j * k**2 * ((x**2/R**2) * sp.special.hankel1(0,arg) - (x**2 - y**2)/(k*R**3) * sp.special.hankel1(1, arg))
+    def latticeSum(self, w, offset, conjugate=False):
+        """
+        Sum of green(offset + R) exp(i q.R) over the Bravais lattice, leaving out offset + R = 0.
 
-        xy_type = 0.25j * k**2 * x*y/R**2 * sp.special.hankel1(2,arg)
+        The lattice is reduced in tiles (see reduction.py). With conjugate the
+        sum with exp(-i q.R) is returned too, from the same Green's functions.
+        """
+        offset = np.asarray(offset, dtype=float)
 
-        return np.array([[xx_type, xy_type], [xy_type, yy_type]])
+        def terms(points, indices):
+            distance = offset + points
+            keep = (distance[:, 0] != 0) | (distance[:, 1] != 0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                greens = np.where(keep, self.green(w, distance.T), 0)  # (2, 2, P)
+            phases = self.getBravaisPhases(points, indices)
+            if conjugate:
+                return np.moveaxis(np.array([greens*phases, greens*np.conj(phases)]), -1, 0)
+            return np.moveaxis(greens*phases, -1, 0)
+
+        return reduction.latticeReduce(self.cell, 'bravais', False, terms, width=8 if conjugate else 4)
 
     def interactionMatrix(self, w):
         intracell = self.cell.getUnitCell()
-        intercell = self.cell.getLattice('bravais', False)
         cell_size = self.cell.getCellSize()
         indices = np.arange(cell_size)
 
         matrix_size = cell_size*2
 
         if cell_size == 1:  # No interactions within the cell, only with other cells
-            H = sum([self.green(w, inter) * np.exp(1j * np.dot(self.q, inter)) for inter in intercell])
+            H = precision.store(self.latticeSum(w, (0, 0)), "interaction matrix")
 
         else:  # Interactions within and with other cells
-            H = np.zeros((matrix_size, matrix_size), dtype=np.complex_)
+            H = np.zeros((matrix_size, matrix_size), dtype=precision.getComplex())
+            reciprocal = reduction.isLatticeSymmetric(self.cell)
 
             for n, m in itertools.combinations(indices, 2):
                 # Loop over (n, m) = (0, 1), (0, 2)... (1, 2), (1, 3)... (2, 3), (2, 4)...
                 # More efficient than considering repeated interactions.
-                H[2*n:2*n+2, 2*m:2*m+2] = sum([self.green(w, -intracell[n].pos + intracell[m].pos + inter) * np.exp(1j * np.dot(self.q, inter)) for inter in intercell])
-                H[2*m:2*m+2, 2*n:2*n+2] = sum([self.green(w, -intracell[m].pos + intracell[n].pos + inter) * np.exp(1j * np.dot(self.q, inter)) for inter in intercell])
-
+                if reciprocal:
+                    # G is even and the lattice symmetric under R -> -R, so the (m, n) block
+                    # is the same sum with conjugate phases and reuses the Green's functions.
+                    H[2*n:2*n+2, 2*m:2*m+2], H[2*m:2*m+2, 2*n:2*n+2] = self.latticeSum(w, -intracell[n].pos + intracell[m].pos, conjugate=True)
+                else:
+                    H[2*n:2*n+2, 2*m:2*m+2] = self.latticeSum(w, -intracell[n].pos + intracell[m].pos)
+                    H[2*m:2*m+2, 2*n:2*n+2] = self.latticeSum(w, -intracell[m].pos + intracell[n].pos)
+
+            self_block = self.latticeSum(w, (0, 0))  # the same for every particle in the cell, (0,0) position ignored
             for n in indices:
-                to_sum = []
-                for inter in intercell:
-                    if np.linalg.norm(inter) != 0:  # ignore (0,0) position
-                        to_sum.append(self.green(w, inter) * np.exp(1j * np.dot(self.q, inter)))
-                H[2*n:2*n+2, 2*n:2*n+2] = sum(to_sum)
+                H[2*n:2*n+2, 2*n:2*n+2] = self_block
 
         return H
 
@@ -450,29 +605,48 @@ class Interaction:
         return self.interactionMatrix(w) - np.identity(self.cell.getCellSize()*2)/self.cell.getPolarisability(w)
 
     def determinant(self, w):
-        print(w)
         w_val = w[0] + 1j*w[1]
         result = np.linalg.det(self.eigenproblem(w_val))
         return [result.real, result.imag]
 
 
 class Ewald:
-    def __init__(self, ewald, j_max, q, lattice, position):
+    def __init__(self, ewald, j_max, q, lattice, position, bloch=None, cache=None, sums=None):
+        """
+        args:
+        - sums: optional source of interactionMatrix(w, q) used instead of the Ewald sums (and the cache), see getSums
+        """
         self.q = q
         self.lattice = lattice
         self.pos = position
         self.E = ewald
         self.j_max = j_max
+        self.bloch = bloch
+        self.cache = cache
+        self.sums = sums
+        self.memo = {}  # (method, args) -> value of the memoized methods, freed with the instance
+
+    def getBravaisPhases(self, points, indices=None):
+        """
+        Bloch phases exp(i q.R) for Bravais points, from the factorised table.
+        """
+        if self.bloch is None:
+            self.bloch = latticeBloch(self.lattice)
+        self.bloch.setQ(self.q)
+        return self.bloch.phases(points, indices, self.q)
 
     def ewaldG1(self, w):
         k = w*ev
         a1, a2 = self.lattice.getLatticeVectors()
 
         area = float(np.cross(a1, a2))
-        _sum = 0
-        for G_pos in self.lattice.getLattice('reciprocal', True):
-            _sum += -(1./area) * (np.exp(1j*np.dot(self.q+G_pos, self.pos)) * np.exp((k**2 - np.linalg.norm(self.q+G_pos)**2)/(4*self.E**2)))/( np.linalg.norm(self.q+G_pos)**2 - k**2)
-        return _sum
+
+        def terms(G_pos, indices):
+            beta = self.q + G_pos
+            beta_norm = np.linalg.norm(beta, axis=1)
+            return precision.store(-(1./area) * (np.exp(1j*np.dot(beta, self.pos)) * np.exp((k**2 - beta_norm**2)/(4*self.E**2)))/(beta_norm**2 - k**2), "ewald terms")
+
+        return reduction.latticeReduce(self.lattice, 'reciprocal', True, terms)
 
     def integralFunc(self, separation, w):
         k = w*ev
@@ -482,11 +656,11 @@ class Ewald:
         return _sum
 
     def ewaldG2(self, w):
-        _sum = 0
-        for R_pos in self.lattice.getLattice('bravais', True):
-            distance = np.linalg.norm(self.pos - R_pos)
-            _sum += -(1./(4*np.pi)) * np.exp(1j * np.dot(self.q, R_pos)) * self.integralFunc(distance, w)
-        return _sum
+        def terms(R_pos, indices):
+            distance = np.linalg.norm(self.pos - R_pos, axis=1)
+            return precision.store(-(1./(4*np.pi)) * self.getBravaisPhases(R_pos, indices) * self.integralFunc(distance, w), "ewald terms")
+
+        return reduction.latticeReduce(self.lattice, 'bravais', True, terms)
 
     def monopolarSum(self, w):
         return self.ewaldG1(w) + self.ewaldG2(w)
@@ -495,52 +669,28 @@ class Ewald:
         k = w*ev
         a1, a2 = self.lattice.getLatticeVectors()
         area = float(np.cross(a1, a2))
-        _sum = 0
-        if _type is "xx":
-            for G_pos in self.lattice.getLattice('reciprocal', True):
-                beta = self.q + G_pos
-                beta_norm = np.linalg.norm(beta)
 
-                _sum += (k**2 + beta[0]**2) * (1./area) * (np.exp(1j*np.dot(beta, self.pos)) * np.exp((k**2 - beta_norm**2)/(4*self.E**2)))/(beta_norm**2 - k**2)
-        elif _type is "xy":
-            for G_pos in self.lattice.getLattice('reciprocal', True):
-                beta = self.q + G_pos
-                beta_norm = np.linalg.norm(beta)
+        def terms(G_pos, indices):
+            beta = self.q + G_pos
+            beta_norm = np.linalg.norm(beta, axis=1)
+            if _type == "xx":
+                factor = k**2 + beta[:, 0]**2
+            elif _type == "xy":
+                factor = beta[:, 0]*beta[:, 1]
+            elif _type == "yy":
+                factor = k**2 + beta[:, 1]**2
+            return precision.store(factor * (1./area) * (np.exp(1j*np.dot(beta, self.pos)) * np.exp((k**2 - beta_norm**2)/(4*self.E**2)))/(beta_norm**2 - k**2), "ewald terms")
 
-                _sum += (beta[0]*beta[1]) * (1./area) * (np.exp(1j*np.dot(beta, self.pos)) * np.exp((k**2 - beta_norm**2)/(4*self.E**2)))/(beta_norm**2 - k**2)
-        elif _type is "yy":
-            for G_pos in self.lattice.getLattice('reciprocal', True):
-                beta = self.q + G_pos
-                beta_norm = np.linalg.norm(beta)
-                _sum += (k**2 + beta[1]**2) * (1./area) * (np.exp(1j*np.dot(beta, self.pos)) * np.exp((k**2 - beta_norm**2)/(4*self.E**2)))/(beta_norm**2 - k**2)
-        return _sum
+        return reduction.latticeReduce(self.lattice, 'reciprocal', True, terms)
 
     def dyadicEwaldG2(self, w, _type):
-        k = w*ev
-        _sum = 0
-        if _type is "xx":
-            for R_pos in self.lattice.getLattice('bravais', True):
-                rho = self.pos - R_pos
-                rho_norm =  np.linalg.norm(rho)
-                _sum += (np.exp(1j * np.dot(self.q, R_pos))) * (self.dyadicIntegralFunc(w, rho, _type) + (np.exp(-rho_norm**2*self.E**2)/rho_norm**2)*(((4*rho[0]**2)/rho_norm**2)*(rho_norm**2*self.E**2 + 1) - 2))
-
-        elif _type is "xy":
-            for R_pos in self.lattice.getLattice('bravais', True):
-                rho = self.pos - R_pos
-                rho_norm =  np.linalg.norm(rho)
-                _sum += np.exp(1j * np.dot(self.q, R_pos)) * (self.dyadicIntegralFunc(w, rho, _type) + (np.exp(-rho_norm**2*self.E**2) * (4*rho[0]*rho[1]/rho_norm**2)*(rho_norm**2*self.E**2 + 1)))
-
-        elif _type is "yy":
-            for R_pos in self.lattice.getLattice('bravais', True):
-                rho = self.pos - R_pos
-                rho_norm =  np.linalg.norm(rho)
-                _sum += (np.exp(1j * np.dot(self.q, R_pos))) * (self.dyadicIntegralFunc(w, rho, _type) + (np.exp(-rho_norm**2*self.E**2)/rho_norm**2)*(((4*rho[1]**2)/rho_norm**2)*(rho_norm**2*self.E**2 + 1) - 2))
-        return _sum/(4*np.pi)
+        xx, xy, yy, _ = self.realSpaceSums(w)
+        return {"xx": xx, "xy": xy, "yy": yy}[_type]/(4*np.pi)
 
     def dyadicIntegralFunc(self, w, rho, _type):
         k = w*ev
         _sum = 0
-        rho_norm = np.linalg.norm(rho)
+        rho_norm = np.hypot(rho[0], rho[1])  # rho may be a vector or an array of shape (2, ...)
         if _type is "xx":
             for j in range(1, self.j_max+1):
                 _sum += ((1./np.math.factorial(j)) * (k/(2*self.E))**(2*j)) * (4*rho[0]**2*self.E**4*sp.special.expn(j-1, rho_norm**2*self.E**2) - 2*self.E**2*sp.special.expn(j, rho_norm**2*self.E**2))
@@ -555,16 +705,35 @@ class Ewald:
 
         return _sum
 
-    def memoize(f):  # speed up recurrence relation below by caching previous results
-        cache = {}
-        def decorated_function(*args):
-            if args in cache:
-                return cache[args]
+    def memoize(f):  # speed up recurrence relation below by caching previous results, per instance
+        name = "Ewald." + f.__name__
+        def decorated_function(self, *args):
+            cache = self.memo
+            key = (name,) + args
+            if key in cache:
+                if profiling.enabled:
+                    profiling.recordCache(name, True)
+                return cache[key]
             else:
-                cache[args] = f(*args)
-                return cache[args]
-        return decorated_function 
+                if profiling.enabled:
+                    profiling.recordCache(name, False)
+                cache[key] = f(self, *args)
+                return cache[key]
+        return decorated_function
+
+
+    @memoize
+    def realSpaceSums(self, w):
+        """
+        Real space sums [xx, xy, yy, scalar] of dyadicEwaldG2 (times 4 pi) and ewaldG2 in one pass (kernels.ewaldRealSpace).
+        """
+        k = w*ev
 
+        def terms(R_pos, indices):
+            rho = self.pos - R_pos
+            return kernels.ewaldRealSpace(k, self.E, self.j_max, rho[:, 0], rho[:, 1], self.getBravaisPhases(R_pos, indices))
+
+        return reduction.latticeReduce(self.lattice, 'bravais', True, terms, width=4, reduced=True)
 
     # terms for sums excluding lattice: t0, t1_lim, t2_lim
     def t0(self, w):  # NB: only non zero for n != 0
@@ -574,23 +743,18 @@ class Ewald:
     @memoize
     def t1_lim(self, w, n):
         k = w*ev
-        _sum = 0
-        prev_sum = 0
         a1, a2 = self.lattice.getLatticeVectors()
         area = float(np.cross(a1, a2))
-        
-        for G_pos in self.lattice.getLattice('reciprocal', True):
+        m = abs(n)  # n < 0 is the conjugate of n > 0, below
+
+        def terms(G_pos, indices):
             beta = self.q + G_pos
-            beta_norm = np.linalg.norm(beta)
+            beta_norm = np.linalg.norm(beta, axis=1)
             #phi = np.angle(beta[0] + 1j*beta[1])
-            phi = np.arctan2(beta[1], beta[0])
-
-            if n > 0 or n == 0:
-                _sum += (4*1j**(n+1))/area * 1/(k**2-beta_norm**2) * np.exp((k**2 - beta_norm**2)/(4*self.E**2)) * (beta_norm/k)**n * np.exp(-1j*n*phi)
-            elif n < 0:
-                m = abs(n)
-                _sum += (4*1j**(m+1))/area * 1/(k**2-beta_norm**2) * np.exp((k**2 - beta_norm**2)/(4*self.E**2)) * (beta_norm/k)**m * np.exp(-1j*m*phi)
+            phi = np.arctan2(beta[:, 1], beta[:, 0])
+            return precision.store((4*1j**(m+1))/area * 1/(k**2-beta_norm**2) * np.exp((k**2 - beta_norm**2)/(4*self.E**2)) * (beta_norm/k)**m * np.exp(-1j*m*phi), "ewald terms")
 
+        _sum = reduction.latticeReduce(self.lattice, 'reciprocal', True, terms)
         if n < 0:
             _sum = -np.conjugate(_sum)
         return _sum
@@ -598,18 +762,18 @@ class Ewald:
     @memoize
     def t2_lim(self, w, n):
         k = w*ev
-        _sum = 0
-        for R_pos in self.lattice.getLattice('bravais', False):  # sum excluding origin
-            R_norm = np.linalg.norm(R_pos)
-            #alpha = np.angle(R_pos[0] + 1j*R_pos[1])
-            alpha = np.arctan2(R_pos[1], R_pos[0])
+        m = abs(n)
+
+        def terms(R_pos, indices):  # sum excluding origin
+            phase = self.getBravaisPhases(R_pos, indices)
+            R_norm = np.linalg.norm(R_pos, axis=1)
             if n == 0:
-                _sum += (-2j/np.pi)*np.exp(1j*np.dot(self.q, R_pos))*self.t2_I_0(R_norm, w)
-            elif n > 0:
-                _sum +=-(2**(n+1))*(1j/np.pi) * np.exp(1j*np.dot(self.q, R_pos)) * np.exp(-1j*n*alpha) * ((R_norm/k)**n) * self.t2_I_2(R_norm, w)
-            elif n < 0:
-                m = abs(n)
-                _sum +=-(2**(m+1))*(1j/np.pi) * np.exp(1j*np.dot(self.q, R_pos))*np.exp(-1j*m*alpha)*(R_norm/k)**m*self.t2_I_2(R_norm, w)
+                return precision.store((-2j/np.pi)*phase*self.t2_I_0(R_norm, w), "ewald terms")
+            #alpha = np.angle(R_pos[0] + 1j*R_pos[1])
+            alpha = np.arctan2(R_pos[:, 1], R_pos[:, 0])
+            return precision.store(-(2**(m+1))*(1j/np.pi) * phase * np.exp(-1j*m*alpha) * ((R_norm/k)**m) * self.t2_I_2(R_norm, w), "ewald terms")
+
+        _sum = reduction.latticeReduce(self.lattice, 'bravais', False, terms)
         if n < 0:
             _sum = -np.conjugate(_sum)
         return _sum
@@ -638,72 +802,127 @@ class Ewald:
             h_0 = (self.t0(w) + self.t1_lim(w, 0) + self.t2_lim(w, 0))
             #h_neg2 = (self.t1_lim(w, -2) + self.t2_lim(w, -2))  # H_2
             h_pos2 = (self.t1_lim(w, 2) + self.t2_lim(w, 2))  # H_(-2)
-            h_neg2 = -np.conjugate(h_pos2)
-          
-            xx_comp = -k**2 * (+(1j/8)*h_0 + (1j/16)*(h_neg2+h_pos2))
-            xy_comp = -k**2 * (+(1/16)*(h_neg2-h_pos2))
-            yy_comp = -k**2 * (+(1j/8)*h_0 - (1j/16)*(h_neg2+h_pos2))
+            return self.dyadicFromLatticeSums(w, h_0, h_pos2)
         else:
-            xx_comp = (self.dyadicEwaldG1(w, "xx") + self.dyadicEwaldG2(w, "xx") + k**2*self.ewaldG2(w))
+            scalar = self.realSpaceSums(w)[3]  # ewaldG2, from the same pass as dyadicEwaldG2
+            xx_comp = (self.dyadicEwaldG1(w, "xx") + self.dyadicEwaldG2(w, "xx") + k**2*scalar)
             xy_comp = (self.dyadicEwaldG1(w, "xy") + self.dyadicEwaldG2(w, "xy"))
-            yy_comp = (self.dyadicEwaldG1(w, "yy") + self.dyadicEwaldG2(w, "yy") + k**2*self.ewaldG2(w))
+            yy_comp = (self.dyadicEwaldG1(w, "yy") + self.dyadicEwaldG2(w, "yy") + k**2*scalar)
+        return np.array([[xx_comp, xy_comp],[xy_comp, yy_comp]])
+
+    def dyadicFromLatticeSums(self, w, h_0, h_pos2):
+        """
+        Dyadic sum at the origin from the lattice sums H_0 and H_(-2).
+        """
+        k = w*ev
+        h_neg2 = -np.conjugate(h_pos2)
+
+        xx_comp = -k**2 * (+(1j/8)*h_0 + (1j/16)*(h_neg2+h_pos2))
+        xy_comp = -k**2 * (+(1/16)*(h_neg2-h_pos2))
+        yy_comp = -k**2 * (+(1j/8)*h_0 - (1j/16)*(h_neg2+h_pos2))
         return np.array([[xx_comp, xy_comp],[xy_comp, yy_comp]])
 
 
     def interactionMatrix(self, w):
         #if cell_size == 1:  # No interactions within the cell, only with other cells
-        H = self.dyadicSumEwald(w)
+        if self.sums is not None:
+            return precision.store(self.sums.interactionMatrix(w, self.q), "interaction matrix")
+        if self.cache is not None:
+            return self.cache.interactionMatrix(self, w)
+        H = precision.store(self.dyadicSumEwald(w), "interaction matrix")
         return H
 
     def eigenproblem(self, w):
         return self.interactionMatrix(w) - np.identity(self.lattice.getCellSize()*2)/self.lattice.getPolarisability(w)
 
     def determinant(self, w):
-        print(w)
         w_val = w[0] + 1j*w[1]
         result = np.linalg.det(self.eigenproblem(w_val))
         return [result.real, result.imag]
 
 
-def determinant_solver(w, cell, resolution):
+def determinant_solver(w, cell, resolution, progress=None, cache=None, sums=None):
+    """
+    Find a complex root of det(H - 1/alpha) at each q along the Brillouin zone path.
+
+    args:
+    - w: initial guess [Re(w), Im(w)]
+    - progress: optional Progress updated after each q
+    - cache: optional lattice_cache.DimensionlessCache
+    - sums: how H(w, q) is found, see getSums. "interpolate" fits every frequency the root search tries, which
+      only pays off for many q points
+    """
+    from scipy import optimize  # only root finding needs it
+
     roots = []
-    for q in cell.getBrillouinZone(resolution):
+    sums = getSums(sums, cell)
+    bloch = latticeBloch(cell)
+    qrange = cell.getBrillouinZone(resolution)
+    independent, source, _ = timeReversalMap(qrange)  # det(H(-q) - 1/alpha) = det(H(q) - 1/alpha)
+    for q in qrange[independent]:
+        start = time.perf_counter()
         #array_int = Interaction(q, cell)
-        array_int = Ewald(2*np.pi/cell.getSpacing(), 20, q, cell, np.array([0, 0]))
-        ans = sp.optimize.root(array_int.determinant, w, method="lm").x
+        array_int = Ewald(2*np.pi/cell.getSpacing(), 20, q, cell, np.array([0, 0]), bloch, cache, sums)
+        with precision.using("double"):  # finite difference Jacobians need double precision
+            ans = sp.optimize.root(array_int.determinant, w, method="lm").x
         roots.append(ans)
-        print(ans)
-    return roots
+        if progress is not None:
+            progress.update(time.perf_counter() - start, q)
+    return [roots[i] for i in source]
 
 
 def _determinant_solver(args):
     return determinant_solver(*args)
 
 
-def dirtyRootFinder(wmin, wmax, guesses, cell, resolution):
+def dirtyRootFinder(wmin, wmax, guesses, cell, resolution, show_progress=True, log=None, backend=None, sums=None):
+    """
+    Roots along the Brillouin zone path from guesses initial frequencies between wmin and wmax, one task per guess.
+
+    args:
+    - backend: "process", "thread", "serial", a backend from backends.py, None to choose from the number of guesses,
+      or "tune" to choose from timing the first guesses (autotune.py)
+    - sums: how H(w, q) is found, see getSums
+    """
     wrange = np.linspace(wmin, wmax, guesses)
     results = []
-    values = [([w, 0], cell, resolution) for w in wrange]
-    pool = Pool()
-    results.append(pool.map(_determinant_solver, values))
-    pool.close()
-    fig, ax = plt.subplots(2)
-    ax[0].plot(np.arange(resolution),[(np.linalg.norm(qval)/ev) for q, qval in enumerate(cell.getBrillouinZone(resolution))], c='k', alpha=0.5)  # light line
-
-    for i in range(guesses):
-        ax[0].scatter(np.arange(resolution), [max(results[0][i][j]) for j in range(resolution)], c='r', s=1)
-        ax[1].scatter(np.arange(resolution), [min(results[0][i][j]) for j in range(resolution)], c='b', s=1)
-    plt.show()
+    values = [([w, 0], cell, resolution, None, None, sums) for w in wrange]
+    progress = Progress(len(values), log=log, stream=sys.stderr if show_progress else None)
+    roots = []
+    chunksize = 1
+    if backend == "tune":
+        schedule = autotune.calibrate(_determinant_solver, values, points=(2*cell.neighbours + 1)**2)
+        for value, elapsed in zip(schedule.values, schedule.times):
+            progress.update(elapsed, wrange[len(roots)])
+            roots.append(value)
+        pool = schedule.getBackend()
+        chunksize = schedule.chunksize
+    else:
+        pool = backends.getBackend(backend, len(values))
+    try:
+        for value, elapsed in profiling.imap(functools.partial(pool.imap, chunksize=chunksize), Timed(_determinant_solver), values[len(roots):], getattr(pool, "local", False)):
+            progress.update(elapsed, wrange[len(roots)])
+            roots.append(value)
+    except BaseException:  # a failed task or Ctrl-C, stop the workers started here
+        if pool is not backend:
+            pool.terminate()
+        raise
+    if pool is not backend:
+        pool.close()
+    results.append(roots)
+    if backend == "tune":
+        schedule.record(time.perf_counter() - progress.start)
+        if show_progress:
+            sys.stderr.write("\n" + schedule.describe())
+    progress.finish()
+    if profiling.enabled:
+        profiling.report()
+    plotting.plotRoots(results[0], cell.getBrillouinZone(resolution), ev)
 
     return(results[0])
 
 
 if __name__ == "__main__":
-    global ev
-    ev = (1.602*10**-19 * 2 * np.pi)/(6.626*10**-34 * 2.997*10**8)  # k-> w conversion
-    global c
-    c = 2.997*10**8  # speed of light
-
     lattice_spacing = 15.*10**-9  # lattice spacing
     particle_radius = 5.*10**-9  # particle radius
     plasma_freq = 3.5  # plasma frequency
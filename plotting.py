@@ -0,0 +1,55 @@
+#! python3
+
+"""
+Plots of extinction and band structure results.
+
+The numerical modules never import matplotlib, so worker processes start
+without it. pyplot is only imported here, on the first call of a plotting
+function.
+"""
+
+import numpy as np
+
+
+def getPyplot():
+    """
+    matplotlib.pyplot, imported on first use.
+    """
+    from matplotlib import pyplot
+    return pyplot
+
+
+def lightLine(qrange, ev):
+    """
+    Frequency (eV) of the light line |q| along a path of q points.
+    """
+    return [np.linalg.norm(qval)/ev for qval in qrange]
+
+
+def plotExtinction(results, qrange, resolution, wmin, wmax, ev, show=True):
+    """
+    Extinction map from the linear list of Extinction.loopExtinction, with the light line.
+    """
+    plt = getPyplot()
+    plt.plot(lightLine(qrange, ev), 'r--', zorder=1, alpha=0.5)
+    reshaped_results = np.array(results).reshape((resolution, resolution))
+    plt.imshow(reshaped_results, origin='lower', extent=[0, resolution-1, wmin, wmax], aspect='auto', cmap='viridis', zorder=0)
+    if show:
+        plt.show()
+
+
+def plotRoots(results, qrange, ev, show=True):
+    """
+    Real (top) and imaginary (bottom) parts of the roots of dirtyRootFinder along the Brillouin zone path.
+    """
+    plt = getPyplot()
+    resolution = len(qrange)
+    fig, ax = plt.subplots(2)
+    ax[0].plot(np.arange(resolution), lightLine(qrange, ev), c='k', alpha=0.5)  # light line
+
+    for roots in results:
+        ax[0].scatter(np.arange(resolution), [max(roots[j]) for j in range(resolution)], c='r', s=1)
+        ax[1].scatter(np.arange(resolution), [min(roots[j]) for j in range(resolution)], c='b', s=1)
+    if show:
+        plt.show()
+    return fig, ax
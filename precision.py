@@ -0,0 +1,179 @@
+#! python3
+
+"""
+Precision of stored arrays: double (default) or single for quick looks.
+
+With setPrecision("single") the Bloch phases, Green's function and Ewald
+terms of each tile, the interaction matrices, the Toeplitz kernels of finite
+arrays and the extinction results are stored as complex64/float32, which
+halves their memory and the traffic through the sums and eigen solves.
+Scalar special functions (Hankel, exponential integrals) are still evaluated
+in double and rounded once when stored.
+
+Accumulation stays in double precision: reduction.pairwiseSum adds single
+precision terms with a float64 accumulator, tile totals go into the
+compensated sum, and sums of eigenvalues are widened first. The error is
+then the rounding of each stored value, about 6e-8 relative, and does not
+grow with the number of lattice points.
+
+Arrays whose magnitude is outside the single precision range (some Ewald
+terms are below 1e-38) are kept in double. Root finding always runs in
+double (see using()), as the finite difference Jacobians of the root finders
+are below single precision resolution, and FiniteArray.solve raises its GMRES
+tolerance to 100 times the unit roundoff.
+
+The loss is estimated while running. store() measures the relative rounding
+error of every array it stores on a sample of its values, and callers record
+bounds for quantities where rounding is amplified: for the eigenvalues of
+H - 1/alpha it is eps*|H|/|lambda|, as 1/alpha nearly cancels H at a
+resonance. report() lists the largest loss per kind of array.
+
+Set the precision before starting a sweep: worker processes inherit it when
+they are forked, and the losses they record stay in the workers.
+setPrecision() sets the default of every thread, using() the precision of the
+calling thread only, so root finding on the thread backend does not change
+the precision of the other tasks.
+"""
+
+import contextlib
+import sys
+import threading
+
+import numpy as np
+
+PRECISIONS = {"double": (np.complex128, np.float64), "single": (np.complex64, np.float32)}
+SAMPLE = 256  # values of a stored array checked for rounding error
+
+precision = "double"  # default of threads outside using()
+
+_local = threading.local()  # precision of the calling thread inside using()
+_losses = {}  # name -> {"arrays": n, "values": n, "loss": largest relative error}
+
+
+def _check(name):
+    if name not in PRECISIONS:
+        raise ValueError("unknown precision {}, use one of {}".format(name, sorted(PRECISIONS)))
+
+
+def setPrecision(name):
+    """
+    Store later arrays in "double" or "single" precision, in every thread outside using().
+    """
+    global precision
+    _check(name)
+    precision = name
+
+
+def getPrecision():
+    """
+    Storage precision of the calling thread.
+    """
+    return getattr(_local, "precision", precision)
+
+
+@contextlib.contextmanager
+def using(name):
+    """
+    Context in which the calling thread stores arrays in precision name, restored afterwards.
+    """
+    _check(name)
+    previous = getattr(_local, "precision", None)
+    _local.precision = name
+    try:
+        yield
+    finally:
+        if previous is None:
+            del _local.precision
+        else:
+            _local.precision = previous
+
+
+def isReduced():
+    return getPrecision() != "double"
+
+
+def getComplex():
+    """
+    Complex dtype of stored arrays.
+    """
+    return PRECISIONS[getPrecision()][0]
+
+
+def getReal():
+    """
+    Real dtype of stored arrays.
+    """
+    return PRECISIONS[getPrecision()][1]
+
+
+def getEpsilon():
+    """
+    Unit roundoff of the stored arrays.
+    """
+    return float(np.finfo(getReal()).eps)/2
+
+
+def widen(array):
+    """
+    array with at least double precision, for accumulating.
+    """
+    array = np.asarray(array)
+    return array.astype(np.promote_types(array.dtype, np.float64), copy=False)
+
+
+def store(array, name="array"):
+    """
+    array in the storage precision. In single precision its rounding error is recorded under name.
+    """
+    if not isReduced():
+        return array
+    array = np.asarray(array)
+    if array.size == 0:
+        return array.astype(getComplex() if np.iscomplexobj(array) else getReal())
+    with np.errstate(invalid='ignore'):
+        scale = np.nanmax(np.abs(array))
+    info = np.finfo(getReal())
+    if not info.tiny/info.eps < scale < info.max*info.eps:  # would underflow or overflow
+        record(name + " (kept double)", 0., array.size)
+        return array
+    stored = array.astype(getComplex() if np.iscomplexobj(array) else getReal())
+    sample = slice(None, None, max(1, array.size//SAMPLE))
+    with np.errstate(invalid='ignore'):
+        record(name, np.nanmax(np.abs(stored.ravel()[sample] - array.ravel()[sample]))/scale, array.size)
+    return stored
+
+
+def record(name, loss, values=1):
+    """
+    Record an estimated relative error of a quantity.
+    """
+    stat = _losses.setdefault(name, {"arrays": 0, "values": 0, "loss": 0.})
+    stat["arrays"] += 1
+    stat["values"] += values
+    if np.isfinite(loss):
+        stat["loss"] = max(stat["loss"], float(loss))
+
+
+def getLosses():
+    """
+    Recorded losses, name -> {"arrays", "values", "loss"}.
+    """
+    return {name: dict(stat) for name, stat in _losses.items()}
+
+
+def reset():
+    _losses.clear()
+
+
+def report(stream=None):
+    """
+    Print the largest estimated relative error of every kind of array.
+    """
+    stream = sys.stdout if stream is None else stream
+    stream.write("precision: {} (unit roundoff {:.1e})\n".format(getPrecision(), getEpsilon()))
+    if not _losses:
+        return
+    stream.write("{:<24}{:>10}{:>14}{:>14}{:>8}\n".format("array", "arrays", "values", "loss", "digits"))
+    for name, stat in sorted(_losses.items(), key=lambda item: -item[1]["loss"]):
+        digits = -np.log10(stat["loss"]) if stat["loss"] > 0 else np.inf
+        stream.write("{:<24}{:>10}{:>14}{:>14.2e}{:>8.1f}\n".format(name, stat["arrays"], stat["values"], stat["loss"], digits))
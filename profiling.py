@@ -0,0 +1,211 @@
+#! python3
+
+"""
+Opt-in profiling of the Ewald pipeline.
+
+enable() wraps the terms of plasmonic_lattice.Ewald, the lattice generators
+and the eigen solve in Extinction to record call counts, time, lattice points
+visited (from getLattice or the tiles of reduction.py) and cache hits per
+term. disable() puts the original methods back, so there is no overhead
+unless profiling is switched on.
+
+Statistics are per process. Work sent to a pool through imap() is run with
+profiling enabled in the worker and the statistics are merged back into the
+parent, so report() at the end of a sweep covers every worker.
+"""
+
+import functools
+import sys
+import threading
+import time
+
+enabled = False
+
+_stats = {}
+_originals = []
+_local = threading.local()
+
+# (module, class, methods timed, methods whose lattice points are counted)
+TERMS = [
+    ("plasmonic_lattice", "Ewald", ["ewaldG1", "ewaldG2", "integralFunc", "dyadicEwaldG1", "dyadicEwaldG2", "dyadicIntegralFunc", "t0", "t1_lim", "t2_lim", "t2IntegralFunc", "realSpaceSums", "dyadicSumEwald", "determinant"], []),
+    ("plasmonic_lattice", "Interaction", ["green", "interactionMatrix", "determinant"], []),
+    ("plasmonic_lattice", "Extinction", ["calcExtinction", "eigenvalues"], []),
+    ("plasmonic_lattice", "Square", [], ["getLattice", "getNeighbours"]),
+    ("plasmonic_lattice", "Triangle", [], ["getLattice"]),
+    ("plasmonic_lattice", "SimpleHoneycomb", [], ["getLattice"]),
+    ("plasmonic_lattice", "Honeycomb", [], ["getLattice"]),
+]
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _stat(name):
+    if name not in _stats:
+        _stats[name] = {"calls": 0, "time": 0., "self_time": 0., "points": 0, "hits": 0, "misses": 0}
+    return _stats[name]
+
+
+def _wrap(name, method, count_points=False):
+    """
+    Wrap a method to record its calls and time under name.
+
+    If count_points is True the length of the returned lattice is added to the
+    points visited by the term which called it.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        stack = _stack()
+        frame = [name, 0.]  # name, time spent in profiled children
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            stat = _stat(name)
+            stat["calls"] += 1
+            stat["time"] += elapsed
+            stat["self_time"] += elapsed - frame[1]
+            if stack:
+                stack[-1][1] += elapsed
+        if count_points and stack:
+            _stat(stack[-1][0])["points"] += len(result)
+        return result
+    return wrapper
+
+
+def recordCache(name, hit):
+    """
+    Record a cache lookup for name. Callers should check enabled first.
+    """
+    stat = _stat(name)
+    if hit:
+        stat["hits"] += 1
+    else:
+        stat["misses"] += 1
+
+
+def recordPoints(number):
+    """
+    Add lattice points visited without getLattice (see reduction.py) to the running term.
+    """
+    stack = _stack()
+    if stack:
+        _stat(stack[-1][0])["points"] += number
+
+
+def enable():
+    """
+    Switch profiling on by wrapping the methods listed in TERMS.
+    """
+    global enabled
+    if enabled:
+        return
+    for module_name, class_name, timed, counted in TERMS:
+        module = sys.modules.get(module_name) or __import__(module_name)
+        cls = getattr(module, class_name)
+        for method_name in timed + counted:
+            method = cls.__dict__.get(method_name)
+            if method is None:
+                continue
+            _originals.append((cls, method_name, method))
+            setattr(cls, method_name, _wrap("{}.{}".format(class_name, method_name), method, method_name in counted))
+    enabled = True
+
+
+def disable():
+    """
+    Switch profiling off, restoring the original methods. Statistics are kept.
+    """
+    global enabled
+    while _originals:
+        cls, method_name, method = _originals.pop()
+        setattr(cls, method_name, method)
+    enabled = False
+
+
+def reset():
+    _stats.clear()
+
+
+def getStats():
+    return {name: dict(stat) for name, stat in _stats.items()}
+
+
+def drain():
+    """
+    Return the statistics and reset them.
+    """
+    stats = getStats()
+    reset()
+    return stats
+
+
+def merge(stats):
+    """
+    Add statistics from another process.
+    """
+    for name, stat in stats.items():
+        total = _stat(name)
+        for key, value in stat.items():
+            total[key] += value
+
+
+class _ProfiledTask:
+    """
+    Picklable wrapper which runs a task with profiling on and returns (result, statistics).
+    """
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args):
+        enable()
+        reset()
+        result = self.func(*args)
+        return result, drain()
+
+
+def imap(mapper, func, iterable, local=False):
+    """
+    Yield func over iterable using mapper (e.g. pool.imap or pool.map).
+
+    With profiling enabled each task records its statistics in the worker and
+    they are merged into this process as results arrive. Set local for
+    mappers which run in this process (threads), whose statistics are
+    recorded here directly.
+    """
+    if not enabled or local:
+        for result in mapper(func, iterable):
+            yield result
+        return
+    for result, stats in mapper(_ProfiledTask(func), iterable):
+        merge(stats)
+        yield result
+
+
+def summary():
+    """
+    Table of the statistics, sorted by time spent in each term itself.
+    """
+    lines = ["{:<34} {:>9} {:>10} {:>10} {:>6} {:>11} {:>9}".format("term", "calls", "total (s)", "self (s)", "self%", "points", "cache hit")]
+    total_self = sum(stat["self_time"] for stat in _stats.values()) or 1.
+    for name, stat in sorted(_stats.items(), key=lambda item: -item[1]["self_time"]):
+        lookups = stat["hits"] + stat["misses"]
+        hit_rate = "{:.1f}%".format(100.*stat["hits"]/lookups) if lookups else "-"
+        lines.append("{:<34} {:>9} {:>10.4f} {:>10.4f} {:>6.1f} {:>11} {:>9}".format(
+            name, stat["calls"], stat["time"], stat["self_time"], 100*stat["self_time"]/total_self, stat["points"], hit_rate))
+    return "\n".join(lines)
+
+
+def report(stream=None):
+    """
+    Print the summary, by default to stderr.
+    """
+    if stream is None:
+        stream = sys.stderr
+    stream.write(summary() + "\n")
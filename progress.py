@@ -0,0 +1,120 @@
+#! python3
+
+"""
+Progress and throughput reporting for sweeps.
+
+Workers time each point with Timed and the process driving the sweep feeds
+the timings to Progress, which shows completed points, points per second,
+ETA and the slowest points, and can write every point to a JSON lines log.
+"""
+
+import heapq
+import json
+import sys
+import time
+
+import numpy as np
+
+
+class Timed:
+    """
+    Picklable wrapper which returns (result, seconds taken) for a task.
+    """
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args):
+        start = time.perf_counter()
+        result = self.func(*args)
+        return result, time.perf_counter() - start
+
+
+def _jsonable(value):
+    if isinstance(value, (np.ndarray, list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, (complex, np.complexfloating)):
+        return [value.real, value.imag]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class Progress:
+    """
+    Collects per point timings from a sweep.
+
+    args:
+    - total: number of points in the sweep
+    - stream: where the status line is written (stderr by default), None for silent
+    - log: path of a JSON lines file recording every point, or None
+    - interval: minimum seconds between status line updates
+    - slowest: number of slowest points to keep
+    """
+    def __init__(self, total, stream=sys.stderr, log=None, interval=1.0, slowest=5):
+        self.total = total
+        self.stream = stream
+        self.interval = interval
+        self.completed = 0
+        self.busy_time = 0.
+        self.start = time.perf_counter()
+        self.last_shown = 0.
+        self.slowest = slowest
+        self.slowest_points = []  # heap of (elapsed, index, point)
+        self.log = open(log, "a") if log is not None else None
+
+    def getRate(self):
+        """
+        Points per second of wall time since the sweep started.
+        """
+        elapsed = time.perf_counter() - self.start
+        return self.completed/elapsed if elapsed > 0 else 0.
+
+    def getETA(self):
+        rate = self.getRate()
+        if rate == 0:
+            return float("inf")
+        return (self.total - self.completed)/rate
+
+    def getSlowest(self):
+        """
+        Slowest points as a list of (seconds, point), slowest first.
+        """
+        return [(elapsed, point) for elapsed, _, point in sorted(self.slowest_points, reverse=True)]
+
+    def update(self, elapsed, point=None):
+        """
+        Record a completed point which took elapsed seconds in its worker.
+        """
+        index = self.completed
+        self.completed += 1
+        self.busy_time += elapsed
+
+        entry = (elapsed, index, point)
+        if len(self.slowest_points) < self.slowest:
+            heapq.heappush(self.slowest_points, entry)
+        elif elapsed > self.slowest_points[0][0]:
+            heapq.heapreplace(self.slowest_points, entry)
+
+        if self.log is not None:
+            self.log.write(json.dumps({"index": index, "point": _jsonable(point), "elapsed": elapsed, "completed": self.completed, "rate": self.getRate()}) + "\n")
+
+        now = time.perf_counter()
+        if self.stream is not None and (now - self.last_shown > self.interval or self.completed == self.total):
+            self.last_shown = now
+            self.stream.write("\r{}/{} points  {:.2f} points/s  ETA {:.0f} s ".format(self.completed, self.total, self.getRate(), self.getETA()))
+            self.stream.flush()
+
+    def finish(self):
+        """
+        Close the log and print a summary with the slowest points.
+        """
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+        if self.stream is None:
+            return
+        wall = time.perf_counter() - self.start
+        self.stream.write("\n{} points in {:.2f} s ({:.2f} points/s, {:.2f} s of worker time)\n".format(self.completed, wall, self.getRate(), self.busy_time))
+        for elapsed, point in self.getSlowest():
+            self.stream.write("  {:.3f} s: {}\n".format(elapsed, point))
+        self.stream.flush()
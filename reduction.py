@@ -0,0 +1,159 @@
+#! python3
+
+"""
+Tiled, memory bounded reductions over lattices.
+
+Lattice sums with thousands of neighbours have millions of points, too many to
+hold every term (and its temporaries) in memory at once, while adding them one
+at a time in Python is slow and loses precision as the terms oscillate. The
+lattice is instead visited in tiles of whole rows of indices n, small enough
+that the temporaries of one tile stay under MEMORY_LIMIT. The terms of a tile
+are computed as arrays and added pairwise by np.sum, and the tile totals are
+accumulated with Neumaier's compensated summation, so the rounding error does
+not grow with the number of tiles.
+
+Lattices with a getLatticeMask(n, m, origin) method (Square, Honeycomb) are
+generated tile by tile from their indices and never built in full. Other
+lattices are built with getLattice and reduced in chunks.
+"""
+
+import numpy as np
+
+import precision
+import profiling
+from symmetry import isInversionSymmetric
+
+MEMORY_LIMIT = 64*2**20  # bytes of temporaries for one tile
+TEMPORARIES = 8  # rough number of arrays the size of the result alive while a tile is computed
+
+
+def setMemoryLimit(limit):
+    """
+    Set the memory ceiling (bytes) of one tile, for every later reduction.
+    """
+    global MEMORY_LIMIT
+    MEMORY_LIMIT = int(limit)
+
+
+def tileSize(width=1, limit=None):
+    """
+    Number of lattice points in a tile whose terms have width complex values each.
+    """
+    limit = MEMORY_LIMIT if limit is None else limit
+    return max(1, int(limit // (16*width*TEMPORARIES)))
+
+
+def _neumaier(total, value):
+    """
+    Sum of two real arrays and the rounding error it makes.
+    """
+    result = total + value
+    error = np.where(np.abs(total) >= np.abs(value), (total - result) + value, (value - result) + total)
+    return result, error
+
+
+class CompensatedSum:
+    """
+    Neumaier (improved Kahan) summation of real or complex arrays.
+
+    Real and imaginary parts are compensated separately.
+    """
+    def __init__(self):
+        self.total = 0.
+        self.compensation = 0.
+
+    def add(self, value):
+        value = np.asarray(value)
+        if np.iscomplexobj(value) or np.iscomplexobj(self.total):
+            real, real_error = _neumaier(np.real(self.total), value.real)
+            imag, imag_error = _neumaier(np.imag(self.total), value.imag)
+            self.total = real + 1j*imag
+            self.compensation = self.compensation + real_error + 1j*imag_error
+        else:
+            self.total, error = _neumaier(self.total, value)
+            self.compensation = self.compensation + error
+
+    def getValue(self):
+        return self.total + self.compensation
+
+
+def pairwiseSum(terms):
+    """
+    Sum over the first axis with numpy's pairwise summation.
+
+    np.sum only sums pairwise along a contiguous axis, so the points are moved last first.
+    Single precision terms are added in double (precision.py).
+    """
+    terms = np.asarray(terms)
+    dtype = precision.widen(terms[:0]).dtype
+    if terms.ndim == 1:
+        return np.sum(terms, dtype=dtype)
+    return np.ascontiguousarray(np.moveaxis(terms, 0, -1)).sum(axis=-1, dtype=dtype)
+
+
+def getTypeVectors(cell, _type):
+    if _type == "bravais":
+        return cell.getLatticeVectors()
+    return cell.getReciprocalVectors()
+
+
+def latticeTiles(cell, _type, origin, size):
+    """
+    Yield tiles (points, indices) of the points of cell.getLattice(_type, origin), in the same order.
+
+    points has shape (P, 2) with P at most size (or one row of indices if that
+    is longer). indices is the pair of index arrays (n, m) of R = n*a1 + m*a2,
+    or None for lattices without getLatticeMask.
+    """
+    if not hasattr(cell, "getLatticeMask"):
+        points = np.asarray(cell.getLattice(_type, origin), dtype=float).reshape(-1, 2)
+        for start in range(0, len(points), size):
+            yield points[start:start+size], None
+        return
+
+    number = cell.neighbours
+    t1, t2 = [np.asarray(t, dtype=float) for t in getTypeVectors(cell, _type)]
+    row = np.arange(-number, number+1)
+    rows = max(1, size//len(row))
+    for start in range(-number, number+1, rows):
+        n, m = np.meshgrid(np.arange(start, min(start+rows, number+1)), row, indexing='ij')
+        mask = cell.getLatticeMask(n, m, origin)
+        n, m = n[mask], m[mask]
+        yield n[:, None]*t1 + m[:, None]*t2, (n, m)
+
+
+def isLatticeSymmetric(cell, _type="bravais", origin=False, limit=None):
+    """
+    True if cell.getLattice(_type, origin) is unchanged by R -> -R, checked tile by tile for masked lattices.
+    """
+    if not hasattr(cell, "getLatticeMask"):
+        return isInversionSymmetric(cell.getLattice(_type, origin))
+    number = cell.neighbours
+    row = np.arange(-number, number+1)
+    rows = max(1, tileSize(1, limit)//len(row))
+    for start in range(-number, number+1, rows):
+        n, m = np.meshgrid(np.arange(start, min(start+rows, number+1)), row, indexing='ij')
+        if np.any(cell.getLatticeMask(n, m, origin) != cell.getLatticeMask(-n, -m, origin)):
+            return False
+    return True
+
+
+def latticeReduce(cell, _type, origin, terms, width=1, limit=None, reduced=False):
+    """
+    Sum of terms over the points of cell.getLattice(_type, origin).
+
+    args:
+    - terms: function (points, indices) -> array with the points along the first axis, see latticeTiles
+    - width: number of complex values per point in the result of terms, sets the tile size
+    - limit: memory ceiling of a tile (bytes), MEMORY_LIMIT by default
+    - reduced: terms returns the total of the tile (e.g. from a compiled kernel) instead of one term per point
+    """
+    total = CompensatedSum()
+    for points, indices in latticeTiles(cell, _type, origin, tileSize(width, limit)):
+        if len(points) == 0:
+            continue
+        tile = terms(points, indices)
+        total.add(tile if reduced else pairwiseSum(tile))
+        if profiling.enabled:
+            profiling.recordPoints(len(points))
+    return total.getValue()
@@ -0,0 +1,60 @@
+#! python3
+
+"""
+Symmetries used to skip work in interaction matrices and q sweeps.
+
+Reciprocity: the dyadic Green's function is even, G(-r) = G(r), so for a
+lattice which is symmetric under R -> -R the (m, n) block of the interaction
+matrix is the (n, m) lattice sum with conjugated Bloch phases, and both come
+from the same Green's function evaluations.
+
+Time reversal: with real q, H(-q) = H(q)^T. Extinction and det(H - 1/alpha)
+are unchanged by the transpose, so -q only needs computing once.
+"""
+
+import numpy as np
+
+
+def _keys(points, tol):
+    points = np.asarray(points, dtype=float).reshape(len(points), -1)
+    scale = np.abs(points).max() if len(points) else 1.
+    if scale == 0:
+        scale = 1.
+    return [tuple(key) for key in np.rint(points/(tol*scale)).astype(np.int64)], scale
+
+
+def isInversionSymmetric(points, tol=1e-9):
+    """
+    True if the set of points is unchanged by R -> -R.
+    """
+    keys, _ = _keys(points, tol)
+    key_set = set(keys)
+    return all(tuple(-i for i in key) in key_set for key in keys)
+
+
+def timeReversalMap(qpoints, tol=1e-9):
+    """
+    Find which q points are repeats of, or the negatives of, earlier points.
+
+    Returns (independent, source, reversed):
+    - independent: indices of the q points which need computing
+    - source: for every q, the index into independent of the point it is taken from
+    - reversed: for every q, True if it is the negative of its source (so H is transposed)
+    """
+    keys, _ = _keys(qpoints, tol)
+    seen = {}
+    independent = []
+    source = np.empty(len(keys), dtype=int)
+    reverse = np.zeros(len(keys), dtype=bool)
+    for i, key in enumerate(keys):
+        negative = tuple(-j for j in key)
+        if key in seen:
+            source[i] = seen[key]
+        elif negative in seen:
+            source[i] = seen[negative]
+            reverse[i] = True
+        else:
+            seen[key] = len(independent)
+            source[i] = len(independent)
+            independent.append(i)
+    return independent, source, reverse